@@ -1,8 +1,20 @@
+import asyncio
+import contextlib
+import functools
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from dotenv import load_dotenv
 from peewee import *
-from playhouse.mysql_ext import MySQLDatabase
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+from playhouse.migrate import SchemaMigrator, make_index_name, migrate
+import constant
+import metrics
+from cache import TTLCache
 
 load_dotenv('secrets.env')
 HOST = os.getenv('MYSQL_HOST')
@@ -10,12 +22,106 @@ MYSQL_USERNAME = os.getenv('MYSQL_USER')
 MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD')
 DB_NAME = os.getenv('MYSQL_DATABASE_NAME')
 
-db = MySQLDatabase(
-    host=HOST,
-    user=MYSQL_USERNAME,
-    password=MYSQL_PASSWORD,
-    database=DB_NAME
-)
+# Set DB_BACKEND=sqlite to run against a local SQLite file instead of MySQL
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'users.db')
+
+# Connections are handed back to the pool on db.close(), and recycled once they've been open for too long
+if DB_BACKEND == 'sqlite':
+    db = PooledSqliteDatabase(
+        SQLITE_PATH,
+        max_connections=constant.DB_MAX_CONNECTIONS,
+        stale_timeout=constant.DB_STALE_TIMEOUT,
+        timeout=constant.DB_POOL_WAIT_TIMEOUT,
+        # Writers from other threads or bot processes are waited for instead of failing right away
+        pragmas={'journal_mode': 'wal', 'busy_timeout': constant.DB_POOL_WAIT_TIMEOUT * 1000},
+        check_same_thread=False
+    )
+else:
+    db = PooledMySQLDatabase(
+        DB_NAME,
+        host=HOST,
+        user=MYSQL_USERNAME,
+        password=MYSQL_PASSWORD,
+        max_connections=constant.DB_MAX_CONNECTIONS,
+        stale_timeout=constant.DB_STALE_TIMEOUT,
+        timeout=constant.DB_POOL_WAIT_TIMEOUT
+    )
+
+# Every query from the event loop runs on this executor. It never has more threads than the pool has connections
+db_executor = ThreadPoolExecutor(max_workers=min(constant.DB_EXECUTOR_WORKERS, constant.DB_MAX_CONNECTIONS),
+                                 thread_name_prefix='db')
+
+
+async def run_async(function, *args, **kwargs):
+    """
+    Runs one of the blocking database functions in this module on the database executor,
+    so a slow query doesn't stall the discord event loop
+
+    :param function: The database function to run, e.g. DbModel.get_user_access_token
+    :return: Whatever the function returns
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(__timed__, function, *args, **kwargs))
+
+
+def __timed__(function, *args, **kwargs):
+    # Only the time spent in the function, waiting for a free executor thread isn't the query's fault
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        metrics.observe('db_query_duration_seconds', time.perf_counter() - start, query=function.__name__)
+
+
+# Recently used WakaData records keyed by (discord_username, server_id), so a single command doesn't select the same
+# row again and again. Every write in this module updates or drops the records it touches. Records still expire after
+# a while since the registration site writes to the table too
+record_cache = TTLCache(constant.DB_RECORD_CACHE_SIZE, constant.DB_RECORD_CACHE_TTL)
+record_cache_lock = threading.Lock()  # Queries run on several executor threads
+
+# SQLite lets one writer in at a time and the ones it turns away sleep before they retry, up to a tenth of a second
+# at a time. Bulk writes from the executor threads queue up here instead, so the next one starts right away
+bulk_write_lock = threading.Lock() if DB_BACKEND == 'sqlite' else contextlib.nullcontext()
+
+
+def __record_key__(discord_username, server_id):
+    # discord.Member objects get passed in too, the column holds their string form
+    return str(discord_username), int(server_id)
+
+
+def __copy_record__(record):
+    # Callers change the records they get, like new tokens before they're saved. The cache only ever holds and hands
+    # out copies, so a change that never made it to the database doesn't show up in the next lookup
+    copy = WakaData(**record.__data__)
+    copy._dirty = set(record._dirty)
+    return copy
+
+
+def __cache_records__(records):
+    with record_cache_lock:
+        for record in records:
+            record_cache.set(__record_key__(record.discord_username, record.server_id), __copy_record__(record))
+
+
+def __uncache_record__(discord_username, server_id):
+    with record_cache_lock:
+        record_cache.invalidate(__record_key__(discord_username, server_id))
+
+
+def __uncache_records__(predicate):
+    """
+    Drops every cached record that matches the predicate
+    :param predicate: Function that takes a WakaData object and returns True if it should be dropped
+    """
+    with record_cache_lock:
+        record_cache.invalidate_values_where(predicate)
+
+
+# Closes every pooled connection and stops the database executor. Used when the bot shuts down
+def shutdown():
+    db_executor.shutdown(wait=True)
+    db.close_all()
 
 
 class BaseModel(Model):
@@ -26,10 +132,19 @@ class BaseModel(Model):
 
 class WakaData(BaseModel):
     discord_username = CharField(null=False, max_length=40)
-    wakatime_username = CharField(null=True, max_length=40)
+    discord_id = BigIntegerField(null=True)  # Discord user id. Rows registered before it was stored get it on first use
+    wakatime_username = CharField(null=True, max_length=40)  # Holds the wakatime user id, which never changes
     auth_token = CharField(null=True, max_length=100)
     refresh_token = CharField(null=True, max_length=100)
     server_id = BigIntegerField(null=False)
+    expires_at = DateTimeField(null=True)  # UTC time the access token expires, None if unknown
+    # The registration site inserts rows too, so these have defaults in the database as well
+    failure_count = IntegerField(null=False, default=0, constraints=[SQL('DEFAULT 0')])  # Failures in a row
+    next_attempt_at = DateTimeField(null=True)  # UTC time before which the registration is skipped after failing
+    # False once wakatime kept refusing the tokens, until the user registers again
+    active = BooleanField(null=False, default=True, constraints=[SQL('DEFAULT 1')])
+    # If the user was told their registration was deactivated
+    notified = BooleanField(null=False, default=False, constraints=[SQL('DEFAULT 0')])
 
     class Meta:
         primary_key = CompositeKey('discord_username', 'server_id')
@@ -37,26 +152,300 @@ class WakaData(BaseModel):
 
 class AuthenticationState(BaseModel):
     discord_username = CharField(null=False, max_length=40)
+    discord_id = BigIntegerField(null=True)
     server_id = BigIntegerField(null=False)
     state = CharField(null=False, max_length=50)
+    created_at = DateTimeField(null=True, default=datetime.utcnow)  # UTC time !register was used, expires after a while
 
     class Meta:
         primary_key = CompositeKey('discord_username', 'server_id')
 
 
-# Self explanatory
-def init_tables():
-    db.connect(reuse_if_open=True)
+class DailySummary(BaseModel):
+    # The wakatime account the day belongs to. See account_key()
+    account = CharField(null=False, max_length=40)
+    day = DateField(null=False)
+    total_seconds = FloatField(null=False, default=0)
+
+    class Meta:
+        primary_key = CompositeKey('account', 'day')
+
+
+class DailyLanguage(BaseModel):
+    # The seconds a day's summary spent on each language, a row per language so the database can sum them up.
+    # The only place the languages of a day are stored, written together with the DailySummary of the day
+    account = CharField(null=False, max_length=40)
+    language = CharField(null=False, max_length=100)
+    day = DateField(null=False)
+    seconds = FloatField(null=False, default=0)
+
+    class Meta:
+        # Rows are stored in key order (InnoDB always does, SQLite only without a rowid), so summing up the days of
+        # every language of an account reads them one after the other instead of jumping around the table
+        primary_key = CompositeKey('account', 'language', 'day')
+        without_rowid = isinstance(db, SqliteDatabase)
+
+
+class SchemaVersion(BaseModel):
+    """Every migration that has been applied to the database"""
+    version = IntegerField(primary_key=True)
+    applied_at = DateTimeField(default=datetime.utcnow)
+
+
+# Migrations have to be idempotent. Databases created before versioning existed already went through some of them
+def __create_base_tables__(migrator):
     db.create_tables([WakaData, AuthenticationState])
-    db.close()
+
+
+def __add_token_expiry__(migrator):
+    if not __has_column__(WakaData, 'expires_at'):
+        migrate(migrator.add_column(WakaData._meta.table_name, 'expires_at', WakaData.expires_at))
+
+
+def __create_daily_summaries__(migrator):
+    db.create_tables([DailySummary])
+
+
+def __add_lookup_indexes__(migrator):
+    # update_tokens_bulk and update_tokens_from_old_refresh_token find rows by refresh token
+    __add_index__(migrator, WakaData, ['refresh_token'])
+    # get_authenticated_discord_users and get_servers_with_authenticated_users filter on server_id and auth_token.
+    # Lookups by discord_username are already covered by the primary key, which starts with it
+    __add_index__(migrator, WakaData, ['server_id', 'auth_token'])
+    # Registrations are completed by looking up their state
+    __add_index__(migrator, AuthenticationState, ['state'])
+
+
+def __add_discord_ids__(migrator):
+    # Existing rows are filled in by the bot as it sees the users, usernames can't be turned into ids here
+    for model in [WakaData, AuthenticationState]:
+        if not __has_column__(model, 'discord_id'):
+            migrate(migrator.add_column(model._meta.table_name, 'discord_id', model.discord_id))
+    __add_index__(migrator, WakaData, ['discord_id', 'server_id'])
+
+
+def __add_failure_tracking__(migrator):
+    # Added as nullable columns, making them NOT NULL afterwards would drop their defaults on MySQL.
+    # Existing rows get the defaults either way
+    columns = {'failure_count': IntegerField(null=True, constraints=[SQL('DEFAULT 0')]),
+               'next_attempt_at': DateTimeField(null=True),
+               'active': BooleanField(null=True, constraints=[SQL('DEFAULT 1')]),
+               'notified': BooleanField(null=True, constraints=[SQL('DEFAULT 0')])}
+    for column, field in columns.items():
+        if not __has_column__(WakaData, column):
+            migrate(migrator.add_column(WakaData._meta.table_name, column, field))
+
+
+def __add_authentication_state_expiry__(migrator):
+    if not __has_column__(AuthenticationState, 'created_at'):
+        migrate(migrator.add_column(AuthenticationState._meta.table_name, 'created_at', AuthenticationState.created_at))
+        # Pending registrations get the full time to finish from now on
+        AuthenticationState.update(created_at=datetime.utcnow()).execute()
+    # The sweeper deletes states by age
+    __add_index__(migrator, AuthenticationState, ['created_at'])
+
+
+def __make_discord_ids_unique__(migrator):
+    # Renamed users could end up registered twice in a server. The registration that still works is kept,
+    # then a unique index makes sure it can't happen again. Rows without an id don't collide
+    duplicates = list(WakaData.select(WakaData.discord_id, WakaData.server_id)
+                              .where(~WakaData.discord_id >> None)
+                              .group_by(WakaData.discord_id, WakaData.server_id)
+                              .having(fn.COUNT(1) > 1)
+                              .tuples())
+    for discord_id, server_id in duplicates:
+        rows = list(WakaData.select().where((WakaData.discord_id == discord_id) & (WakaData.server_id == server_id)))
+        keep = max(rows, key=lambda row: (bool(row.active) and row.auth_token is not None,
+                                          row.expires_at or datetime.min))
+        for row in rows:
+            if row.discord_username != keep.discord_username:
+                WakaData.delete().where((WakaData.discord_username == row.discord_username) &
+                                        (WakaData.server_id == server_id)).execute()
+
+    # The unique index gets the same name as the plain one added by __add_discord_ids__
+    table = WakaData._meta.table_name
+    name = make_index_name(table, ['discord_id', 'server_id'])
+    if any(index.name == name and not index.unique for index in db.get_indexes(table)):
+        migrate(migrator.drop_index(table, name))
+    __add_index__(migrator, WakaData, ['discord_id', 'server_id'], unique=True)
+
+
+def __create_daily_languages__(migrator):
+    db.create_tables([DailyLanguage])
+    # Days stored before get their languages copied over from the JSON column __drop_daily_summary_languages__
+    # removes, a batch of days at a time
+    if not __has_column__(DailySummary, 'languages'):
+        return
+    days = DailySummary.select(DailySummary.account, DailySummary.day, SQL('languages'))\
+                       .where(SQL('languages IS NOT NULL'))\
+                       .namedtuples()\
+                       .iterator()
+    for batch in __batches__(days, constant.DB_BATCH_SIZE):
+        rows = [row for day in batch for row in __language_rows__(day.account, day.day, json.loads(day.languages))]
+        for sql, params in __replacements__(DailyLanguage, rows):
+            db.execute_sql(sql, params)
+
+
+def __drop_daily_summary_languages__(migrator):
+    # DailyLanguage holds the languages of every day now
+    if __has_column__(DailySummary, 'languages'):
+        migrate(migrator.drop_column(DailySummary._meta.table_name, 'languages'))
+
+
+# Every migration in the order they get applied. Only ever add to the end of this list
+MIGRATIONS = [
+    __create_base_tables__,
+    __add_token_expiry__,
+    __create_daily_summaries__,
+    __add_lookup_indexes__,
+    __add_discord_ids__,
+    __add_failure_tracking__,
+    __add_authentication_state_expiry__,
+    __make_discord_ids_unique__,
+    __create_daily_languages__,
+    __drop_daily_summary_languages__,
+]
+
+
+def __batches__(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def __language_rows__(account, day, languages):
+    """
+    Turns the languages of a day into DailyLanguage rows, languages without seconds are left out
+
+    :param languages: Dictionary of language name -> seconds, or None
+    """
+    if not languages:
+        return []
+    return [{'account': account, 'day': day, 'language': name, 'seconds': seconds}
+            for name, seconds in languages.items() if seconds]
+
+
+@functools.lru_cache(maxsize=None)
+def __replace_template__(model, count):
+    """
+    :return: SQL that inserts count rows into the table of model, replacing the ones with the same key
+    """
+    placeholders = {field: None for field in model._meta.sorted_fields}
+    sql, _ = model.insert_many([placeholders] * count).on_conflict_replace().sql()
+    return sql
+
+
+def __replacements__(model, rows):
+    """
+    Builds the statements that insert rows in batches, replacing the ones with the same key.
+    insert_many renders its SQL value by value, which takes longer than running it for many small rows,
+    so the SQL comes from a cached template and only the parameters are built per call
+
+    :param model: The model of the table
+    :param rows: List of dictionaries of field name -> value, with every field of the model
+    :return: List of (sql, parameters) tuples
+    """
+    fields = model._meta.sorted_fields
+    statements = []
+    for start in range(0, len(rows), constant.DB_BATCH_SIZE):
+        batch = rows[start:start + constant.DB_BATCH_SIZE]
+        statements.append((__replace_template__(model, len(batch)),
+                           [field.db_value(row[field.name]) for row in batch for field in fields]))
+    return statements
+
+
+def __has_column__(model, column):
+    return column in [c.name for c in db.get_columns(model._meta.table_name)]
+
+
+def __add_index__(migrator, model, columns, unique=False):
+    table = model._meta.table_name
+    if make_index_name(table, columns) not in [index.name for index in db.get_indexes(table)]:
+        migrate(migrator.add_index(table, columns, unique))
+
+
+def migrate_schema(target_version=None):
+    """
+    Brings the database schema up to date by applying every migration that hasn't been applied yet
+
+    :param target_version: OPTIONAL parameter. Stop after this version instead of applying everything
+    :return: The schema version the database is at
+    """
+    db.connect(reuse_if_open=True)
+    try:
+        # Bot processes starting at the same time would otherwise both see the same version and apply its migrations
+        with __migration_lock__():
+            db.create_tables([SchemaVersion])
+            current_version = SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+            migrator = SchemaMigrator.from_database(db)
+
+            for version, migration in enumerate(MIGRATIONS, start=1):
+                if version <= current_version:
+                    continue
+                if target_version is not None and version > target_version:
+                    break
+
+                # MySQL commits schema changes right away, so a failed migration must be safe to run again
+                with db.atomic():
+                    migration(migrator)
+                    SchemaVersion.create(version=version)
+                current_version = version
+                print("Applied database migration {}: {}".format(version, migration.__name__.strip('_')))
+
+            return current_version
+    finally:
+        db.close()
+
+
+@contextlib.contextmanager
+def __migration_lock__():
+    """
+    Keeps other processes from migrating the schema at the same time, for as long as the block runs.
+    MySQL gets a named lock, since its schema changes can't be rolled back anyway. SQLite holds a write transaction
+    the whole time, other writers wait for it to end
+    """
+    if DB_BACKEND == 'sqlite':
+        # Migrations can take longer than a write usually does
+        db.pragma('busy_timeout', constant.MIGRATION_LOCK_TIMEOUT * 1000)
+        try:
+            with db.atomic('IMMEDIATE'):
+                yield
+        finally:
+            db.pragma('busy_timeout', constant.DB_POOL_WAIT_TIMEOUT * 1000)
+        return
+
+    name = '{}.schema_migrations'.format(DB_NAME)
+    if db.execute_sql('SELECT GET_LOCK(%s, %s)', (name, constant.MIGRATION_LOCK_TIMEOUT)).fetchone()[0] != 1:
+        raise OperationalError('Timed out waiting for another process to migrate the database')
+    try:
+        yield
+    finally:
+        db.execute_sql('SELECT RELEASE_LOCK(%s)', (name,))
 
 
 # Used when the register command is used. Initializes an entry in the db with the discord_user and serverid that
 # requested to be initialized.
-def initialize_user_data(discord_username, server_id, state):
+def initialize_user_data(discord_username, server_id, state, discord_id=None):
+    # The registration is about to change the user's row
+    __uncache_record__(discord_username, server_id)
+
     try:
         db.connect(reuse_if_open=True)
-        code = AuthenticationState.create(discord_username=discord_username, server_id=server_id, state=state)
+        # A deactivated registration starts over, its old tokens don't work anymore
+        WakaData.update(auth_token=None, refresh_token=None, expires_at=None, failure_count=0, next_attempt_at=None,
+                        active=True, notified=False)\
+                .where((WakaData.discord_username == discord_username) & (WakaData.server_id == server_id) &
+                       (WakaData.active == False))\
+                .execute()
+        # Using !register again replaces the pending registration, and restarts its expiry
+        code = AuthenticationState(discord_username=discord_username, discord_id=discord_id, server_id=server_id,
+                                   state=state, created_at=datetime.utcnow())
+        AuthenticationState.insert(**code.__data__).on_conflict_replace().execute()
         db.close()
         return code
     except Exception as e:
@@ -66,27 +455,47 @@ def initialize_user_data(discord_username, server_id, state):
 
 
 # Updates discord username with server ids tokens
-def update_user_tokens(discord_username, server_id, new_auth_token, new_refresh_token):
+def update_user_tokens(discord_username, server_id, new_auth_token, new_refresh_token, expires_at=None):
+    data = get_discord_user_data(discord_username, server_id)
+    if data is None:
+        raise WakaData.DoesNotExist('{} is not registered in server {}'.format(discord_username, server_id))
+
     db.connect(reuse_if_open=True)
 
-    data = WakaData.get((WakaData.discord_username == discord_username) & (WakaData.server_id == server_id))
     data.auth_token = new_auth_token
     data.refresh_token = new_refresh_token
+    data.expires_at = expires_at
 
     code = data.save()
     db.close()
+    __cache_records__([data])
     return code
 
 
-# Returns the WakaData object associated with the discord username and server id
-def get_discord_user_data(discord_user, serverid):
+# Returns the WakaData object associated with the discord username and server id.
+# When the discord id is given the user is found by id, so it still works after they change their name
+def get_discord_user_data(discord_user, serverid, discord_id=None):
+    with record_cache_lock:
+        user = record_cache.get(__record_key__(discord_user, serverid))
+    if user is not None and (discord_id is None or user.discord_id == discord_id):
+        return __copy_record__(user)
+
     try:
         db.connect(reuse_if_open=True)
 
-        data = WakaData.select().where((WakaData.discord_username == discord_user) & (WakaData.server_id == serverid))
-        user = data[0]
+        if discord_id is None:
+            user = WakaData.get((WakaData.discord_username == discord_user) & (WakaData.server_id == serverid))
+        else:
+            # Registrations are found by id first, rows registered before ids were stored can only be found by name
+            user = WakaData.get_or_none((WakaData.discord_id == discord_id) & (WakaData.server_id == serverid))
+            if user is None:
+                user = WakaData.get((WakaData.discord_id >> None) & (WakaData.discord_username == discord_user) &
+                                    (WakaData.server_id == serverid))
 
         db.close()
+        if discord_id is not None and (user.discord_id != discord_id or user.discord_username != str(discord_user)):
+            user = __update_discord_identity__(user, str(discord_user), discord_id)
+        __cache_records__([user])
         return user
     except Exception as e:
         print(e)
@@ -101,41 +510,20 @@ def is_user_initialized_not_authenticated(discord_username, server_id):
 
 
 # Checks to see if a user has been fully authenticated (aka, exists in DB with access token
-def is_user_authenticated(discord_username, server_id):
-    return get_user_access_token(discord_username, server_id) is not None
-
+def is_user_authenticated(discord_username, server_id, discord_id=None):
+    return get_user_access_token(discord_username, server_id, discord_id) is not None
 
-# Get's the discord user in server ID's access token
-def get_user_access_token(discord_user, server_id):
-    try:
-        db.connect(reuse_if_open=True)
 
-        data = WakaData.select().where((WakaData.discord_username == discord_user) & (WakaData.server_id == server_id))
-        access_token = data[0].auth_token
-
-        db.close()
-        return access_token
-    except Exception as e:
-        print(e)
-        db.close()
-        return None
+# Get's the discord user in server ID's access token. Deactivated registrations don't have a usable one
+def get_user_access_token(discord_user, server_id, discord_id=None):
+    user = get_discord_user_data(discord_user, server_id, discord_id)
+    return user.auth_token if user is not None and user.active else None
 
 
 # Gets the discord user in server id's refresh token
 def get_user_refresh_token(discord_username, server_id):
-    try:
-        db.connect(reuse_if_open=True)
-
-        data = WakaData.select().where((WakaData.discord_username == discord_username) &
-                                       (WakaData.server_id == server_id))
-        refresh_token = data[0].refresh_token
-
-        db.close()
-        return refresh_token
-    except Exception as e:
-        print(e)
-        db.close()
-        return None
+    user = get_discord_user_data(discord_username, server_id)
+    return user.refresh_token if user is not None else None
 
 
 def get_authenticated_discord_users(server_id, as_is=False):
@@ -149,10 +537,14 @@ def get_authenticated_discord_users(server_id, as_is=False):
     try:
         # Get data from database
         db.connect(reuse_if_open=True)
-        data = WakaData.select().where((WakaData.server_id == server_id) &  # ServerID is equal
-                                       (~WakaData.auth_token >> None))  # auth_token is not None
+        # Run the query now, iterating it later would need the connection we are about to give back
+        data = list(WakaData.select().where((WakaData.server_id == server_id) &  # ServerID is equal
+                                            (~WakaData.auth_token >> None) &  # auth_token is not None
+                                            (WakaData.active == True)))  # Not deactivated
 
         db.close()
+        # Commands about these users right after a leaderboard don't need to select them again
+        __cache_records__(data)
 
         # If we dont pass in as_is, return the data as is
         if as_is:
@@ -170,6 +562,335 @@ def get_authenticated_discord_users(server_id, as_is=False):
         return None
 
 
+def get_servers_with_authenticated_users():
+    """
+    Gets the ids of every server that has at least one authenticated user
+
+    :return: A list of server ids
+    """
+    try:
+        db.connect(reuse_if_open=True)
+        data = WakaData.select(WakaData.server_id).where((~WakaData.auth_token >> None) &
+                                                         (WakaData.active == True)).distinct()
+        result = [row.server_id for row in data]
+        db.close()
+        return result
+    except Exception as e:
+        print(e)
+        db.close()
+        return []
+
+
+def update_wakatime_usernames(account_updates):
+    """
+    Stores which wakatime account registrations belong to, in a single transaction
+
+    :param account_updates: List of (discord_username, server_id, wakatime account id) tuples
+    :return: Nothing
+    """
+    if not account_updates:
+        return
+
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            for discord_username, server_id, account in account_updates:
+                WakaData.update(wakatime_username=account)\
+                        .where((WakaData.discord_username == discord_username) & (WakaData.server_id == server_id))\
+                        .execute()
+    finally:
+        db.close()
+        for discord_username, server_id, _ in account_updates:
+            __uncache_record__(discord_username, server_id)
+
+
+def record_registration_outcomes(recovered, failures):
+    """
+    Stores which registrations failed to refresh or fetch and until when they're skipped,
+    and resets the ones that worked again, in a single transaction
+
+    :param recovered: List of (discord_username, server_id) tuples of registrations that worked after failing
+    :param failures: List of (discord_username, server_id, failure_count, next_attempt_at, active) tuples
+    :return: Nothing
+    """
+    if not recovered and not failures:
+        return
+
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            for discord_username, server_id in recovered:
+                WakaData.update(failure_count=0, next_attempt_at=None)\
+                        .where((WakaData.discord_username == discord_username) & (WakaData.server_id == server_id))\
+                        .execute()
+            for discord_username, server_id, failure_count, next_attempt_at, active in failures:
+                WakaData.update(failure_count=failure_count, next_attempt_at=next_attempt_at, active=active)\
+                        .where((WakaData.discord_username == discord_username) & (WakaData.server_id == server_id))\
+                        .execute()
+    finally:
+        db.close()
+        for discord_username, server_id in recovered:
+            __uncache_record__(discord_username, server_id)
+        for discord_username, server_id, _, _, _ in failures:
+            __uncache_record__(discord_username, server_id)
+
+
+def get_unnotified_deactivated_users(server_ids):
+    """
+    Gets the deactivated registrations whose users weren't told about it yet
+
+    :param server_ids: The ids of the servers to look in
+    :return: A list of WakaData objects
+    """
+    if not server_ids:
+        return []
+
+    try:
+        db.connect(reuse_if_open=True)
+        data = list(WakaData.select().where((WakaData.active == False) & (WakaData.notified == False) &
+                                            (WakaData.server_id.in_(server_ids))))
+        db.close()
+        return data
+    except Exception as e:
+        print(e)
+        db.close()
+        return []
+
+
+def claim_notification(discord_username, server_id):
+    """
+    Marks a deactivated registration as notified, unless another bot process got to it first
+
+    :return: True if the caller should send the notification
+    """
+    db.connect(reuse_if_open=True)
+    try:
+        claimed = WakaData.update(notified=True)\
+                          .where((WakaData.discord_username == discord_username) & (WakaData.server_id == server_id) &
+                                 (WakaData.active == False) & (WakaData.notified == False))\
+                          .execute()
+    finally:
+        db.close()
+
+    __uncache_record__(discord_username, server_id)
+    return claimed == 1
+
+
+def __update_discord_identity__(user, discord_username, discord_id):
+    """
+    Stores a registration's discord id, and its current name if the user renamed themselves since registering
+
+    :param user: WakaData object of the registration
+    :param discord_username: The user's current discord name
+    :param discord_id: The user's discord id
+    :return: The updated WakaData object
+    """
+    old_username = user.discord_username
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            for model in [WakaData, AuthenticationState]:
+                model.update(discord_id=discord_id, discord_username=discord_username)\
+                     .where((model.discord_username == old_username) & (model.server_id == user.server_id))\
+                     .execute()
+        user.discord_username = discord_username
+    except Exception as e:
+        # Someone else registered under the new name, keep the old one
+        print(e)
+        WakaData.update(discord_id=discord_id)\
+                .where((WakaData.discord_username == old_username) & (WakaData.server_id == user.server_id))\
+                .execute()
+    finally:
+        db.close()
+
+    __uncache_record__(old_username, user.server_id)
+    user.discord_id = discord_id
+    return user
+
+
+def update_discord_ids(id_updates):
+    """
+    Stores the discord ids of registrations that were made before ids were stored, in a single transaction
+
+    :param id_updates: List of (discord_username, server_id, discord_id) tuples
+    :return: Nothing
+    """
+    if not id_updates:
+        return
+
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            for discord_username, server_id, discord_id in id_updates:
+                registered = WakaData.select().where((WakaData.discord_id == discord_id) &
+                                                     (WakaData.server_id == server_id) &
+                                                     (WakaData.discord_username != discord_username))
+                if registered.exists():
+                    # The user registered again under a new name, the old registration was a duplicate
+                    WakaData.delete().where((WakaData.discord_username == discord_username) &
+                                            (WakaData.server_id == server_id) & (WakaData.discord_id >> None))\
+                                     .execute()
+                for model in [WakaData, AuthenticationState]:
+                    model.update(discord_id=discord_id)\
+                         .where((model.discord_username == discord_username) & (model.server_id == server_id) &
+                                (model.discord_id >> None))\
+                         .execute()
+    finally:
+        db.close()
+        for discord_username, server_id, _ in id_updates:
+            __uncache_record__(discord_username, server_id)
+
+
+def get_registrations_without_discord_id(server_ids):
+    """
+    Gets the registrations that were made before discord ids were stored
+
+    :param server_ids: The ids of the servers to look in
+    :return: A list of (discord_username, server_id) tuples
+    """
+    if not server_ids:
+        return []
+
+    db.connect(reuse_if_open=True)
+    try:
+        return [(row.discord_username, row.server_id) for row in
+                WakaData.select(WakaData.discord_username, WakaData.server_id)
+                        .where((WakaData.discord_id >> None) & WakaData.server_id.in_(server_ids))]
+    finally:
+        db.close()
+
+
+def account_key(user):
+    """
+    Gets the key a user's daily summaries are stored under.
+    The wakatime username if we know it, the discord username otherwise.
+
+    :param user: WakaData object of the user
+    :return: The account key as a string
+    """
+    return user.wakatime_username or user.discord_username
+
+
+def get_daily_summaries(account, start, end):
+    """
+    Gets the stored daily summaries of an account between two dates, with the languages of every day
+
+    :param account: The account key, see account_key()
+    :param start: The first day as a date
+    :param end: The last day as a date
+    :return: A list of dictionaries with 'day', 'total_seconds' and 'languages' (language name -> seconds) keys,
+             ordered by day
+    """
+    try:
+        db.connect(reuse_if_open=True)
+        days = {row.day: {'day': row.day, 'total_seconds': row.total_seconds, 'languages': {}}
+                for row in DailySummary.select(DailySummary.day, DailySummary.total_seconds)
+                                       .where((DailySummary.account == account) &
+                                              (DailySummary.day.between(start, end)))
+                                       .order_by(DailySummary.day)
+                                       .namedtuples()}
+        for day, language, seconds in DailyLanguage.select(DailyLanguage.day, DailyLanguage.language,
+                                                           DailyLanguage.seconds)\
+                                                   .where((DailyLanguage.account == account) &
+                                                          (DailyLanguage.day.between(start, end)))\
+                                                   .tuples():
+            if day in days:
+                days[day]['languages'][language] = seconds
+        db.close()
+        return list(days.values())
+    except Exception as e:
+        print(e)
+        db.close()
+        return []
+
+
+def get_stored_days(account, start, end):
+    """
+    Gets which days between two dates have a stored daily summary for an account
+
+    :param account: The account key, see account_key()
+    :param start: The first day as a date
+    :param end: The last day as a date
+    :return: A set of dates
+    """
+    try:
+        db.connect(reuse_if_open=True)
+        days = set(row.day for row in DailySummary.select(DailySummary.day)
+                                                  .where((DailySummary.account == account) &
+                                                         (DailySummary.day.between(start, end)))
+                                                  .namedtuples())
+        db.close()
+        return days
+    except Exception as e:
+        print(e)
+        db.close()
+        return set()
+
+
+def get_language_seconds_of_accounts(accounts, start, end):
+    """
+    Sums up the seconds every account spent on each language between two dates, in the database.
+    A batch of accounts per query
+
+    :param accounts: List of account keys, see account_key()
+    :param start: The first day as a date
+    :param end: The last day as a date
+    :return: A list of (account, language, seconds) tuples
+    """
+    data = []
+    try:
+        db.connect(reuse_if_open=True)
+        for first in range(0, len(accounts), constant.DB_READ_BATCH_SIZE):
+            batch = accounts[first:first + constant.DB_READ_BATCH_SIZE]
+            data.extend(DailyLanguage.select(DailyLanguage.account, DailyLanguage.language,
+                                             fn.SUM(DailyLanguage.seconds))
+                                     .where((DailyLanguage.account.in_(batch)) &
+                                            (DailyLanguage.day.between(start, end)))
+                                     .group_by(DailyLanguage.account, DailyLanguage.language)
+                                     .tuples())
+        db.close()
+        return data
+    except Exception as e:
+        print(e)
+        db.close()
+        return []
+
+
+def save_daily_summaries(account, days):
+    """
+    Stores daily summaries of an account, replacing the ones that were already stored for the same days
+
+    :param account: The account key, see account_key()
+    :param days: List of dictionaries with 'day', 'total_seconds' and 'languages' (language name -> seconds) keys
+    :return: Nothing
+    """
+    if not days:
+        return
+
+    rows = [{'account': account,
+             'day': day['day'],
+             'total_seconds': day['total_seconds']} for day in days]
+    language_rows = [row for day in days for row in __language_rows__(account, day['day'], day['languages'])]
+
+    # Building the statements takes longer than running them, so it's done before the transaction starts.
+    # Other writers have to wait for as long as it's open
+    statements = __replacements__(DailySummary, rows)
+    for start in range(0, len(rows), constant.DB_BATCH_SIZE):
+        # A language can disappear from a day that is fetched again
+        days_in_batch = [row['day'] for row in rows[start:start + constant.DB_BATCH_SIZE]]
+        statements.append(DailyLanguage.delete().where((DailyLanguage.account == account) &
+                                                       (DailyLanguage.day.in_(days_in_batch))).sql())
+    statements += __replacements__(DailyLanguage, language_rows)
+
+    db.connect(reuse_if_open=True)
+    try:
+        with bulk_write_lock, db.atomic():
+            for sql, params in statements:
+                db.execute_sql(sql, params)
+    finally:
+        db.close()
+
+
 def __debug_log_all_data__():
     db.connect(reuse_if_open=True)
 
@@ -187,13 +908,205 @@ def get_user_with_no_access_token(discord_username):
     return data
 
 
-def update_tokens_from_old_refresh_token(old_refresh_token, new_refresh_token, access_token):
+def update_tokens_from_old_refresh_token(old_refresh_token, new_refresh_token, access_token, expires_at=None):
     db.connect(reuse_if_open=True)
-    query = WakaData.update(refresh_token=new_refresh_token, auth_token=access_token)\
+    query = WakaData.update(refresh_token=new_refresh_token, auth_token=access_token, expires_at=expires_at)\
                     .where(WakaData.refresh_token == old_refresh_token)
     code = query.execute()
-    #db.close() For some reason this line slows token refreshing by like 31%
+    # Closing only hands the connection back to the pool
+    db.close()
+    __uncache_records__(lambda record: record.refresh_token in (old_refresh_token, new_refresh_token))
     return code
 
-#init_tables()
+def update_tokens_bulk(token_updates):
+    """
+    Writes the results of many token refreshes in a single transaction.
+    Rows are matched by their old refresh token and updated in batches, one UPDATE per batch.
+    Matching on the old token makes every row a compare and swap: if another bot process refreshed the row
+    first, it holds a different refresh token by now and is left alone.
+
+    :param token_updates: List of (old_refresh_token, new_refresh_token, access_token, expires_at) tuples
+    :return: The set of new refresh tokens that were written. Refreshes missing from it lost the race
+    """
+    if not token_updates:
+        return set()
+
+    written = set()
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            for start in range(0, len(token_updates), constant.DB_BATCH_SIZE):
+                batch = token_updates[start:start + constant.DB_BATCH_SIZE]
+
+                # refresh_token has to be assigned last, MySQL evaluates the assignments from left to right
+                # and the other CASEs still need to match on the old refresh token
+                query = WakaData.update(
+                    auth_token=Case(WakaData.refresh_token, [(row[0], row[2]) for row in batch], WakaData.auth_token),
+                    expires_at=Case(WakaData.refresh_token, [(row[0], row[3]) for row in batch], WakaData.expires_at),
+                    refresh_token=Case(WakaData.refresh_token, [(row[0], row[1]) for row in batch],
+                                       WakaData.refresh_token)
+                ).where(WakaData.refresh_token.in_([row[0] for row in batch]))
+                query.execute()
+
+                # New refresh tokens are unique, so a row that holds one was swapped by this transaction
+                new_tokens = [row[1] for row in batch]
+                written.update(row.refresh_token for row in
+                               WakaData.select(WakaData.refresh_token).where(WakaData.refresh_token.in_(new_tokens)))
+    finally:
+        db.close()
+        refresh_tokens = set(row[0] for row in token_updates) | set(row[1] for row in token_updates)
+        __uncache_records__(lambda record: record.refresh_token in refresh_tokens)
+
+    return written
+
+
+def claim_authentication_state(state):
+    """
+    Finds the pending registration a state belongs to and removes it, so it can only be completed once
+
+    :param state: The state wakatime sent back to the OAuth callback
+    :return: The AuthenticationState object, or None if there is no pending registration with that state
+             or it has expired
+    """
+    not_before = datetime.utcnow() - timedelta(seconds=constant.AUTH_STATE_TTL)
+    db.connect(reuse_if_open=True)
+    try:
+        pending = AuthenticationState.get_or_none((AuthenticationState.state == state) &
+                                                  (AuthenticationState.created_at >= not_before))
+        if pending is None:
+            return None
+
+        # Whoever deletes the row owns the registration, the same callback can arrive twice
+        claimed = AuthenticationState.delete().where((AuthenticationState.state == state) &
+                                                     (AuthenticationState.discord_username == pending.discord_username) &
+                                                     (AuthenticationState.server_id == pending.server_id)).execute()
+        return pending if claimed == 1 else None
+    finally:
+        db.close()
+
+
+def complete_registration(pending, auth_token, refresh_token, expires_at, wakatime_username):
+    """
+    Stores the tokens of a finished registration. Registrations that were deactivated
+    or made under an older name of the same discord user are replaced, including ones made before
+    discord ids were stored that belong to the same wakatime account
+
+    :param pending: The claimed AuthenticationState object, see claim_authentication_state
+    :param wakatime_username: The wakatime user id the tokens belong to, None if unknown
+    :return: The WakaData object of the registration
+    """
+    user = WakaData(discord_username=pending.discord_username, discord_id=pending.discord_id,
+                    server_id=pending.server_id, wakatime_username=wakatime_username, auth_token=auth_token,
+                    refresh_token=refresh_token, expires_at=expires_at, failure_count=0, next_attempt_at=None,
+                    active=True, notified=False)
+
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            same_user = None
+            if pending.discord_id is not None:
+                same_user = WakaData.discord_id == pending.discord_id
+            if wakatime_username is not None:
+                # Rows without an id can't be told apart by name once the user renamed, but their account is the same
+                same_account = (WakaData.wakatime_username == wakatime_username) & (WakaData.discord_id >> None)
+                same_user = same_account if same_user is None else same_user | same_account
+            if same_user is not None:
+                WakaData.delete().where(same_user & (WakaData.server_id == pending.server_id) &
+                                        (WakaData.discord_username != pending.discord_username)).execute()
+            WakaData.insert(**user.__data__).on_conflict_replace().execute()
+    finally:
+        db.close()
+
+    __uncache_records__(lambda record: int(record.server_id) == int(pending.server_id) and
+                        ((pending.discord_id is not None and record.discord_id == pending.discord_id) or
+                         (wakatime_username is not None and record.wakatime_username == wakatime_username)))
+    __cache_records__([user])
+    return user
+
+
+def delete_expired_authentication_states():
+    """
+    Deletes the pending registrations that expired, a batch per statement so the table isn't locked for long
+
+    :return: How many were deleted
+    """
+    expired_before = datetime.utcnow() - timedelta(seconds=constant.AUTH_STATE_TTL)
+    expired = (AuthenticationState.created_at < expired_before) | (AuthenticationState.created_at >> None)
+    deleted = 0
+
+    db.connect(reuse_if_open=True)
+    try:
+        while True:
+            states = [row.state for row in AuthenticationState.select(AuthenticationState.state)
+                                                              .where(expired)
+                                                              .limit(constant.AUTH_STATE_SWEEP_BATCH)]
+            if not states:
+                break
+
+            deleted += AuthenticationState.delete().where(AuthenticationState.state.in_(states) & expired).execute()
+            if len(states) < constant.AUTH_STATE_SWEEP_BATCH:
+                break
+    finally:
+        db.close()
+
+    return deleted
+
+
+def delete_daily_summaries_before(before):
+    """
+    Deletes the daily summaries and their languages of the days before a date, the days of a batch of accounts
+    per statement so the tables aren't locked for long
+
+    :param before: The first day to keep, as a date
+    :return: How many daily summaries were deleted
+    """
+    deleted = 0
+
+    db.connect(reuse_if_open=True)
+    try:
+        while True:
+            accounts = [row.account for row in DailySummary.select(DailySummary.account)
+                                                           .where(DailySummary.day < before)
+                                                           .distinct()
+                                                           .limit(constant.DAILY_SUMMARY_SWEEP_BATCH)]
+            if not accounts:
+                break
+
+            with db.atomic():
+                DailyLanguage.delete().where(DailyLanguage.account.in_(accounts) &
+                                             (DailyLanguage.day < before)).execute()
+                deleted += DailySummary.delete().where(DailySummary.account.in_(accounts) &
+                                                       (DailySummary.day < before)).execute()
+            if len(accounts) < constant.DAILY_SUMMARY_SWEEP_BATCH:
+                break
+    finally:
+        db.close()
+
+    return deleted
+
+
+def reload_user_data(registrations):
+    """
+    Selects registrations again, skipping the record cache. Used when another bot process may have
+    changed them, like after losing a token refresh race
+
+    :param registrations: List of (discord_username, server_id) tuples
+    :return: A dictionary of (discord_username, server_id) to WakaData object, for the ones that still exist
+    """
+    if not registrations:
+        return {}
+
+    wanted = set((str(name), int(server_id)) for name, server_id in registrations)
+    db.connect(reuse_if_open=True)
+    try:
+        rows = list(WakaData.select().where(WakaData.discord_username.in_([name for name, _ in wanted]) &
+                                            WakaData.server_id.in_([server_id for _, server_id in wanted])))
+    finally:
+        db.close()
+
+    rows = [row for row in rows if (row.discord_username, int(row.server_id)) in wanted]
+    __cache_records__(rows)
+    return {(row.discord_username, int(row.server_id)): row for row in rows}
+
+#migrate_schema()
 #__debug_log_all_data__()
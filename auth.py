@@ -1,14 +1,176 @@
 import asyncio
+import multiprocessing
 import os
 import aiohttp
-import requests
 import time
 import hashlib
+import functools
+import random
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 from rauth import OAuth2Service
 from rauth import *
 from dotenv import load_dotenv
 import DbModel
+import constant
+import data_parser
+import command_scheduler
+import metrics
+from cache import TTLCache, SnapshotStore, SingleFlight, ResponseCache
+
+
+class RequestFailed(Exception):
+    """
+    Raised by RequestScheduler when a request still failed after every retry or ran out of time
+    """
+    pass
+
+
+class RequestScheduler:
+    """
+    Every async request to wakatime goes through here.
+    Caps how many requests are in flight in total and per host, spaces requests out with a token bucket,
+    and retries failed requests with a jittered exponential backoff that honours Retry-After.
+    Requests of interactive commands get through every limit before those of heavy and background jobs.
+    """
+    # Status codes that mean the request wasn't processed and can safely be sent again
+    RETRY_STATUSES = {429, 503}
+    # Status codes worth retrying only if sending the request twice is harmless
+    IDEMPOTENT_RETRY_STATUSES = {500, 502, 504}
+
+    def __init__(self, max_concurrency, max_concurrency_per_host, rate, burst, max_retries,
+                 backoff_base, backoff_max, attempt_timeout, deadline):
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.rate = rate  # Requests per second refilled into the bucket
+        self.burst = burst  # Size of the bucket
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.attempt_timeout = attempt_timeout  # Seconds a single attempt may take
+        self.deadline = deadline  # Seconds a request may take including every retry
+
+        # Requests wait for every limit with the priority of the command that sent them,
+        # so a !stats doesn't queue up behind the hundreds of requests of a !top
+        self.__global_limit__ = command_scheduler.PriorityLimiter(max_concurrency)
+        self.__host_limits__ = {}
+
+        self.__tokens__ = burst
+        self.__last_refill__ = time.monotonic()
+        self.__bucket_lock__ = command_scheduler.PriorityLimiter(1)
+
+    def __host_limit__(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.__host_limits__:
+            self.__host_limits__[host] = command_scheduler.PriorityLimiter(self.max_concurrency_per_host)
+        return self.__host_limits__[host]
+
+    async def __take_token__(self, level):
+        """
+        Waits until the token bucket allows another request to be sent
+        """
+        async with self.__bucket_lock__.hold(level):
+            while True:
+                now = time.monotonic()
+                self.__tokens__ = min(self.burst, self.__tokens__ + (now - self.__last_refill__) * self.rate)
+                self.__last_refill__ = now
+
+                if self.__tokens__ >= 1:
+                    self.__tokens__ -= 1
+                    return
+
+                await asyncio.sleep((1 - self.__tokens__) / self.rate)
+
+    def __backoff__(self, attempt, retry_after=None):
+        """
+        Works out how long to wait before the next attempt
+        :param attempt: The attempt that just failed, starting at 0
+        :param retry_after: The value of the Retry-After header if the server sent one
+        :return: Seconds to wait
+        """
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    # Retry-After can also be an HTTP date
+                    retry_at = parsedate_to_datetime(retry_after)
+                    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+
+        # Full jitter so a burst of failures doesn't retry all at once
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def request(self, session, method, url, idempotent=True, **kwargs):
+        """
+        Sends a request, retrying it if it fails
+
+        :param session: The aio.http client session
+        :param method: The HTTP method, e.g. 'GET'
+        :param url: The URL to send the request to
+        :param idempotent: OPTIONAL parameter. Set to False if sending the request twice could do harm (like using up a
+                           refresh token). Then only requests the server explicitly didn't process get retried.
+        :return: A tuple of the response status, the response body as text and the response headers
+        """
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self.deadline
+        reason = None
+        level = command_scheduler.priority.get()
+        # Work several tasks wait for waits with the priority of the most urgent of them
+        shared = command_scheduler.shared_priority.get()
+
+        for attempt in range(self.max_retries + 1):
+            remaining = give_up_at - loop.time()
+            if remaining <= 0:
+                break
+
+            retry_after = None
+            endpoint = urlsplit(url).path
+            try:
+                queued = time.perf_counter()
+                waits_with = shared or level
+                await asyncio.wait_for(self.__take_token__(waits_with), remaining)
+                async with self.__global_limit__.hold(waits_with), self.__host_limit__(url).hold(waits_with):
+                    waited_with = shared.level if shared is not None else level
+                    metrics.observe('http_queue_wait_seconds', time.perf_counter() - queued,
+                                    priority=command_scheduler.PRIORITY_NAMES[waited_with])
+                    timeout = aiohttp.ClientTimeout(total=min(self.attempt_timeout, give_up_at - loop.time()))
+                    started = time.perf_counter()
+                    async with session.request(method, url, timeout=timeout, **kwargs) as response:
+                        text = await response.text()
+                        metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                                        endpoint=endpoint)
+                        metrics.inc('http_responses_total', endpoint=endpoint, status=str(response.status))
+
+                        retry_statuses = self.RETRY_STATUSES
+                        if idempotent:
+                            retry_statuses = retry_statuses | self.IDEMPOTENT_RETRY_STATUSES
+
+                        if response.status not in retry_statuses:
+                            return response.status, text, response.headers
+
+                        reason = 'HTTP {}'.format(response.status)
+                        retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                reason = repr(e)
+                metrics.inc('http_responses_total', endpoint=endpoint, status='error')
+                # A timed out request may have reached the server
+                if not idempotent:
+                    break
+
+            if attempt == self.max_retries:
+                break
+
+            delay = self.__backoff__(attempt, retry_after)
+            if loop.time() + delay >= give_up_at:
+                break
+            await asyncio.sleep(delay)
+
+        raise RequestFailed('{} {} failed: {}'.format(method, url, reason or 'deadline exceeded'))
 
 
 class Authorizer:
@@ -17,25 +179,119 @@ class Authorizer:
         self.APP_ID = os.getenv('WAKA_APP_ID')
         self.APP_SECRET = os.getenv('WAKA_APP_SECRET')
 
-        self.redirect_uri = 'https://immewtable.com/authenticate'
+        # Where wakatime sends users after they allowed access. It has to reach the bot's web server,
+        # usually through a reverse proxy, which serves the OAuth callback on the same path
+        self.redirect_uri = os.getenv('OAUTH_REDIRECT_URI', 'https://immewtable.com/authenticate')
 
-        self.base_url = 'https://wakatime.com/api/v1/'
+        # Can be pointed at a stand-in like scripts/fake_wakatime.py to run without the real API
+        self.site_url = os.getenv('WAKA_SITE_URL', 'https://wakatime.com').rstrip('/')
+        self.base_url = self.site_url + '/api/v1/'
+        self.token_url = self.site_url + '/oauth/token'
 
         self.service = OAuth2Service(
             client_id=self.APP_ID,  # from https://wakatime.com/apps
             client_secret=self.APP_SECRET,  # from https://wakatime.com/apps
             name='wakatime',
-            authorize_url='https://wakatime.com/oauth/authorize',
-            access_token_url='https://wakatime.com/oauth/token',
-            base_url='https://wakatime.com/api/v1/')
+            authorize_url=self.site_url + '/oauth/authorize',
+            access_token_url=self.token_url,
+            base_url=self.base_url)
+
+        # Ranked leaderboards keyed by (server_id, time_range)
+        self.leaderboard_cache = TTLCache(constant.LEADERBOARD_CACHE_SIZE, constant.LEADERBOARD_CACHE_DEFAULT_TTL)
+        # Leaderboards precomputed in the background, also keyed by (server_id, time_range)
+        self.snapshots = SnapshotStore()
+        # Data of a single wakatime account keyed by (account, time_range). Shared between every server the
+        # account is registered in
+        self.account_results = TTLCache(constant.ACCOUNT_CACHE_SIZE, constant.LEADERBOARD_CACHE_DEFAULT_TTL)
+
+        # Identical requests that are already running get coalesced instead of being started again
+        self.leaderboard_flights = SingleFlight('leaderboard')  # keyed by (server_id, time_range[, kind])
+        self.stats_flights = SingleFlight('stats')  # keyed by (discord id or username, server_id, time_range)
+        self.refresh_flights = SingleFlight('token_refresh')  # keyed by the refresh token being used up
+        self.__refresh_priorities__ = {}  # refresh token -> command_scheduler.SharedPriority of its refresh in flight
+
+        # Responses of wakatime GET requests, kept on disk so unchanged data can be revalidated instead of downloaded
+        cache_size = int(os.getenv('HTTP_CACHE_MAX_BYTES', constant.HTTP_CACHE_MAX_BYTES))
+        self.response_cache = ResponseCache(os.getenv('HTTP_CACHE_DIR', constant.HTTP_CACHE_DIR),
+                                            cache_size) if cache_size > 0 else None
+
+        # Shared HTTP session for every async request to wakatime. Opened with open_session()
+        self.session = None
+        # Processes that parse big responses, also started by open_session()
+        self.worker_count = int(os.getenv('FETCH_WORKERS', constant.FETCH_WORKERS))
+        self.workers = None
+        self.scheduler = RequestScheduler(max_concurrency=constant.HTTP_MAX_CONCURRENCY,
+                                          max_concurrency_per_host=constant.HTTP_MAX_CONCURRENCY_PER_HOST,
+                                          rate=constant.HTTP_RATE_LIMIT,
+                                          burst=constant.HTTP_RATE_BURST,
+                                          max_retries=constant.HTTP_MAX_RETRIES,
+                                          backoff_base=constant.HTTP_BACKOFF_BASE,
+                                          backoff_max=constant.HTTP_BACKOFF_MAX,
+                                          attempt_timeout=constant.HTTP_REQUEST_TIMEOUT,
+                                          deadline=constant.HTTP_REQUEST_DEADLINE)
+
+    async def open_session(self):
+        """
+        Opens the pooled HTTP session that is shared by every async request for the bot's lifetime,
+        and the fetch worker processes. Does nothing if the session is already open.
+        :return: Nothing
+        """
+        if self.workers is None and self.worker_count > 0:
+            self.__start_workers__()
+
+        if self.session is not None and not self.session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(limit=constant.HTTP_POOL_SIZE,
+                                         limit_per_host=constant.HTTP_POOL_SIZE_PER_HOST,
+                                         ttl_dns_cache=constant.HTTP_DNS_CACHE_TTL,
+                                         keepalive_timeout=constant.HTTP_KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close_session(self):
+        """
+        Closes the shared HTTP session and all of its pooled connections
+        :return: Nothing
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+        if self.workers is not None:
+            workers, self.workers = self.workers, None
+            await asyncio.get_running_loop().run_in_executor(None, workers.shutdown)
+
+    def __start_workers__(self):
+        # Spawned instead of forked, forking a process with a running event loop and DB pool isn't safe
+        self.workers = ProcessPoolExecutor(max_workers=self.worker_count, mp_context=multiprocessing.get_context('spawn'))
 
-    def get_user_authorization_url(self, discord_username, server_id):
+    async def __get_session__(self):
+        """
+        Gets the shared HTTP session, opening it first if the bot hasn't done so yet
+        :return: The aio.http client session
+        """
+        await self.open_session()
+        return self.session
+
+    def invalidate_server_leaderboards(self, server_id):
+        """
+        Drops every cached leaderboard of a server. Should be called whenever the
+        set of registered users in the server changes.
+
+        :param server_id: The server id whose leaderboards are outdated
+        :return: Nothing
+        """
+        self.leaderboard_cache.invalidate_where(lambda key: key[0] == server_id)
+        self.snapshots.discard_where(lambda key: key[0] == server_id)
+
+    async def get_user_authorization_url(self, discord_username, server_id, discord_id=None):
         """
         Generates an authorization URL for the user to begin the authentication process.
         Also calls the initialization function for the user using the state generated for
         the url.
         :param discord_username: The user's discord username who will receive the URL
         :param server_id: The server id that the user started to register with
+        :param discord_id: OPTIONAL parameter. The user's discord id
         :return: the URL as a string that the user will use to register with wakabot
         """
         state = hashlib.sha1(os.urandom(40)).hexdigest()
@@ -46,10 +302,51 @@ class Authorizer:
 
         url = self.service.get_authorize_url(**params)
 
-        DbModel.initialize_user_data(discord_username, server_id, state)
+        await DbModel.run_async(DbModel.initialize_user_data, discord_username, server_id, state, discord_id)
+        self.invalidate_server_leaderboards(server_id)
 
         return url
 
+    async def complete_registration(self, state, code):
+        """
+        Finishes a registration once wakatime sent the user back to the OAuth callback.
+        Exchanges the authorization code for tokens and stores them for the pending registration of state
+
+        :param state: The state the registration was started with, see get_user_authorization_url
+        :param code: The authorization code wakatime sent along
+        :return: The WakaData object of the registration, or None if there is no pending registration
+                 with that state (it expired or was already completed)
+        :raises RequestFailed: If wakatime didn't hand out tokens for the code
+        """
+        pending = await DbModel.run_async(DbModel.claim_authentication_state, state)
+        if pending is None:
+            metrics.inc('registrations_total', outcome='unknown_state')
+            return None
+
+        body = {'client_id': self.APP_ID,
+                'client_secret': self.APP_SECRET,
+                'redirect_uri': self.redirect_uri,
+                'grant_type': 'authorization_code',
+                'code': code}
+        headers = {'Accept': 'application/x-www-form-urlencoded'}
+        session = await self.__get_session__()
+        # Codes can only be used once, like refresh tokens
+        status, text, _ = await self.scheduler.request(session, 'POST', self.token_url,
+                                                       idempotent=False, data=body, headers=headers)
+        token_response = self.__parse_raw_response__(text)
+        if 'access_token' not in token_response:
+            metrics.inc('registrations_total', outcome='refused')
+            raise RequestFailed('Exchanging the code of {} failed: HTTP {}'.format(pending.discord_username, status))
+
+        user = await DbModel.run_async(DbModel.complete_registration, pending,
+                                       token_response['access_token'],
+                                       token_response.get('refresh_token'),
+                                       self.__token_expiry__(token_response),
+                                       token_response.get('uid'))
+        metrics.inc('registrations_total', outcome='completed')
+        self.invalidate_server_leaderboards(user.server_id)
+        return user
+
     def __parse_raw_response__(self, response_text):
         """
         Turns raw response object into dictionary for easy parsing
@@ -62,114 +359,269 @@ class Authorizer:
         parsed_response = {}
         for entry in response_objects:
             # split at = to get proper key/value
-            kv = entry.split('=')
+            kv = entry.split('=', 1)
+            # Error responses aren't key/value pairs, skip anything that isn't
+            if len(kv) != 2:
+                continue
             parsed_response[kv[0]] = kv[1]
 
         return parsed_response
 
-    def refresh_tokens(self, discord_username, server_id, old_refresh_token):
+    def __token_expiry__(self, token_response):
         """
-        Refreshes a user's access token and refresh tokens
-        :param discord_username: The discord username to refresh
-        :param server_id: The server id to refresh
-        :param old_refresh_token: The old refresh token that will be used to refresh the existing tokens
-        :return: nothing
+        Works out when a freshly issued access token expires
+        :param token_response: The parsed token response
+        :return: The UTC datetime the token expires at, None if the response didn't say
         """
-        headers = {'Accept': 'application/x-www-form-urlencoded'}
-        data = {'grant_type': 'refresh_token',
+        try:
+            return datetime.utcnow() + timedelta(seconds=int(token_response['expires_in']))
+        except (KeyError, ValueError):
+            return None
+
+    def token_needs_refresh(self, expires_at):
+        """
+        Checks if an access token is expired or about to expire
+        :param expires_at: The UTC datetime the token expires at. None if it is unknown
+        :return: True if the token should be refreshed before using it
+        """
+        # Tokens stored before we tracked expiry have to be refreshed once to find out
+        if expires_at is None:
+            return True
+
+        return expires_at - datetime.utcnow() <= timedelta(seconds=constant.TOKEN_REFRESH_WINDOW)
+
+    def __refresh_body__(self, old_refresh_token):
+        """
+        Generates the body of a refresh token request
+        :param old_refresh_token: The refresh token that will be exchanged for new tokens
+        :return: The body data as a dictionary
+        """
+        return {'client_id': self.APP_ID,
+                'client_secret': self.APP_SECRET,
+                'redirect_uri': self.redirect_uri,
+                'grant_type': 'refresh_token',
                 'refresh_token': old_refresh_token}
-        response = self.__parse_raw_response__(self.service.get_raw_access_token(headers=headers, data=data).text)
-        new_refresh_token = response['refresh_token']
-        new_access_token = response['access_token']
-        DbModel.update_user_tokens(discord_username, server_id, new_access_token, new_refresh_token)
 
-    def get_wakatime_user_json(self, discord_username, server_id, time_range):
+    async def async_get_wakatime_user_json(self, discord_username, server_id, time_range, discord_id=None):
         """
-        Authenticates and gets the discord users in server id's data.
-        Returns as json if found, returns None if not found or authentication failed
+        Asynchronously authenticates and gets the discord users in server id's data.
+        Returns a data_parser.UserSummary if found, returns None if the user isn't registered
 
         :param discord_username: The discord username as a string whose data to retrieve
         :param server_id: the server id the username is in
         :param time_range: The time range to retrieve. must either be nothing, 'last_7_days', 'last_30_days', 'last_6_months', or 'last_year'
-        :return: Json response of a user's data if it worked, None if it didnt
+        :param discord_id: OPTIONAL parameter. The user's discord id, finds the user even if they were renamed
+        :return: UserSummary of the user's data, with its error set if retrieving it failed. None if not registered
         """
-        old_refresh_token = DbModel.get_user_refresh_token(discord_username, server_id)
-
-        # Refresh token prior to accessing API so its always up to date
-        self.refresh_tokens(discord_username, server_id, old_refresh_token)
-        access_token = DbModel.get_user_access_token(discord_username, server_id)
-
-        # Use authorization header
-        headers = {'Accept': 'application/x-www-form-urlencoded',
-                   'Authorization': 'Bearer {}'.format(access_token)}
+        return await self.stats_flights.run((discord_id or discord_username, server_id, time_range),
+                                            self.__get_wakatime_user_json__, discord_username, server_id, time_range,
+                                            discord_id)
 
-        # Need different URL for all-time stats
-        if time_range == 'all_time_since_today':
-            url_args = 'users/current/all_time_since_today'
-        else:
-            url_args = 'users/current/summaries?range='
-            url_args = url_args + time_range
-
-        # Use get request using authorization header
-        response = requests.get(self.base_url + url_args, headers=headers)
-        if response.status_code == 200:
-            return response.json()
+    async def __get_wakatime_user_json__(self, discord_username, server_id, time_range, discord_id=None):
+        """
+        Does the work of async_get_wakatime_user_json, which makes sure it only runs once at a time per user
+        """
+        user = await DbModel.run_async(DbModel.get_discord_user_data, discord_username, server_id, discord_id)
+        if user is None:
+            return None
 
-        return None
+        user_data = await self.async_get_users_json([user], time_range)
+        return user_data[0][1]
 
-    async def __refresh_all_server_tokens__(self, server_id):
+    async def __limited__(self, limit, coroutine):
         """
-        Executes a refresh of all the tokens under server_id.
-        Should be used in conjunction with async scoreboard retrieval
-
-        :param server_id: the id of the server whose tokens to refresh
-        :return: Nothing
+        Runs a coroutine while holding a limit, so a caller can cap its own share of the requests
+        :param limit: An asyncio.Semaphore, or None to run the coroutine without a limit
+        :param coroutine: The coroutine to run
+        :return: Whatever the coroutine returns
         """
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as token_session:
-            tasks = []
-            headers = {'Accept': 'application/x-www-form-urlencoded'}
+        if limit is None:
+            return await coroutine
 
-            users = DbModel.get_authenticated_discord_users(server_id, as_is=True)
+        async with limit:
+            return await coroutine
 
-            for user in users:
-                # Generate body data
-                data = {'client_id': self.APP_ID,
-                        'client_secret': self.APP_SECRET,
-                        'redirect_uri': self.redirect_uri,
-                        'grant_type': 'refresh_token',
-                        'refresh_token': user.refresh_token}
-
-                # Call ensure_future to basically "queue up" all the function calls
-                tasks.append(asyncio.ensure_future(self.__refresh_single_token__(headers, data,
-                                                                                 user.refresh_token, token_session)))
+    async def __refresh_user_tokens__(self, users, limit=None):
+        """
+        Executes a refresh of the tokens of users that are expired or about to expire.
+        The WakaData objects are updated in place with the new tokens, and the database in one go.
 
-            # This actually executes all the async tasks
-            token_responses = await asyncio.gather(*tasks)
-            for response in token_responses:
-                http_response = response[0]  # Actual token response
-                old_refresh_token = response[1]  # Old refresh token
+        :param users: List of WakaData objects whose tokens to refresh
+        :param limit: OPTIONAL parameter. asyncio.Semaphore that caps how many of the requests run at once
+        :return: A list of (WakaData object, True if wakatime refused the refresh token) tuples
+                 of the users whose tokens couldn't be refreshed
+        """
+        token_session = await self.__get_session__()
+        tasks = []
+        refreshing = []
+        headers = {'Accept': 'application/x-www-form-urlencoded'}
 
-                # Refresh token data.
-                DbModel.update_tokens_from_old_refresh_token(old_refresh_token,
-                                                             http_response['refresh_token'],
-                                                             http_response['access_token'])
+        for user in users:
+            # Tokens that are still good can go straight to the data fetch
+            if not self.token_needs_refresh(user.expires_at):
+                continue
+
+            # Call ensure_future to basically "queue up" all the function calls
+            data = self.__refresh_body__(user.refresh_token)
+            tasks.append(asyncio.ensure_future(self.__limited__(limit,
+                                                                self.__refresh_token__(headers, data,
+                                                                                       user.refresh_token,
+                                                                                       token_session))))
+            refreshing.append(user)
+
+        # This actually executes all the async tasks
+        token_responses = await asyncio.gather(*tasks)
+        token_updates = []
+        swapping = []  # The user of every token update
+        account_updates = []
+        failed = []
+        for user, response in zip(refreshing, token_responses):
+            http_response = response[0]  # Actual token response
+            old_refresh_token = response[1]  # Old refresh token
+            status = response[2]  # Status of the token response, None if there was none
+
+            # Either the token was revoked, or another bot process used it up first
+            if 'access_token' not in http_response:
+                failed.append((user, old_refresh_token, status))
+                continue
+
+            user.auth_token = http_response['access_token']
+            user.refresh_token = http_response['refresh_token']
+            user.expires_at = self.__token_expiry__(http_response)
+            token_updates.append((old_refresh_token, user.refresh_token, user.auth_token, user.expires_at))
+            swapping.append(user)
+
+            # Token responses tell us which wakatime account the tokens belong to
+            if user.wakatime_username is None and http_response.get('uid'):
+                user.wakatime_username = http_response['uid']
+                account_updates.append((user.discord_username, user.server_id, user.wakatime_username))
+
+        # Refresh token data. Failed refreshes were skipped above so the successful ones still get written
+        with metrics.span('db_write'):
+            written = await DbModel.run_async(DbModel.update_tokens_bulk, token_updates)
+            await DbModel.run_async(DbModel.update_wakatime_usernames, account_updates)
+
+        # Another process swapped the row first, its tokens are the ones in the database now
+        for user, (old_refresh_token, new_refresh_token, _, _) in zip(swapping, token_updates):
+            if new_refresh_token not in written:
+                failed.append((user, old_refresh_token, None))
+
+        if not failed:
+            return []
+        return await self.__adopt_stored_tokens__(failed)
+
+    async def __adopt_stored_tokens__(self, failed):
+        """
+        Handles refreshes that failed or lost a race against another bot process. If the stored row
+        has moved on to a token that is still good, the other process won and its tokens get used.
+        Otherwise the token is revoked or broken, and the user won't show up on the leaderboard anymore.
+
+        :param failed: List of (WakaData object, the refresh token that was used, status of the token response
+                       or None) tuples
+        :return: A list of (WakaData object, True if wakatime refused the refresh token) tuples of the users
+                 whose tokens couldn't be refreshed or adopted
+        """
+        stored = await DbModel.run_async(DbModel.reload_user_data,
+                                         [(user.discord_username, user.server_id) for user, _, _ in failed])
+
+        given_up = []
+        for user, old_refresh_token, status in failed:
+            row = stored.get((user.discord_username, int(user.server_id)))
+            if row is not None and row.refresh_token != old_refresh_token and row.auth_token is not None \
+                    and not self.token_needs_refresh(row.expires_at):
+                metrics.inc('token_refresh_failures_total', outcome='adopted')
+                user.auth_token = row.auth_token
+                user.refresh_token = row.refresh_token
+                user.expires_at = row.expires_at
+                user.wakatime_username = user.wakatime_username or row.wakatime_username
+                continue
+
+            metrics.inc('token_refresh_failures_total', outcome='failed')
+            print("Could not refresh the token of {} in server {}".format(user.discord_username, user.server_id))
+            # Rate limits are the only client errors that don't say anything about the token
+            revoked = status is not None and 400 <= status < 500 and status != 429
+            if revoked:
+                # Leaderboards that still have the user's old data don't hold anymore. Timeouts and server errors
+                # don't change anything, the leaderboards run into the same failure on their own.
+                # Deactivations invalidate them in __record_outcomes__
+                self.invalidate_server_leaderboards(user.server_id)
+            given_up.append((user, revoked))
+
+        return given_up
+
+    async def __refresh_token__(self, header, body, old_refresh_token, session):
+        """
+        Subroutine to be used in __refresh_user_tokens__ to be called with ensure_future.
+        A refresh token can only be used once, so concurrent refreshes of the same one share the response.
+        The refresh waits with the priority of the most urgent caller, so a command that needs the token
+        doesn't wait behind a background refresh that asked for it first
 
-    async def __refresh_single_token__(self, header, body, old_refresh_token, session):
+        :return: See __refresh_single_token__
+        """
+        level = command_scheduler.priority.get()
+        shared = self.__refresh_priorities__.get(old_refresh_token)
+        if shared is not None:
+            shared.join(level)
+        elif not self.refresh_flights.running(old_refresh_token):
+            shared = command_scheduler.SharedPriority(level)
+            self.__refresh_priorities__[old_refresh_token] = shared
+
+        return await self.refresh_flights.run(old_refresh_token, self.__refresh_single_token__,
+                                              header, body, old_refresh_token, session, shared)
+
+    async def __refresh_single_token__(self, header, body, old_refresh_token, session, shared):
         """
-        Subroutine to be used in __refresh_all_server_tokens__ to be called with ensure_future
-        Asynchronously retrieves a single refresh token response
+        Asynchronously retrieves a single refresh token response. Runs in the task of its flight
 
         :param header: The header of the HTTP request
         :param body: The body or data of the HTTP request
         :param old_refresh_token: The old refresh token that was used to get a new refresh/access token
         :param session: The aio.http client session
-        :return: The token response from the token URL and the old refresh token as a tuple
+        :param shared: The command_scheduler.SharedPriority the request waits with
+        :return: The token response from the token URL, the old refresh token and the response status as a tuple.
+                 The token response is empty and the status None if the request failed or timed out
         """
-        async with session.post(url='https://wakatime.com/oauth/token', data=body, headers=header) as response:
-            token_response = self.__parse_raw_response__(await response.text())
-            return token_response, old_refresh_token
+        command_scheduler.shared_priority.set(shared)
+        try:
+            # Refreshing uses up the old refresh token, so don't resend requests that might have reached wakatime
+            status, text, _ = await self.scheduler.request(session, 'POST', self.token_url,
+                                                           idempotent=False, data=body, headers=header)
+            return self.__parse_raw_response__(text), old_refresh_token, status
+        except RequestFailed as e:
+            print("Token refresh request failed: {}".format(e))
+            return {}, old_refresh_token, None
+        finally:
+            self.__refresh_priorities__.pop(old_refresh_token, None)
+
+    async def __resolve_accounts__(self, users, limit=None):
+        """
+        Looks up which wakatime account the tokens of users belong to, for users where we don't know yet.
+        Only happens once per registration, afterwards the account id is stored in wakatime_username.
 
-    async def async_get_all_wakatime_users_json(self, server_id, time_range):
+        :param users: List of WakaData objects
+        :param limit: OPTIONAL parameter. asyncio.Semaphore that caps how many of the requests run at once
+        :return: Nothing
+        """
+        session = await self.__get_session__()
+        unknown = [user for user in users if user.wakatime_username is None]
+        tasks = []
+        for user in unknown:
+            header = {'Accept': 'application/x-www-form-urlencoded',
+                      'Authorization': 'Bearer {}'.format(user.auth_token)}
+            tasks.append(asyncio.ensure_future(self.__limited__(limit,
+                                                                self.__get_json__(header, session, 'users/current',
+                                                                                  user.discord_username))))
+
+        account_updates = []
+        for user, response in zip(unknown, await asyncio.gather(*tasks)):
+            account_id = response.get('data', {}).get('id')
+            if account_id:
+                user.wakatime_username = account_id
+                account_updates.append((user.discord_username, user.server_id, account_id))
+
+        await DbModel.run_async(DbModel.update_wakatime_usernames, account_updates)
+
+    async def async_get_all_wakatime_users_json(self, server_id, time_range, limit=None):
         """
         Asynchronously retrieves all of the registered users wakatime data.
         Also refreshes all the tokens of the users in server_id
@@ -177,54 +629,315 @@ class Authorizer:
 
         :param server_id: The id of the server whos data is to be retrieved
         :param time_range: The time range to retrieve. Must be nothing, 'last_7_days', 'last_30_days', 'last_6_months', or 'last_year'
-        :return: the json data of each wakatime user under the server_id
+        :param limit: OPTIONAL parameter. asyncio.Semaphore that caps how many of the requests run at once
+        :return: A (discord username, data_parser.UserSummary, discord id) tuple for each wakatime user under the server_id
         """
-        await self.__refresh_all_server_tokens__(server_id)
-        return await self.__async_get_wakatime_users_json__(server_id, time_range)
+        users = await DbModel.run_async(DbModel.get_authenticated_discord_users, server_id, as_is=True)
+        return await self.async_get_users_json(users, time_range, limit)
 
-    async def __async_get_wakatime_users_json__(self, server_id, time_range):
+    async def async_get_users_json(self, users, time_range, limit=None, aggregate=True):
         """
-        Asynchronously retrieves all of the registered users wakatime data
+        Asynchronously retrieves the wakatime data of users, refreshing their tokens first if needed.
+        Users can come from different servers. Every wakatime account is only refreshed and fetched once,
+        and its data is shared with every registration of that account for a little while.
 
-        :param server_id: The server id from which to retrieve the data
+        :param users: List of WakaData objects whose data to retrieve
         :param time_range: The time range to retrieve. Must be nothing, 'last_7_days', 'last_30_days', 'last_6_months', or 'last_year'
-        :return: A list of tuples. 0 index contains the discord username, 1 index contains the json data
-        """
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-            tasks = []
-            users = DbModel.get_authenticated_discord_users(server_id, as_is=True)
-            for user in users:
-                # Generate authentication header
-                header = {'Accept': 'application/x-www-form-urlencoded',
-                          'Authorization': 'Bearer {}'.format(user.auth_token)}
-                # Call ensure_future to basically "queue up" all the function calls
-                tasks.append(asyncio.ensure_future(self.__retrieve_single_wakatime_user_json__(header,
-                                                                                               session,
-                                                                                               time_range,
-                                                                                               user.discord_username)))
-            # Execute all queued up tasks
-            data_responses = await asyncio.gather(*tasks)
-            return data_responses
-
-    async def __retrieve_single_wakatime_user_json__(self, header, session, time_range, discord_username):
-        """
-        Subroutine that retrieves a single user's json data from the wakatime API asynchronously
+        :param limit: OPTIONAL parameter. asyncio.Semaphore that caps how many of the requests run at once
+        :param aggregate: OPTIONAL parameter. If False, ranges made up of whole days only get their daily summaries
+                          stored, and the UserSummary of an account that was synced is left empty.
+                          For callers that sum up the stored days in the database
+        :return: A list of tuples. 0 index contains the discord username, 1 index contains a data_parser.UserSummary,
+                 2 index contains the discord id, or None if it isn't known yet.
+                 Users whose data couldn't be retrieved get a UserSummary with its error set
+        """
+        # Group registrations by account. Accounts fetched recently don't need anything at all,
+        # and registrations that failed recently are left alone until their backoff is over
+        now = datetime.utcnow()
+        keys = [DbModel.account_key(user) for user in users]
+        results = {}
+        representatives = {}
+        for user, key in zip(users, keys):
+            cached = self.account_results.get((key, time_range))
+            if cached is not None:
+                results[key] = cached
+            elif user.next_attempt_at is not None and user.next_attempt_at > now:
+                metrics.inc('registrations_skipped_total')
+            elif key not in representatives:
+                representatives[key] = user
+
+        guild_size = metrics.size_bucket(len(users))
+        with metrics.span('token_refresh', guild_size=guild_size):
+            given_up = dict(await self.__refresh_user_tokens__(list(representatives.values()), limit))
+        # Tokens wakatime refused won't get any data either
+        usable = [user for user in representatives.values() if not given_up.get(user)]
+        with metrics.span('account_resolve', guild_size=guild_size):
+            await self.__resolve_accounts__(usable, limit)
+
+        # Now that more accounts are known, registrations that turned out to be the same account are fetched once,
+        # or not at all if the account was fetched recently through another registration
+        fetched = {}
+        fetches = {}
+        for user in usable:
+            account = DbModel.account_key(user)
+            cached = self.account_results.get((account, time_range))
+            if cached is not None:
+                fetched[account] = cached
+            else:
+                fetches.setdefault(account, user)
+
+        session = await self.__get_session__()
+        tasks = []
+        for account, user in fetches.items():
+            # Generate authentication header
+            header = {'Accept': 'application/x-www-form-urlencoded',
+                      'Authorization': 'Bearer {}'.format(user.auth_token)}
+            # Call ensure_future to basically "queue up" all the function calls
+            tasks.append(asyncio.ensure_future(self.__limited__(limit,
+                                                                self.__retrieve_account_summary__(
+                                                                    account,
+                                                                    header,
+                                                                    session,
+                                                                    time_range,
+                                                                    user,
+                                                                    aggregate))))
+
+        # Handle every response as soon as it arrives. Each one has already been cut down to a small UserSummary
+        ttl = constant.LEADERBOARD_CACHE_TTL.get(time_range, constant.LEADERBOARD_CACHE_DEFAULT_TTL)
+        with metrics.span('data_fetch', guild_size=guild_size):
+            for task in asyncio.as_completed(tasks):
+                account, (_, summary) = await task
+                fetched[account] = summary
+                # Empty summaries of a sync that wasn't summed up aren't answers to anything
+                if summary.error is None and aggregate:
+                    self.account_results.set((account, time_range), summary, ttl)
+
+        outcomes = []
+        for key, user in representatives.items():
+            if given_up.get(user):
+                results[key] = data_parser.UserSummary(error='The refresh token was refused')
+                outcomes.append((user, results[key], True))
+            else:
+                results[key] = fetched[DbModel.account_key(user)]
+                outcomes.append((user, results[key], results[key].status in constant.REFUSED_STATUSES))
+        await self.__record_outcomes__(outcomes)
+
+        skipped = data_parser.UserSummary(error='Skipped after failing too often, retrying later', skipped=True)
+        return [(user.discord_username, results.get(key, skipped), user.discord_id) for user, key in zip(users, keys)]
+
+    async def __record_outcomes__(self, outcomes):
+        """
+        Keeps track of the registrations that keep failing. Every failure in a row doubles how long a registration
+        is skipped for. Registrations whose tokens wakatime kept refusing are deactivated until the user registers
+        again, so they stop costing requests on every leaderboard
+
+        :param outcomes: List of (WakaData object, its data_parser.UserSummary, True if wakatime refused its tokens)
+                         tuples of the registrations that were refreshed and fetched
+        :return: Nothing
+        """
+        now = datetime.utcnow()
+        recovered = []
+        failures = []
+        for user, summary, refused in outcomes:
+            if summary.error is None:
+                if user.failure_count:
+                    user.failure_count = 0
+                    user.next_attempt_at = None
+                    recovered.append((user.discord_username, user.server_id))
+                continue
+
+            user.failure_count += 1
+            backoff = min(constant.FAILURE_BACKOFF_MAX, constant.FAILURE_BACKOFF_BASE * 2 ** (user.failure_count - 1))
+            user.next_attempt_at = now + timedelta(seconds=backoff)
+            if refused and user.failure_count >= constant.QUARANTINE_AFTER:
+                user.active = False
+                metrics.inc('registration_failures_total', outcome='deactivated')
+                print("Deactivated {} in server {} after {} failures".format(user.discord_username, user.server_id,
+                                                                            user.failure_count))
+                self.invalidate_server_leaderboards(user.server_id)
+            else:
+                metrics.inc('registration_failures_total', outcome='backoff')
+            failures.append((user.discord_username, user.server_id, user.failure_count, user.next_attempt_at,
+                             user.active))
+
+        if recovered or failures:
+            await DbModel.run_async(DbModel.record_registration_outcomes, recovered, failures)
+
+    async def __retrieve_account_summary__(self, account, header, session, time_range, user, aggregate=True):
+        """
+        Same as __retrieve_single_wakatime_user_json__, but also returns which account the data belongs to
+        so results can be matched up while they come in out of order
+        """
+        return account, await self.__retrieve_single_wakatime_user_json__(header, session, time_range, user,
+                                                                          aggregate)
+
+    async def __retrieve_single_wakatime_user_json__(self, header, session, time_range, user, aggregate=True):
+        """
+        Subroutine that retrieves a single user's json data from the wakatime API asynchronously.
+        Ranges made up of whole days are answered from the stored daily summaries, only the days
+        that are missing or can still change get requested.
 
         :param header: The authorization header required to get the user's data
         :param session: The aio.http client session
         :param time_range: The time range for data retrieval. Must be nothing, 'last_7_days', 'last_30_days', 'last_6_months', or 'last_year'
-        :param discord_username: The discord username that the data is associated with
-        :return: A tuple of the discord username and that usernames json data from the wakatime API
+        :param user: The WakaData object of the user whose data to retrieve
+        :param aggregate: OPTIONAL parameter. If False, ranges made up of whole days are only synced,
+                          see __sync_daily_summaries__
+        :return: A tuple of the discord username and a data_parser.UserSummary of that usernames data
         """
-        if time_range == 'all_time_since_today':
-            url_args = 'users/current/all_time_since_today'
+        today = date.today()
+        windows = data_parser.range_windows(constant.DAY_RANGES, today)
+
+        if time_range in windows:
+            # Fetch the window that covers every range people usually ask for next, not just this one
+            start = min(windows[r][0] for r in constant.COVERING_RANGES + [time_range])
+            # Every range inside the window gets answered, and the ones that weren't asked for are cached
+            covered = {r: window for r, window in windows.items() if window[0] >= start}
+            summaries = await self.__sync_daily_summaries__(header, session, user, covered, today, aggregate)
+
+            summary = summaries[time_range]
+            account = DbModel.account_key(user)
+            for r, other in summaries.items():
+                if r != time_range and other.error is None and aggregate:
+                    ttl = constant.LEADERBOARD_CACHE_TTL.get(r, constant.LEADERBOARD_CACHE_DEFAULT_TTL)
+                    self.account_results.set((account, r), other, ttl)
+        elif time_range == 'all_time_since_today':
+            summary = await self.__get_json__(header, session, 'users/current/all_time_since_today',
+                                              user.discord_username,
+                                              functools.partial(data_parser.summary_from_json, r=time_range),
+                                              DbModel.account_key(user))
+        else:
+            summary = await self.__get_json__(header, session, 'users/current/summaries?range=' + time_range,
+                                              user.discord_username,
+                                              functools.partial(data_parser.summary_from_json, r=time_range),
+                                              DbModel.account_key(user))
+
+        return user.discord_username, summary
+
+    async def __sync_daily_summaries__(self, header, session, user, windows, today, aggregate=True):
+        """
+        Brings a user's stored daily summaries up to date for every range in windows with a single request,
+        then sums them up for each of those ranges
+
+        :param header: The authorization header required to get the user's data
+        :param session: The aio.http client session
+        :param user: The WakaData object of the user
+        :param windows: Dictionary of range -> (first day, last day) of the ranges to answer
+        :param today: Today's date
+        :param aggregate: OPTIONAL parameter. If False the days are only brought up to date, not loaded or summed up,
+                          and every range gets an empty UserSummary
+        :return: Dictionary of range -> data_parser.UserSummary. They all have their error set if it couldn't be synced
+        """
+        start = min(window[0] for window in windows.values())
+        end = max(window[1] for window in windows.values())
+        account = DbModel.account_key(user)
+        if aggregate:
+            days = await DbModel.run_async(DbModel.get_daily_summaries, account, start, end)
+            stored_days = set(day['day'] for day in days)
+        else:
+            days = []
+            stored_days = await DbModel.run_async(DbModel.get_stored_days, account, start, end)
+        missing = data_parser.days_to_fetch(stored_days, start, end, today)
+
+        if missing:
+            # One request for everything from the first missing day, it's cheaper than a request per gap
+            url_args = 'users/current/summaries?start={}&end={}'.format(missing[0].isoformat(), end.isoformat())
+            data = await self.__get_json__(header, session, url_args, user.discord_username,
+                                           data_parser.project_summaries, account)
+            if 'error' in data:
+                return {r: data_parser.UserSummary(error=str(data['error']), status=data.get('status'))
+                        for r in windows}
+
+            fetched = data['data']
+            await DbModel.run_async(DbModel.save_daily_summaries, account, fetched)
+
+            # Merge the fetched days over the stored ones instead of selecting them all again
+            merged = {day['day']: day for day in days}
+            for day in fetched:
+                merged[day['day']] = day
+            days = sorted(merged.values(), key=lambda day: day['day'])
+
+        if not aggregate:
+            return {r: data_parser.UserSummary() for r in windows}
+        # Summing up months of days for every range takes long enough to hold up the other fetches
+        return await asyncio.get_running_loop().run_in_executor(None, data_parser.aggregate_ranges, days, windows)
+
+    async def __get_json__(self, header, session, url_args, discord_username, project=None, account=None):
+        """
+        Sends a GET request to the wakatime API through the scheduler
+
+        :param header: The authorization header
+        :param session: The aio.http client session
+        :param url_args: The part of the URL after the API base URL
+        :param discord_username: The discord username the request is for, used for logging
+        :param project: OPTIONAL parameter. Module level function that cuts the json response down to what's needed.
+                        Big responses are then parsed and projected in a worker process
+        :param account: OPTIONAL parameter. The account key of the user, see DbModel.account_key. If it's given
+                        the response is kept in the response cache, and only downloaded again if it changed
+        :return: The json response, or what project made of it. Failures get the same shape as an error response
+                 from wakatime (an object with an 'error' key) so callers handle both the same way
+        """
+        url = self.base_url + url_args
+        cache_key = (account, url) if account is not None and self.response_cache is not None else None
+        cached = None
+        if cache_key is not None:
+            cached = await self.response_cache.get(cache_key)
+            if cached is not None:
+                header = dict(header)
+                if cached.etag:
+                    header['If-None-Match'] = cached.etag
+                if cached.last_modified:
+                    header['If-Modified-Since'] = cached.last_modified
+
+        try:
+            status, text, headers = await self.scheduler.request(session, 'GET', url, headers=header)
+        except RequestFailed as e:
+            print("Could not retrieve the data of {}: {}".format(discord_username, e))
+            error = {'error': str(e)}
+            return error if project is None else project(error)
+
+        if cache_key is not None:
+            status, text = await self.__use_response_cache__(cache_key, cached, status, text, headers)
+
+        if project is None:
+            return data_parser.parse_response(status, text)
+
+        if self.workers is not None and len(text) >= constant.WORKER_PARSE_MIN_BYTES:
+            try:
+                with metrics.span('worker_parse'):
+                    return await asyncio.get_running_loop().run_in_executor(self.workers,
+                                                                            data_parser.parse_and_project,
+                                                                            status, text, project)
+            except BrokenProcessPool:
+                # A worker died, start new ones for the next responses and parse this one here
+                print("A fetch worker died, restarting the fetch workers")
+                self.__start_workers__()
+
+        return data_parser.parse_and_project(status, text, project)
+
+    async def __use_response_cache__(self, cache_key, cached, status, text, headers):
+        """
+        Answers a 304 with the cached body, and stores responses that can be revalidated later
+
+        :param cache_key: The (account, url) key of the response
+        :param cached: The cache.CachedResponse that was revalidated, None if nothing was cached
+        :return: The status and body to use, as a tuple
+        """
+        if status == 304 and cached is not None:
+            metrics.inc('http_cache_requests_total', result='not_modified')
+            metrics.inc('http_cache_bytes_saved_total', len(cached.body))
+            return 200, cached.body
+
+        if cached is None:
+            metrics.inc('http_cache_requests_total', result='miss')
         else:
-            url_args = 'users/current/summaries?range='
-            url_args = url_args + time_range
+            metrics.inc('http_cache_requests_total', result='modified' if status == 200 else 'error')
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if status == 200 and (etag or last_modified):
+            await self.response_cache.put(cache_key, etag, last_modified, text)
 
-        async with session.get(url=self.base_url + url_args, headers=header) as response:
-            data = await response.json()
-            return discord_username, data
+        return status, text
 
 
 #auth = Authorizer()
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+import metrics
+
+
+class TTLCache:
+    """
+    A size bounded cache where every entry expires after its own time to live.
+    When the cache is full the least recently used entry is evicted first.
+    """
+    def __init__(self, max_size, default_ttl):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.__entries__ = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        """
+        Gets a value from the cache
+
+        :param key: The key of the entry
+        :return: The cached value, or None if it is missing or expired
+        """
+        entry = self.__entries__.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.__entries__[key]
+            return None
+
+        # Mark as most recently used
+        self.__entries__.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value in the cache, evicting the least recently used entry if the cache is full
+
+        :param key: The key of the entry
+        :param value: The value to store
+        :param ttl: OPTIONAL parameter. Seconds until the entry expires. Uses the default ttl if not given
+        :return: Nothing
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+
+        # A ttl of 0 means this kind of entry should never be cached
+        if ttl <= 0:
+            return
+
+        self.__entries__[key] = (time.monotonic() + ttl, value)
+        self.__entries__.move_to_end(key)
+
+        while len(self.__entries__) > self.max_size:
+            self.__entries__.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Removes a single entry from the cache if it exists
+        """
+        self.__entries__.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """
+        Removes every entry whose key matches the predicate
+
+        :param predicate: Function that takes a key and returns True if the entry should be removed
+        :return: Nothing
+        """
+        for key in [key for key in self.__entries__ if predicate(key)]:
+            del self.__entries__[key]
+
+    def invalidate_values_where(self, predicate):
+        """
+        Removes every entry whose value matches the predicate
+
+        :param predicate: Function that takes a value and returns True if the entry should be removed
+        :return: Nothing
+        """
+        for key in [key for key, (_, value) in self.__entries__.items() if predicate(value)]:
+            del self.__entries__[key]
+
+    def __len__(self):
+        return len(self.__entries__)
+
+
+class SnapshotStore:
+    """
+    Keeps the latest precomputed value for every key, along with when it was computed.
+    Unlike TTLCache, old snapshots are kept so callers can decide how old is too old.
+    """
+    def __init__(self):
+        self.__snapshots__ = {}  # key -> (taken_at, value)
+
+    def put(self, key, value):
+        self.__snapshots__[key] = (time.time(), value)
+
+    def get(self, key, max_age):
+        """
+        Gets the latest snapshot of a key if it isn't too old
+
+        :param key: The key of the snapshot
+        :param max_age: Max age of the snapshot in seconds
+        :return: A tuple of the value and its age in seconds, or (None, None) if there is no recent enough snapshot
+        """
+        age = self.age(key)
+        if age is None or age > max_age:
+            return None, None
+
+        return self.__snapshots__[key][1], age
+
+    def age(self, key):
+        """
+        :return: The age of the snapshot of a key in seconds, None if there is no snapshot
+        """
+        snapshot = self.__snapshots__.get(key)
+        if snapshot is None:
+            return None
+
+        return time.time() - snapshot[0]
+
+    def discard_where(self, predicate):
+        """
+        Removes every snapshot whose key matches the predicate
+
+        :param predicate: Function that takes a key and returns True if the snapshot should be removed
+        :return: Nothing
+        """
+        for key in [key for key in self.__snapshots__ if predicate(key)]:
+            del self.__snapshots__[key]
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers that ask for the same key share a single computation.
+    The first caller starts it, everyone who asks for the key while it runs waits for its result.
+    """
+    def __init__(self, name):
+        self.name = name  # Used as the label of the coalesced requests metric
+        self.__in_flight__ = {}  # key -> future
+
+    def running(self, key):
+        """
+        :return: True if a run for the key is in flight, so asking for it now only means waiting for its result
+        """
+        return key in self.__in_flight__
+
+    async def run(self, key, function, *args, **kwargs):
+        """
+        Runs a coroutine function, or waits for the run that is already in flight for the same key
+
+        :param key: The key that identifies identical requests
+        :param function: The coroutine function to run
+        :return: Whatever the coroutine returns
+        """
+        future = self.__in_flight__.get(key)
+        if future is not None:
+            metrics.inc('requests_coalesced_total', kind=self.name)
+        else:
+            future = asyncio.ensure_future(function(*args, **kwargs))
+            self.__in_flight__[key] = future
+            future.add_done_callback(lambda _: self.__in_flight__.pop(key, None))
+
+        # Shielded so one caller giving up doesn't cancel the computation for everyone else
+        return await asyncio.shield(future)
+
+
+# A response stored by ResponseCache, with the validators that ask the server whether it changed
+CachedResponse = namedtuple('CachedResponse', ['etag', 'last_modified', 'body'])
+
+
+class ResponseCache:
+    """
+    HTTP responses stored on disk with their ETag and Last-Modified, one compressed file per response,
+    so they survive restarts. Once the files take up more than max_bytes the least recently used ones are deleted.
+    Reading and writing happens on the default executor, so the disk never holds up the event loop.
+    """
+    SUFFIX = '.z'
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__sizes__ = None  # file name -> size in bytes, least recently used first. Loaded on first use
+        self.__total__ = 0
+        self.__lock__ = threading.Lock()  # The executor runs several reads and writes at once
+
+    async def get(self, key):
+        """
+        :param key: Anything with a stable repr, e.g. (account, url)
+        :return: The CachedResponse of the key, or None if nothing is stored for it
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.load, key)
+
+    async def put(self, key, etag, last_modified, body):
+        """
+        Stores a response, replacing what was stored for the key before
+
+        :param key: Anything with a stable repr, e.g. (account, url)
+        :param etag: The ETag header of the response, or None
+        :param last_modified: The Last-Modified header of the response, or None
+        :param body: The response body as text
+        :return: Nothing
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.store, key, etag, last_modified, body)
+
+    def __file_name__(self, key):
+        return hashlib.sha256(repr(key).encode()).hexdigest() + self.SUFFIX
+
+    def __load_index__(self):
+        # Files written before a restart count towards the size too, the oldest ones get evicted first
+        if self.__sizes__ is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        self.__sizes__ = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.__total__ = sum(self.__sizes__.values())
+
+    def load(self, key):
+        """
+        Blocking version of get
+        """
+        name = self.__file_name__(key)
+        with self.__lock__:
+            self.__load_index__()
+            if name not in self.__sizes__:
+                return None
+            self.__sizes__.move_to_end(name)
+
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as file:
+                header, body = file.read().split(b'\n', 1)
+            header = json.loads(header)
+            body = zlib.decompress(body).decode()
+        except (OSError, ValueError, zlib.error):
+            # Evicted by another bot process sharing the directory, or cut short by a crash
+            return None
+
+        if header['key'] != repr(key):
+            return None
+        return CachedResponse(header['etag'], header['last_modified'], body)
+
+    def store(self, key, etag, last_modified, body):
+        """
+        Blocking version of put
+        """
+        name = self.__file_name__(key)
+        header = json.dumps({'key': repr(key), 'etag': etag, 'last_modified': last_modified})
+        data = header.encode() + b'\n' + zlib.compress(body.encode())
+        path = os.path.join(self.directory, name)
+
+        with self.__lock__:
+            self.__load_index__()
+
+        # Written next to the real file first, so a crash can't leave half a response behind
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+        with self.__lock__:
+            self.__total__ += len(data) - self.__sizes__.pop(name, 0)
+            self.__sizes__[name] = len(data)
+
+            evicted = []
+            while self.__total__ > self.max_bytes and len(self.__sizes__) > 1:
+                oldest, size = self.__sizes__.popitem(last=False)
+                self.__total__ -= size
+                evicted.append(oldest)
+
+        for oldest in evicted:
+            try:
+                os.remove(os.path.join(self.directory, oldest))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,220 @@
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+
+from discord.ext import commands
+
+import metrics
+
+# Priorities, the lower the sooner. Work with the same priority runs in the order it arrived
+INTERACTIVE = 0  # Commands that answer about a single user, or from a cache
+HEAVY = 1  # Commands that fan out over a whole guild, like !top
+BACKGROUND = 2  # Work nobody is waiting for, like refreshing snapshots
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', HEAVY: 'heavy', BACKGROUND: 'background'}
+
+# The priority of the work running in the current task. Tasks started from it (asyncio.gather, SingleFlight)
+# inherit it, so every wakatime request a command sends waits with the command's priority
+priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+# Set in the task of work that several tasks wait for, like a coalesced token refresh. Its wakatime requests wait
+# with this SharedPriority instead, so they move up the queues when a more urgent task starts waiting for them too
+shared_priority = contextvars.ContextVar('shared_priority', default=None)
+
+
+class Busy(Exception):
+    """
+    Raised by CommandScheduler.heavy_job when too many heavy jobs are waiting already
+    """
+    def __init__(self, retry_after):
+        super().__init__('Too many heavy jobs are waiting, retry after {} seconds'.format(retry_after))
+        self.retry_after = retry_after  # Seconds until a slot is expected to be free
+
+
+class SharedPriority:
+    """
+    The priority of work that several tasks wait for. It starts out with the priority of the task that started
+    the work and becomes as urgent as the most urgent task that waits for it, so a command never waits behind
+    background work it happened to join
+    """
+    def __init__(self, level):
+        self.level = level
+        self.__waiting__ = []  # (PriorityLimiter, waiter) pairs of the queues the work is waiting in right now
+
+    def join(self, level):
+        """
+        Makes the work at least as urgent as a task that starts waiting for it
+
+        :param level: The priority of that task
+        :return: Nothing
+        """
+        if level >= self.level:
+            return
+
+        self.level = level
+        for limiter, waiter in self.__waiting__:
+            limiter.__reprioritize__(waiter, level)
+
+
+class PriorityLimiter:
+    """
+    Caps how many tasks hold it at once, like asyncio.Semaphore. When it's taken, the waiter with the
+    most urgent priority gets in next, not the one that has been waiting the longest
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.__held__ = 0
+        self.__waiters__ = []  # Heap of [priority, arrival, future]
+        self.__arrivals__ = itertools.count()
+
+    def waiting(self, level=None):
+        """
+        :param level: OPTIONAL parameter. Only count the waiters with this priority
+        :return: How many tasks are waiting to get in
+        """
+        return sum(1 for waiter in self.__waiters__ if level is None or waiter[0] == level)
+
+    async def acquire(self, level):
+        """
+        :param level: The priority to wait with, or a SharedPriority that can become more urgent while it waits
+        """
+        if self.__held__ < self.limit and not self.__waiters__:
+            self.__held__ += 1
+            return
+
+        shared = level if isinstance(level, SharedPriority) else None
+        if shared is not None:
+            level = shared.level
+
+        waiter = [level, next(self.__arrivals__), asyncio.get_running_loop().create_future()]
+        heapq.heappush(self.__waiters__, waiter)
+        if shared is not None:
+            shared.__waiting__.append((self, waiter))
+        try:
+            await waiter[2]
+        except asyncio.CancelledError:
+            if waiter[2].done() and not waiter[2].cancelled():
+                # It was handed over right as the waiter gave up, pass it on
+                self.release()
+            elif waiter in self.__waiters__:
+                self.__waiters__.remove(waiter)
+                heapq.heapify(self.__waiters__)
+            raise
+        finally:
+            if shared is not None:
+                shared.__waiting__.remove((self, waiter))
+
+    def __reprioritize__(self, waiter, level):
+        # Called by SharedPriority, the waiter moves up the queue as if it had arrived with that priority
+        if waiter in self.__waiters__:
+            waiter[0] = level
+            heapq.heapify(self.__waiters__)
+
+    def release(self):
+        while self.__waiters__:
+            future = heapq.heappop(self.__waiters__)[2]
+            # Skips waiters that were cancelled but haven't woken up yet
+            if not future.done():
+                # Handed straight to the next waiter, so nobody can get in between
+                future.set_result(None)
+                return
+        self.__held__ -= 1
+
+    @asynccontextmanager
+    async def hold(self, level):
+        await self.acquire(level)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class CommandScheduler:
+    """
+    Decides when commands get to run. Heavy jobs that fan out over a whole guild are capped, wait with the
+    priority of their command, and are turned away with Busy when too many are waiting already.
+    Commands can also get a cooldown per guild and per user, meant for the times they need a live fetch.
+    """
+    def __init__(self, heavy_limit, max_waiting, job_estimate, cooldowns):
+        """
+        :param heavy_limit: Max amount of heavy jobs running at once
+        :param max_waiting: Max amount of heavy jobs waiting for a slot before interactive and heavy ones are
+                            turned away. Background jobs always wait
+        :param job_estimate: Seconds a heavy job is guessed to take until some have finished
+        :param cooldowns: Dictionary of command name to (seconds per guild, seconds per user)
+        """
+        self.heavy_limit = heavy_limit
+        self.max_waiting = max_waiting
+        self.job_seconds = job_estimate  # Moving average of how long heavy jobs take
+        self.heavy_slots = PriorityLimiter(heavy_limit)
+
+        self.__cooldowns__ = {}
+        for command, (per_guild, per_user) in cooldowns.items():
+            self.__cooldowns__[command] = [commands.CooldownMapping.from_cooldown(1, per_guild, commands.BucketType.guild),
+                                           commands.CooldownMapping.from_cooldown(1, per_user, commands.BucketType.user)]
+
+        for level, name in PRIORITY_NAMES.items():
+            metrics.gauge('job_queue_depth', functools.partial(self.heavy_slots.waiting, level), priority=name)
+
+    def retry_after_cooldown(self, command, message):
+        """
+        Uses up the cooldowns of a command, unless one of them is still running
+
+        :param command: The name of the command
+        :param message: The discord message that invoked it
+        :return: Seconds until the command can be used again, or None if it can be used now
+        """
+        buckets = [mapping.get_bucket(message) for mapping in self.__cooldowns__.get(command, [])]
+        retry_after = max([bucket.get_retry_after() for bucket in buckets], default=0)
+        if retry_after > 0:
+            metrics.inc('commands_throttled_total', command=command, reason='cooldown')
+            return retry_after
+
+        for bucket in buckets:
+            bucket.update_rate_limit()
+        return None
+
+    def refund_cooldown(self, command, message):
+        """
+        Gives back the cooldowns retry_after_cooldown used up, for a command that was turned away before it did anything
+
+        :param command: The name of the command
+        :param message: The discord message that invoked it
+        :return: Nothing
+        """
+        for mapping in self.__cooldowns__.get(command, []):
+            mapping.get_bucket(message).reset()
+
+    def estimate_wait(self):
+        """
+        :return: Whole seconds until a heavy job that starts waiting now is expected to get a slot
+        """
+        ahead = self.heavy_slots.waiting() // self.heavy_limit + 1
+        return max(1, math.ceil(ahead * self.job_seconds))
+
+    @asynccontextmanager
+    async def heavy_job(self, kind):
+        """
+        Runs the code inside the with block as a heavy job, with the priority of the current task
+
+        :param kind: What the job is, used as a metrics label, e.g. 'leaderboard'
+        :raise Busy: If too many heavy jobs are waiting already
+        """
+        level = priority.get()
+        waiting = self.heavy_slots.waiting() - self.heavy_slots.waiting(BACKGROUND)
+        if level != BACKGROUND and waiting >= self.max_waiting:
+            metrics.inc('commands_throttled_total', command=kind, reason='busy')
+            raise Busy(self.estimate_wait())
+
+        queued = time.perf_counter()
+        async with self.heavy_slots.hold(level):
+            started = time.perf_counter()
+            metrics.observe('job_queue_wait_seconds', started - queued, kind=kind, priority=PRIORITY_NAMES[level])
+            try:
+                yield
+            finally:
+                self.job_seconds = 0.8 * self.job_seconds + 0.2 * (time.perf_counter() - started)
@@ -3,4 +3,118 @@ YESTERDAY = 'yesterday'
 WEEK = 'last_7_days'
 MONTH = 'this_month'
 SIX_MONTH = 'last_6_months'
-ALL_TIME = 'all_time_since_today'
\ No newline at end of file
+ALL_TIME = 'all_time_since_today'
+
+# Leaderboard cache settings
+# How long (in seconds) a leaderboard stays cached for each time range.
+# Short ranges change quickly, long ranges barely move between commands.
+LEADERBOARD_CACHE_TTL = {
+    TODAY: 60,
+    YESTERDAY: 30 * 60,
+    WEEK: 5 * 60,
+    MONTH: 10 * 60,
+    SIX_MONTH: 30 * 60,
+    ALL_TIME: 60 * 60
+}
+LEADERBOARD_CACHE_DEFAULT_TTL = 5 * 60
+LEADERBOARD_CACHE_SIZE = 256  # Max amount of (server, range) leaderboards kept in memory
+ACCOUNT_CACHE_SIZE = 5000  # Max amount of (wakatime account, range) results shared between servers
+
+# Access tokens that expire within this many seconds get refreshed before they are used
+TOKEN_REFRESH_WINDOW = 10 * 60
+
+# Shared HTTP session settings
+HTTP_POOL_SIZE = 100  # Max amount of open connections in total
+HTTP_POOL_SIZE_PER_HOST = 30  # Max amount of open connections to a single host (basically wakatime.com)
+HTTP_DNS_CACHE_TTL = 5 * 60  # Seconds a DNS lookup is reused for
+HTTP_KEEPALIVE_TIMEOUT = 60  # Seconds an idle connection is kept open for reuse
+HTTP_REQUEST_TIMEOUT = 15  # Seconds a single request to wakatime may take before it is abandoned
+
+# Database settings
+DB_MAX_CONNECTIONS = 10  # Max amount of pooled database connections
+DB_STALE_TIMEOUT = 5 * 60  # Seconds after which an idle pooled connection gets recycled
+DB_POOL_WAIT_TIMEOUT = 10  # Seconds to wait for a free pooled connection before failing
+DB_EXECUTOR_WORKERS = 8  # Threads that run database queries off the event loop
+DB_BATCH_SIZE = 100  # Rows written per statement by bulk writes
+DB_READ_BATCH_SIZE = 500  # Keys looked up per statement by bulk reads
+DB_RECORD_CACHE_SIZE = 2048  # Max amount of WakaData records kept in memory
+DB_RECORD_CACHE_TTL = 60  # Seconds a cached WakaData record is trusted for
+MIGRATION_LOCK_TIMEOUT = 5 * 60  # Seconds to wait for another process to finish migrating the schema
+
+# Request scheduling for the wakatime API
+HTTP_MAX_CONCURRENCY = 20  # Max amount of requests in flight at once
+HTTP_MAX_CONCURRENCY_PER_HOST = 10  # Max amount of requests in flight to a single host
+HTTP_RATE_LIMIT = 10  # Requests per second, on average
+HTTP_RATE_BURST = 20  # Requests that can be sent at once before the rate limit kicks in
+HTTP_MAX_RETRIES = 3  # Retries for requests that failed, timed out or were rate limited
+HTTP_BACKOFF_BASE = 0.5  # Seconds, doubled for every retry
+HTTP_BACKOFF_MAX = 10  # Max seconds to wait between retries
+HTTP_REQUEST_DEADLINE = 45  # Seconds a request may take including all of its retries
+
+# Background leaderboard snapshots
+LEADERBOARD_RANGES = [WEEK, MONTH, ALL_TIME]  # Ranges that !top supports, so the ones worth precomputing
+SNAPSHOT_INTERVAL = 10 * 60  # Seconds between two background refresh cycles
+SNAPSHOT_MAX_AGE = 30 * 60  # Seconds a snapshot can be served for before !top fetches live data instead
+SNAPSHOT_SERVERS_PER_CYCLE = 5  # Max amount of servers refreshed per cycle, the stalest ones go first
+SNAPSHOT_SERVER_CONCURRENCY = 5  # Max amount of requests in flight for a single server during a refresh
+
+# Days that make up SIX_MONTH when its totals are computed from stored daily summaries
+SIX_MONTH_DAYS = 183
+# Ranges made up of whole days, answered from stored daily summaries
+DAY_RANGES = [TODAY, YESTERDAY, WEEK, MONTH, SIX_MONTH]
+# Ranges that are fetched together whenever one of them is needed. One request covering all of them costs
+# about the same as a request for the week alone, and every one of them gets answered from it
+COVERING_RANGES = [TODAY, YESTERDAY, WEEK, MONTH]
+# Accounts whose days no range covers anymore are deleted per statement, during the sweep of expired registrations
+DAILY_SUMMARY_SWEEP_BATCH = 100
+
+# Big wakatime responses are parsed in this many worker processes instead of on the event loop, 0 parses everything
+# on the event loop. FETCH_WORKERS in secrets.env overrides it
+FETCH_WORKERS = 2
+WORKER_PARSE_MIN_BYTES = 64 * 1024  # Responses smaller than this are cheaper to parse than to send to a worker
+
+# In process web server, serves the OAuth callback behind a reverse proxy. WEB_HOST and WEB_PORT in secrets.env
+# override these. Registrations can't be finished without it, so the bot doesn't start if it can't listen
+WEB_SERVER_HOST = '127.0.0.1'
+WEB_SERVER_PORT = 8080
+WEB_SERVER_BIND_ATTEMPTS = 5  # Tries to listen before giving up, the port can still be held by a process that just quit
+WEB_SERVER_BIND_RETRY_DELAY = 2  # Seconds between two tries
+# Serves /metrics on its own listener, so it isn't exposed through the reverse proxy.
+# METRICS_HOST and METRICS_PORT in secrets.env override these
+METRICS_SERVER_HOST = '127.0.0.1'
+METRICS_SERVER_PORT = 9090
+
+# Server wide language leaderboards of !toplang, summed up from the stored daily summaries of every user
+LANGUAGE_LEADERBOARD_SIZE = 10  # Languages shown when !toplang isn't given an amount
+LANGUAGE_BREAKDOWN_SIZE = 5  # Languages shown in the breakdown of !stats
+
+# Registrations that keep failing. Every failure in a row doubles how long a registration is skipped for,
+# and after QUARANTINE_AFTER failures in a row where wakatime refused its tokens it's deactivated until re-registered
+FAILURE_BACKOFF_BASE = 5 * 60  # Seconds a registration is skipped for after its first failure
+FAILURE_BACKOFF_MAX = 6 * 60 * 60  # Max seconds a registration is skipped for
+QUARANTINE_AFTER = 5
+REFUSED_STATUSES = [401, 403]  # Statuses of data requests that mean the access token doesn't work anymore
+DEACTIVATION_NOTIFY_INTERVAL = 5 * 60  # Seconds between two checks for deactivated users to notify
+FAILED_NAMES_SHOWN = 5  # Users a leaderboard names when their stats couldn't be fetched, the rest are only counted
+
+# Registrations started with !register. Wakatime sends users back to the OAuth callback served by the bot
+AUTH_STATE_TTL = 60 * 60  # Seconds a user has to allow the bot access after using !register
+AUTH_STATE_SWEEP_INTERVAL = 10 * 60  # Seconds between two sweeps of expired registrations
+AUTH_STATE_SWEEP_BATCH = 500  # Expired registrations deleted per statement
+
+# Wakatime responses kept on disk, compressed, and revalidated with ETag / Last-Modified instead of downloaded again.
+# HTTP_CACHE_DIR and HTTP_CACHE_MAX_BYTES in secrets.env override these, a size of 0 turns the cache off.
+# Every bot process should get its own directory
+HTTP_CACHE_DIR = 'http-cache'
+HTTP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Commands that fan out over a whole guild are heavy jobs. Only a few run at once, and once too many are waiting
+# new ones are turned away with "busy, try again in N seconds" instead of piling up
+HEAVY_JOB_LIMIT = 2  # Max amount of heavy jobs running at once
+HEAVY_JOB_MAX_WAITING = 8  # Max amount of heavy jobs waiting for a slot, background refreshes don't count
+HEAVY_JOB_ESTIMATE = 10  # Seconds a heavy job is guessed to take, until the bot has timed some
+HEAVY_COMMANDS = ['top', 'toplang']  # Commands whose wakatime requests wait behind those of every other command
+COMMAND_COOLDOWNS = {  # Command -> (seconds per guild, seconds per user) between two uses
+    'top': (5, 15),
+    'toplang': (5, 15),
+}
@@ -1,23 +1,101 @@
 import DbModel
 import constant
+import metrics
 import asyncio
-import auth
 import itertools
+import json
+from datetime import date, timedelta
+
+
+
+class UserSummary:
+    """
+    The only parts of a user's wakatime data the bot uses. Full responses
+    get turned into these as soon as they arrive, so a big leaderboard
+    doesn't keep every user's whole json document in memory.
+    """
+    __slots__ = ('seconds', 'text', 'top_languages', 'languages', 'start_text', 'error', 'status', 'skipped')
+
+    def __init__(self, seconds=0, text='0 secs', top_languages=(), languages=None, start_text=None, error=None,
+                 status=None, skipped=False):
+        self.seconds = seconds  # Total time coded in seconds
+        self.text = text  # Total time coded, formatted by wakatime
+        self.top_languages = top_languages  # The most used language of every day that had one
+        self.languages = languages or {}  # Language name -> seconds coded in it over the whole range
+        self.start_text = start_text  # When all time stats start, only set for all time
+        self.error = error  # Why the data couldn't be retrieved, None if it could
+        self.status = status  # HTTP status wakatime refused the request with, None if it didn't answer or didn't refuse
+        self.skipped = skipped  # True if the registration wasn't tried because it's waiting out its failure backoff
+
+
+def parse_response(status, text):
+    """
+    Turns the body of a wakatime API response into json. Failures get the same shape as an error
+    response from wakatime (an object with an 'error' key) so callers handle both the same way.
+    Responses that aren't a 200 also get their status under 'status'
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return {'error': 'HTTP {}, response was not json'.format(status), 'status': status}
+
+    if status != 200:
+        if not isinstance(data, dict) or 'error' not in data:
+            data = {'error': 'HTTP {}'.format(status)}
+        data['status'] = status
+    return data
+
+
+def parse_and_project(status, text, project):
+    """
+    Parses a response and cuts it down with project right away. Big responses get this done
+    in the fetch worker processes, so only the small projection is sent back to the bot
+    """
+    return project(parse_response(status, text))
+
+
+def summary_from_json(data, r):
+    """
+    Projects a wakatime response onto a UserSummary
+    """
+    if 'error' in data:
+        return UserSummary(error=str(data['error']), status=data.get('status'))
+
+    try:
+        if r == constant.ALL_TIME:
+            return UserSummary(seconds=data['data']['total_seconds'],
+                               text=data['data']['text'],
+                               start_text=data['data']['range']['start_text'])
+
+        top_languages = tuple(day['languages'][0]['name'] for day in data['data'] if day.get('languages'))
+        languages = {}
+        for day in data['data']:
+            for language in day.get('languages', []):
+                languages[language['name']] = languages.get(language['name'], 0) + language['total_seconds']
+
+        return UserSummary(seconds=data['cummulative_total']['seconds'],
+                           text=data['cummulative_total']['text'],
+                           top_languages=top_languages,
+                           languages=languages)
+    except (KeyError, IndexError, TypeError) as e:
+        return UserSummary(error='Unexpected response: {}'.format(repr(e)))
+
 
 def most_used_language(stats):
     """
     Returns a user's most used programming language
     """
+    # The seconds spent on every language are known for ranges made up of days
+    if stats.languages:
+        return max(stats.languages, key=stats.languages.get)
+
     langs = {}
     
-    for day in stats['data']:
-        if day['languages']:
-            language = day['languages'][0]['name']
-
-            if language in langs:
-                langs[language] += 1
-            else:
-                langs[language] = 1
+    for language in stats.top_languages:
+        if language in langs:
+            langs[language] += 1
+        else:
+            langs[language] = 1
 
     # find the max (not accounting for a tie... yet)
     if langs:
@@ -30,42 +108,283 @@ def most_used_language(stats):
 async def rank_all_users(self, ctx, r):
     """
     Returns a sorted list of dictionaries that contain
-    every authenticated user in the server
+    every authenticated user in the server, a list of
+    the names of users whose data couldn't be retrieved,
+    how many users were skipped while they wait out their failure backoff,
+    and the age in seconds of the data (None if it's live)
     """
+    cache_key = (ctx.guild.id, r)
+
+    # Use the background snapshot if there is a recent enough one
+    scores, age = recent_snapshot(self, cache_key, r)
+    if scores is None:
+        scores = self.authenticator.leaderboard_cache.get(cache_key)
+
+    if scores is None:
+        # Someone else asking for the same leaderboard right now gets the same result
+        scores = await self.authenticator.leaderboard_flights.run(cache_key, compute_scores, self, ctx.guild.id, r)
+        self.authenticator.leaderboard_cache.set(cache_key, scores, ranking_ttl(r, scores))
+
+    ranking, failed, skipped = scores
+    with metrics.span('member_resolve', guild_size=metrics.size_bucket(len(ranking) + len(failed))):
+        members = await resolve_members(ctx.guild, ranking + failed)
 
     people = []
+    for entry in ranking:
+        member = members.get(entry['discord_id'] or entry['username'])
+
+        userDict = {}
+        # People who left the server are still ranked under the name they registered with
+        userDict['name'] = member.display_name if member is not None else entry['username']
+        userDict['seconds'] = entry['seconds']
+        userDict['time'] = entry['time']
+
+        people.append(userDict)
+
+    failed_names = []
+    for entry in failed:
+        member = members.get(entry['discord_id'] or entry['username'])
+        failed_names.append(member.display_name if member is not None else entry['username'])
+
+    return people, failed_names, skipped, age
+
+
+def ranking_ttl(r, result):
+    """
+    Returns how long a ranking of a range is cached for. Don't keep it around for long if people are missing from it
+
+    :param result: A (ranking, failed, skipped) tuple, see score_users
+    """
+    ttl = constant.LEADERBOARD_CACHE_TTL.get(r, constant.LEADERBOARD_CACHE_DEFAULT_TTL)
+    if result[1] or result[2]:
+        ttl = min(ttl, constant.LEADERBOARD_CACHE_TTL[constant.TODAY])
+    return ttl
+
+
+def recent_snapshot(self, cache_key, r):
+    """
+    Gets the snapshot of a leaderboard if it's recent enough to answer with. Snapshots people are missing from
+    are only used for as long as the same leaderboard fetched live would be cached
 
-    userData = await self.authenticator.async_get_all_wakatime_users_json(ctx.guild.id, r)
+    :return: A tuple of the scores and their age in seconds, or (None, None)
+    """
+    scores, age = self.authenticator.snapshots.get(cache_key, constant.SNAPSHOT_MAX_AGE)
+    if scores is not None and age > ranking_ttl(r, scores):
+        return None, None
+    return scores, age
+
+
+def fetches_live(self, server_id, r, languages=False):
+    """
+    Tells if ranking a server right now means fetching from wakatime. Rankings answered from a snapshot,
+    the cache, or a fetch someone else already started don't
+
+    :param languages: OPTIONAL parameter. Ask about the language ranking of rank_languages instead of the leaderboard
+    :return: True if the ranking has to be fetched live
+    """
+    if languages:
+        cache_key = (server_id, r, 'languages')
+    else:
+        cache_key = (server_id, r)
+        scores, _ = recent_snapshot(self, cache_key, r)
+        if scores is not None:
+            return False
+
+    return self.authenticator.leaderboard_cache.get(cache_key) is None and \
+        not self.authenticator.leaderboard_flights.running(cache_key)
+
+
+async def rank_languages(self, ctx, r):
+    """
+    Returns the languages coded in by the authenticated users of a server as a list of dictionaries,
+    the most used first, the names of users whose data couldn't be brought up to date,
+    and how many users were skipped while they wait out their failure backoff
+    """
+    cache_key = (ctx.guild.id, r, 'languages')
+
+    result = self.authenticator.leaderboard_cache.get(cache_key)
+    if result is None:
+        result = await self.authenticator.leaderboard_flights.run(cache_key, compute_language_ranking,
+                                                                  self, ctx.guild.id, r)
+        self.authenticator.leaderboard_cache.set(cache_key, result, ranking_ttl(r, result))
+
+    ranking, failed, skipped = result
+    members = await resolve_members(ctx.guild, failed)
+
+    failed_names = []
+    for entry in failed:
+        member = members.get(entry['discord_id'] or entry['username'])
+        failed_names.append(member.display_name if member is not None else entry['username'])
+
+    return ranking, failed_names, skipped
+
+
+async def compute_language_ranking(self, server_id, r):
+    """
+    Brings the stored daily summaries of every authenticated user in a server up to date, then sums up
+    the seconds of every language over all of them. Should be run through leaderboard_flights
+    """
+    async with self.jobs.heavy_job('languages'):
+        return await __compute_language_ranking__(self, server_id, r)
+
+
+async def __compute_language_ranking__(self, server_id, r):
+    users = await DbModel.run_async(DbModel.get_authenticated_discord_users, server_id, as_is=True)
+    # Fetching a day based range stores the days it covers. The database sums them up, they don't need to be
+    # summed up here as well
+    userData = await self.authenticator.async_get_users_json(users, r, aggregate=False)
+    # Registrations waiting out their backoff are known to be broken, they're only counted
+    failed = [{'username': user[0], 'discord_id': user[2]} for user in userData
+              if user[1].error is not None and not user[1].skipped]
+    skipped = sum(1 for user in userData if user[1].skipped)
+
+    # Accounts are known now. Registrations of the same account count once.
+    # Days stored before a fetch failed still count, they're just missing the latest ones
+    accounts = list(dict.fromkeys(DbModel.account_key(user) for user in users))
+    start, end = range_dates(r, date.today())
+    # The database sums up the days, so only a row per account and language comes back
+    seconds = await DbModel.run_async(DbModel.get_language_seconds_of_accounts, accounts, start, end)
+
+    with metrics.span('language_score', guild_size=metrics.size_bucket(len(users))):
+        ranking = await asyncio.get_running_loop().run_in_executor(None, rank_language_seconds, seconds, accounts)
+    return ranking, failed, skipped
+
+
+def rank_language_seconds(seconds, accounts):
+    """
+    Ranks languages by the seconds the accounts spent on them
+
+    :param seconds: (account, language, seconds) tuples, see DbModel.get_language_seconds_of_accounts
+    :param accounts: The account keys to count, sums of other accounts are left out
+    :return: A list of dictionaries with the language's name, its total seconds, its share of all seconds
+             and how many accounts used it, sorted by seconds
+    """
+    accounts = set(accounts)
+    totals = {}
+    users = {}
+    for account, language, value in seconds:
+        if account not in accounts or not value:
+            continue
+        totals[language] = totals.get(language, 0) + value
+        users[language] = users.get(language, 0) + 1
+
+    total = sum(totals.values())
+    return [{'language': language,
+             'seconds': float(totals[language]),
+             'share': totals[language] / total if total else 0.0,
+             'users': users[language]}
+            for language in sorted(totals, key=totals.get, reverse=True) if totals[language] > 0]
+
+
+async def resolve_members(guild, entries):
+    """
+    Finds the guild members of scored entries. Members are looked up by id, members the
+    cache doesn't have are fetched from discord in batches, and entries registered before
+    ids were stored are matched by name once and get their id saved
+
+    :return: A dictionary of discord id (or username, for entries without one) to discord.Member
+    """
+    members = {}
+    missing = []
+    id_updates = []
+
+    for entry in entries:
+        if entry['discord_id'] is None:
+            member = guild.get_member_named(entry['username'])
+            if member is not None:
+                members[entry['username']] = member
+                id_updates.append((entry['username'], guild.id, member.id))
+                # Entries are shared with the leaderboard cache, so the next render looks them up by id
+                entry['discord_id'] = member.id
+                members[member.id] = member
+            continue
+
+        member = guild.get_member(entry['discord_id'])
+        if member is not None:
+            members[entry['discord_id']] = member
+        else:
+            missing.append(entry['discord_id'])
+
+    # Discord takes at most 100 ids per member query
+    for start in range(0, len(missing), 100):
+        try:
+            found = await guild.query_members(user_ids=missing[start:start + 100], limit=100)
+        except Exception as e:
+            print("Could not query the members of {}: {}".format(guild.id, e))
+            break
+        for member in found:
+            members[member.id] = member
+
+    if id_updates:
+        await DbModel.run_async(DbModel.update_discord_ids, id_updates)
+
+    return members
+
+
+async def refresh_server_snapshots(self, server_id):
+    """
+    Precomputes the leaderboards of every supported range for a server,
+    so !top can answer without waiting for wakatime
+    """
+    # Per server budget so one big server doesn't take every connection during a refresh
+    limit = asyncio.Semaphore(constant.SNAPSHOT_SERVER_CONCURRENCY)
+
+    for r in constant.LEADERBOARD_RANGES:
+        # Not shared with !top, a command joining a background refresh would wait with its priority and limit
+        scores = await self.authenticator.leaderboard_flights.run((server_id, r, 'snapshot'), compute_scores,
+                                                                  self, server_id, r, limit)
+        self.authenticator.snapshots.put((server_id, r), scores)
+
+
+async def compute_scores(self, server_id, r, limit=None):
+    """
+    Fetches the data of every authenticated user in a server and scores it.
+    Should be run through leaderboard_flights so it only runs once at a time per server and range
+    """
+    async with self.jobs.heavy_job('leaderboard'):
+        userData = await self.authenticator.async_get_all_wakatime_users_json(server_id, r, limit)
+    with metrics.span('score', guild_size=metrics.size_bucket(len(userData))):
+        return score_users(userData, r)
+
+
+def score_users(userData, r):
+    """
+    Turns the (discord username, UserSummary, discord id) tuples into a list of dictionaries
+    sorted by time coded, a list of the users whose json had an error, and how many users
+    were skipped while they wait out their failure backoff. Skipped users are known to be broken,
+    so they're only counted instead of named on every leaderboard.
+    Doesn't depend on discord so the result can be cached.
+    """
+    ranking = []
+    failed = []
+    skipped = 0
 
     # turn list of tuples into my list of dicts
     for user in userData:
+        if user[1].skipped:
+            skipped += 1
+            continue
+
         #make sure they dont have an error
-        if 'error' in user[1]:
+        if user[1].error is not None:
             print(f"User {user[0]} has an error in their json file reeeeeee")
+            failed.append({'username': user[0], 'discord_id': user[2]})
             continue
-            
-        if r == constant.ALL_TIME:
-            textTime = user[1]['data']['text']
-            rawTime = user[1]['data']['total_seconds']
-        else: 
-            textTime = user[1]['cummulative_total']['text']
-            rawTime = user[1]['cummulative_total']['seconds']
-        
-        member = ctx.guild.get_member_named(user[0])
-    
-        userDict = {}
-        userDict['name'] = member.display_name
-        userDict['seconds'] = rawTime
-        userDict['time'] = textTime
 
-        people.append(userDict)
+        entry = {}
+        entry['username'] = user[0]
+        entry['discord_id'] = user[2]
+        entry['seconds'] = user[1].seconds
+        entry['time'] = user[1].text
+
+        ranking.append(entry)
             
     # Sort the list
-    people = sorted(people, key=lambda x: x['seconds'], reverse=True)
+    ranking = sorted(ranking, key=lambda x: x['seconds'], reverse=True)
 
-    return people
+    return ranking, failed, skipped
 
-def format_leaderboard(people, n, guild_name):
+def format_leaderboard(people, n, guild_name, failed=None, age=None, skipped=0):
     count = 0
     leaderboard = "**Top {0} of {1}:**".format(n, guild_name)
 
@@ -73,6 +392,197 @@ def format_leaderboard(people, n, guild_name):
         count += 1
         row = "\n**[{0}]** {1} - *{2}*".format(count, person['name'], person['time'])
         leaderboard += row
-    
+
+    # Let people know someone is missing instead of leaving them out silently
+    if failed:
+        leaderboard += "\n*Couldn't get the stats of {0} right now, try again later.*".format(format_names(failed))
+    if skipped:
+        leaderboard += format_skipped(skipped)
+
+    if age is not None:
+        minutes = int(age // 60)
+        if minutes == 0:
+            leaderboard += "\n*Updated less than a minute ago*"
+        else:
+            leaderboard += "\n*Updated {0} minute{1} ago*".format(minutes, "" if minutes == 1 else "s")
+
     return leaderboard
-            
\ No newline at end of file
+
+
+def format_language_leaderboard(ranking, n, guild_name, period, failed=None, skipped=0):
+    leaderboard = "**Top {0} languages of {1} this {2}:**".format(n, guild_name, period)
+
+    for count, language in enumerate(itertools.islice(ranking, n), 1):
+        leaderboard += "\n**[{0}]** {1} - *{2}* ({3:.1%}, {4} coder{5})".format(
+            count, language['language'], format_duration(language['seconds']), language['share'],
+            language['users'], "" if language['users'] == 1 else "s")
+
+    if failed:
+        leaderboard += "\n*Couldn't get the latest stats of {0}, their older days still count.*".format(
+            format_names(failed))
+    if skipped:
+        leaderboard += format_skipped(skipped)
+
+    return leaderboard
+
+
+def format_skipped(skipped):
+    """
+    Formats the line that tells how many members were skipped while they wait out their failure backoff
+    """
+    return "\n*{0} member{1} temporarily unavailable after failing too often, retrying later.*".format(
+        skipped, "" if skipped == 1 else "s")
+
+
+def format_names(names):
+    """
+    Joins names for a message, only the first few of a long list are spelled out so the message stays short
+    """
+    shown = names[:constant.FAILED_NAMES_SHOWN]
+    if len(names) > len(shown):
+        return "{0} and {1} more".format(", ".join(shown), len(names) - len(shown))
+    return ", ".join(shown)
+
+
+def format_language_breakdown(languages, n):
+    """
+    Formats the n languages a user spent the most time on, with their share of the user's time
+
+    :param languages: Dictionary of language name -> seconds
+    :return: One line per language
+    """
+    total = sum(languages.values())
+    if not total:
+        return ""
+
+    top = sorted(languages.items(), key=lambda item: item[1], reverse=True)[:n]
+    return "\n".join("{0}: {1} ({2:.1%})".format(name, format_duration(seconds), seconds / total)
+                     for name, seconds in top if seconds)
+
+
+def range_dates(r, today):
+    """
+    Returns the first and last day of a time range as a tuple of dates,
+    or None if the range isn't made up of days we store (like all time)
+    """
+    if r == constant.TODAY:
+        return today, today
+    if r == constant.YESTERDAY:
+        yesterday = today - timedelta(days=1)
+        return yesterday, yesterday
+    if r == constant.WEEK:
+        return today - timedelta(days=6), today
+    if r == constant.MONTH:
+        return today.replace(day=1), today
+    if r == constant.SIX_MONTH:
+        return today - timedelta(days=constant.SIX_MONTH_DAYS - 1), today
+
+    return None
+
+
+def range_windows(ranges, today):
+    """
+    Returns the first and last day of every range that is made up of days we store,
+    as a dictionary of range -> (start, end). Other ranges are left out
+    """
+    windows = {}
+    for r in ranges:
+        dates = range_dates(r, today)
+        if dates is not None:
+            windows[r] = dates
+
+    return windows
+
+
+def days_to_fetch(stored_days, start, end, today):
+    """
+    Returns the days between start and end that have to be requested from wakatime.
+    That's every day that isn't stored yet, plus today and yesterday since they can still change
+    """
+    still_open = today - timedelta(days=1)
+
+    missing = []
+    day = start
+    while day <= end:
+        if day >= still_open or day not in stored_days:
+            missing.append(day)
+        day += timedelta(days=1)
+
+    return missing
+
+
+def project_day(day_json):
+    """
+    Keeps only what the bot uses out of a single day of a summaries response
+    """
+    languages = {}
+    for language in day_json.get('languages', []):
+        languages[language['name']] = language['total_seconds']
+
+    return {'day': date.fromisoformat(day_json['range']['date']),
+            'total_seconds': day_json['grand_total']['total_seconds'],
+            'languages': languages}
+
+
+def project_summaries(data):
+    """
+    Keeps only the days of a summaries response, each one cut down with project_day
+    """
+    if 'error' in data:
+        return data
+
+    return {'data': [project_day(day) for day in data.get('data', [])]}
+
+
+def aggregate_ranges(days, windows):
+    """
+    Sums up daily summaries into a UserSummary for every range, in a single pass over the days.
+    Each range gets its total, the seconds spent on every language, and the most used language of each of its days
+
+    :param days: Daily summaries as dictionaries with 'day', 'total_seconds' and 'languages' keys,
+                 see DbModel.get_daily_summaries
+    :param windows: Dictionary of range -> (first day, last day), see range_windows
+    :return: Dictionary of range -> UserSummary
+    """
+    totals = {r: 0 for r in windows}
+    languages = {r: {} for r in windows}
+    top_languages = {r: [] for r in windows}
+
+    for day in days:
+        day_languages = day['languages'] or {}
+        top = max(day_languages, key=day_languages.get) if day_languages else None
+
+        for r, (start, end) in windows.items():
+            if not start <= day['day'] <= end:
+                continue
+
+            totals[r] += day['total_seconds']
+            range_languages = languages[r]
+            for name, seconds in day_languages.items():
+                range_languages[name] = range_languages.get(name, 0) + seconds
+            if top is not None:
+                top_languages[r].append(top)
+
+    return {r: UserSummary(seconds=totals[r], text=format_duration(totals[r]),
+                           top_languages=tuple(top_languages[r]), languages=languages[r])
+            for r in windows}
+
+
+def format_duration(seconds):
+    """
+    Formats an amount of seconds the same way wakatime does, like "3 hrs 2 mins"
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return "{0} sec{1}".format(seconds, "" if seconds == 1 else "s")
+
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+
+    parts = []
+    if hours:
+        parts.append("{0} hr{1}".format(hours, "" if hours == 1 else "s"))
+    if minutes or not hours:
+        parts.append("{0} min{1}".format(minutes, "" if minutes == 1 else "s"))
+
+    return " ".join(parts)
@@ -0,0 +1,93 @@
+from aiohttp import web
+
+import metrics
+from auth import RequestFailed
+
+
+class WebServer:
+    """
+    An HTTP server that runs inside the bot's process, on the bot's event loop.
+    Routes have to be added before it's started
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.__runner__ = None
+
+        self.__complete_registration__ = None
+
+    async def start(self):
+        """
+        Starts listening. Does nothing if the server is already running.
+
+        :raise OSError: If it can't listen on its host and port
+        :return: Nothing
+        """
+        if self.__runner__ is not None:
+            return
+
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        self.__runner__ = runner
+
+    async def stop(self):
+        """
+        Stops listening and waits for the requests that are still being answered
+
+        :return: Nothing
+        """
+        if self.__runner__ is not None:
+            await self.__runner__.cleanup()
+            self.__runner__ = None
+
+    def add_metrics(self, path='/metrics'):
+        """
+        Serves every metric in the Prometheus text format. Only add it to a server that isn't reachable from outside
+
+        :param path: OPTIONAL parameter. The path to serve them on
+        :return: Nothing
+        """
+        self.app.router.add_get(path, self.__metrics__)
+
+    def add_oauth_callback(self, path, complete_registration):
+        """
+        Serves the page wakatime sends users to after they allowed the bot access
+
+        :param path: The path of the OAuth redirect URI
+        :param complete_registration: Coroutine function that takes the state and the code and returns the
+                                      registration, or None if the state is unknown. See Authorizer.complete_registration
+        :return: Nothing
+        """
+        self.__complete_registration__ = complete_registration
+        self.app.router.add_get(path, self.__oauth_callback__)
+
+    async def __oauth_callback__(self, request):
+        state = request.query.get('state')
+        code = request.query.get('code')
+        if request.query.get('error') or not state or not code:
+            # The user pressed deny, or someone opened the page by hand
+            return web.Response(status=400, text="Wakabot wasn't given access to your Wakatime account. "
+                                                 "Use !register in Discord to try again.")
+
+        try:
+            user = await self.__complete_registration__(state, code)
+        except RequestFailed as e:
+            print("Could not complete a registration: {}".format(e))
+            return web.Response(status=502, text="Wakatime didn't accept the registration. "
+                                                 "Use !register in Discord to try again.")
+
+        if user is None:
+            return web.Response(status=410, text="This registration link has expired or was already used. "
+                                                 "Use !register in Discord to get a new one.")
+
+        return web.Response(text="You're registered! Head back to Discord, your Wakatime stats "
+                                 "will show up in the server you registered in.")
+
+    async def __metrics__(self, request):
+        return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -1,20 +1,77 @@
+import asyncio
 import discord
+import math
 import os
+import time
+from datetime import date
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
-from discord.ext import commands
+from discord.ext import commands, tasks
 import DbModel
 from DbModel import WakaData
 import auth
+import command_scheduler
 import constant
 import json
 import data_parser
+import http_server
+import metrics
 
 
 
-class WakaBot(commands.Bot):
+def shard_options():
+    """
+    Works out which shards this process runs. By default discord decides how many shards the bot needs
+    and this process runs all of them. To split them over several processes, set SHARD_COUNT and
+    SHARD_IDS (like 0-3 or 0,2,4) in the environment of every process.
+    Every process shares the same database, and only refreshes the snapshots of its own guilds.
+
+    :return: The keyword arguments for AutoShardedBot
+    """
+    shard_count = os.getenv('SHARD_COUNT')
+    shard_ids = os.getenv('SHARD_IDS')
+    if not shard_ids:
+        return {'shard_count': int(shard_count)} if shard_count else {}
+
+    if not shard_count:
+        raise ValueError('SHARD_IDS needs SHARD_COUNT to be set too')
+
+    ids = []
+    for part in shard_ids.split(','):
+        first, _, last = part.strip().partition('-')
+        ids.extend(range(int(first), int(last or first) + 1))
+    return {'shard_count': int(shard_count), 'shard_ids': ids}
+
+
+class WakaBot(commands.AutoShardedBot):
     def __init__(self):
-        super().__init__(command_prefix='!', intents=intents)
+        super().__init__(command_prefix='!', intents=intents, **shard_options())
         self.authenticator = auth.Authorizer()
+        self.jobs = command_scheduler.CommandScheduler(constant.HEAVY_JOB_LIMIT, constant.HEAVY_JOB_MAX_WAITING,
+                                                       constant.HEAVY_JOB_ESTIMATE, constant.COMMAND_COOLDOWNS)
+        self.web_server = http_server.WebServer(os.getenv('WEB_HOST', constant.WEB_SERVER_HOST),
+                                                int(os.getenv('WEB_PORT', constant.WEB_SERVER_PORT)))
+        self.web_server.add_oauth_callback(urlsplit(self.authenticator.redirect_uri).path,
+                                           self.authenticator.complete_registration)
+        self.metrics_server = http_server.WebServer(os.getenv('METRICS_HOST', constant.METRICS_SERVER_HOST),
+                                                    int(os.getenv('METRICS_PORT', constant.METRICS_SERVER_PORT)))
+        self.metrics_server.add_metrics()
+
+        # Time every command from when its checks passed until it's done, failed or not
+        @self.before_invoke
+        async def start_command_timer(ctx):
+            ctx.started_at = time.perf_counter()
+            # Every command runs in its own task, so this only applies to the command and what it starts
+            if ctx.command.name in constant.HEAVY_COMMANDS:
+                command_scheduler.priority.set(command_scheduler.HEAVY)
+            else:
+                command_scheduler.priority.set(command_scheduler.INTERACTIVE)
+
+        @self.after_invoke
+        async def record_command_time(ctx):
+            command = ctx.command.qualified_name
+            metrics.observe('command_duration_seconds', time.perf_counter() - ctx.started_at, command=command)
+            metrics.inc('commands_total', command=command, outcome='error' if ctx.command_failed else 'ok')
 
         # Command to register user
         @self.command(name='register')
@@ -24,9 +81,10 @@ class WakaBot(commands.Bot):
             # initialize_user_data returns the record that was successfully created
             # If it didn't work, it returns None. So if it's not None, it worked.
             # OR, we check if the user is initialized in the database but NOT authenticated (meaning auth_token is None)
-            if not DbModel.is_user_authenticated(str(cmd_author), server_id):
+            if not await DbModel.run_async(DbModel.is_user_authenticated, str(cmd_author), server_id,
+                                           cmd_author.id):
                 # Get authorization url initializes the user's information in the auth state DB
-                url = self.authenticator.get_user_authorization_url(str(cmd_author), server_id)
+                url = await self.authenticator.get_user_authorization_url(str(cmd_author), server_id, cmd_author.id)
                 await cmd_author.send("Please visit {0} in your browser and allow Wakabot to access your Wakatime "
                                       "data. Once you've done that, you are ready to use Wakabot commands in the "
                                       "server you are registered in!".format(url));
@@ -78,13 +136,87 @@ class WakaBot(commands.Bot):
                 await ctx.message.reply("Sorry, I dont recognize **{0}** as a valid time range. Try `week`, `month`, or `alltime`!".format(r))
                 return
 
-            people = await data_parser.rank_all_users(self, ctx, range)
+            # Answers from the cache don't use up the cooldown, and neither do mistyped commands
+            live = data_parser.fetches_live(self, ctx.guild.id, range)
+            if live and not await self.__within_cooldown__(ctx):
+                return
+
+            try:
+                people, failed, skipped, age = await data_parser.rank_all_users(self, ctx, range)
+            except command_scheduler.Busy as e:
+                if live:
+                    # Nothing was fetched, retrying when the bot says so shouldn't run into the cooldown
+                    self.jobs.refund_cooldown(ctx.command.name, ctx.message)
+                await self.__reply_busy__(ctx, e)
+                return
 
-            board = data_parser.format_leaderboard(people, n, ctx.guild.name)
-            
-            await ctx.message.reply(board)
+            board = data_parser.format_leaderboard(people, n, ctx.guild.name, failed, age, skipped)
+
+            with metrics.span('message_send', guild_size=metrics.size_bucket(len(people) + len(failed))):
+                await ctx.message.reply(board)
             
         
+        # Languages the whole server codes in
+        @self.command(name='toplang')
+        async def language_leaderboard(ctx, *args):
+            """
+            Prints the languages the server spent the most time on
+            args[0]: range (week, month, sixmonths)
+            args[1]: amount of languages to print
+            """
+            await ctx.channel.trigger_typing()
+
+            if len(args) == 0:
+                await ctx.message.reply("Invalid command syntax, try: `!toplang <range>`")
+                return
+
+            if len(args) == 1:
+                n = constant.LANGUAGE_LEADERBOARD_SIZE
+            else:
+                try:
+                    n = int(args[1])
+                except ValueError:
+                    await ctx.message.reply("Sorry, I dont recognize **{0}** as a valid number.".format(args[1]))
+                    return
+
+            r = args[0]
+
+            if r == 'week' or r == 'weekly':
+                range = constant.WEEK
+                r = "week"
+            elif r == 'month' or r == 'monthly':
+                range = constant.MONTH
+                r = "month"
+            elif r == 'sixmonths' or r == '6months':
+                range = constant.SIX_MONTH
+                r = "half year"
+            else:
+                # All time stats don't have languages
+                print("{0} is not an acceptable time range for !toplang, command failed.".format(r))
+                await ctx.message.reply("Sorry, I dont recognize **{0}** as a valid time range. Try `week`, `month`, or `sixmonths`!".format(r))
+                return
+
+            # Answers from the cache don't use up the cooldown, and neither do mistyped commands
+            live = data_parser.fetches_live(self, ctx.guild.id, range, languages=True)
+            if live and not await self.__within_cooldown__(ctx):
+                return
+
+            try:
+                ranking, failed, skipped = await data_parser.rank_languages(self, ctx, range)
+            except command_scheduler.Busy as e:
+                if live:
+                    # Nothing was fetched, retrying when the bot says so shouldn't run into the cooldown
+                    self.jobs.refund_cooldown(ctx.command.name, ctx.message)
+                await self.__reply_busy__(ctx, e)
+                return
+            if not ranking:
+                await ctx.message.reply("Nobody in {0} has coded this {1} yet!".format(ctx.guild.name, r))
+                return
+
+            board = data_parser.format_language_leaderboard(ranking, n, ctx.guild.name, r, failed, skipped)
+            with metrics.span('message_send', guild_size=metrics.size_bucket(len(ranking))):
+                await ctx.message.reply(board[:2000])
+
         # HANDLES ALL INDIVIDUAL STAT ARGS
         @self.command(name='stats')
         async def stats(ctx, r, user: discord.Member):
@@ -114,24 +246,24 @@ class WakaBot(commands.Bot):
                 return
 
             # Check user is registered and in database
-            if DbModel.is_user_authenticated(user, ctx.guild.id) is False:
+            if await DbModel.run_async(DbModel.is_user_authenticated, str(user), ctx.guild.id, user.id) is False:
                 await ctx.message.reply("Sorry, I can't find {0} in my database. If they have a Wakatime account, they can use the command: `!register` to start that process.".format(user.nick))
                 return
         
-            stats = self.authenticator.get_wakatime_user_json(user, ctx.guild.id, range)
+            stats = await self.authenticator.async_get_wakatime_user_json(str(user), ctx.guild.id, range, user.id)
 
-            if stats is None or 'error' in stats:
+            if stats is None or stats.error is not None:
                 await ctx.message.reply("Sorry, there was an error! Make sure you've installed the wakatime extension on your IDEs and are registered!")
                 return
             
             # Top language is not included in alltime stats. Different json formats too
             if range == constant.ALL_TIME:
-                start = stats['data']['range']['start_text']
+                start = stats.start_text
                 start = start[4:] # Cut off the weekday, I dont like it there
-                time = stats['data']['text']
+                time = stats.text
                 lang = 'None'
             else:
-                time = stats['cummulative_total']['text']
+                time = stats.text
                 lang = data_parser.most_used_language(stats)
 
             # Print results
@@ -141,7 +273,37 @@ class WakaBot(commands.Bot):
             elif lang == "None":
                 await ctx.message.reply("**{0}** has coded for **{1}** since **{2}**".format(user.nick, time, start))
             else:
-                await ctx.message.reply("**{0}** has coded for **{1}** this {2} \nMost used language: {3}".format(user.nick, time, r, lang))
+                message = "**{0}** has coded for **{1}** this {2} \nMost used language: {3}".format(user.nick, time, r, lang)
+                breakdown = data_parser.format_language_breakdown(stats.languages, constant.LANGUAGE_BREAKDOWN_SIZE)
+                if breakdown:
+                    message += "\n" + breakdown
+                await ctx.message.reply(message)
+
+        # Shows where the bot spends its time. Only for the bot's owner since it covers every server
+        @self.command(name='botstats')
+        @commands.is_owner()
+        async def botstats(ctx):
+            def row(labels, count, total, p50, p95):
+                name = ' '.join(str(value) for value in labels.values())
+                return "{:<34} {:>6} {:>9.3f} {:>9.3f} {:>9.1f}".format(name[:34], count, p50, p95, total)
+
+            header = "{:<34} {:>6} {:>9} {:>9} {:>9}".format('', 'count', 'p50 (s)', 'p95 (s)', 'total (s)')
+            sections = [("Commands", 'command_duration_seconds'),
+                        ("Phases", 'phase_duration_seconds'),
+                        ("Heavy job queue", 'job_queue_wait_seconds'),
+                        ("HTTP requests", 'http_request_duration_seconds'),
+                        ("DB queries", 'db_query_duration_seconds')]
+
+            lines = ["Up for {:.0f} minutes".format((time.time() - metrics.started_at) / 60)]
+            for title, name in sections:
+                lines += ["", title, header] + [row(*summary) for summary in metrics.summarize(name)[:8]]
+
+            statuses = sorted(metrics.counter_values('http_responses_total'), key=lambda item: -item[1])
+            lines += ["", "HTTP statuses"] + ["{endpoint} {status}: ".format(**labels) + str(value)
+                                               for labels, value in statuses[:8]]
+
+            # Discord messages are limited to 2000 characters
+            await ctx.message.reply("```\n{}\n```".format("\n".join(lines)[:1980]))
 
         # ME TRYING TO HANDLE THE ERROR OF NOT HAVING ENOUGH ARGS IN STATS
         @stats.error
@@ -150,21 +312,177 @@ class WakaBot(commands.Bot):
             if isinstance(error, commands.MissingRequiredArgument):
                 await ctx.message.reply('You didn\'t type enough parameters, try `!stats <range> <@user>`')
 
+    async def __within_cooldown__(self, ctx):
+        """
+        Uses up the cooldowns of the command, or tells the user how long to wait if one is still running
+
+        :return: True if the command can go ahead
+        """
+        retry_after = self.jobs.retry_after_cooldown(ctx.command.name, ctx.message)
+        if retry_after is None:
+            return True
+
+        await ctx.message.reply("Slow down! `!{0}` can fetch new stats again in {1} seconds.".format(
+            ctx.command.name, math.ceil(retry_after)))
+        return False
+
+    async def __reply_busy__(self, ctx, busy):
+        await ctx.message.reply("I'm busy with other leaderboards right now, try again in {0} seconds!".format(
+            busy.retry_after))
+
     # Overridden method
     # Called when bot successfully logs onto server
     async def on_ready(self):
-        print('We have logged in as {0.user}'.format(client))
+        # on_ready can fire again after a reconnect, open_session won't open a second session
+        await self.authenticator.open_session()
+        await self.backfill_discord_ids()
+        if not self.refresh_snapshots.is_running():
+            self.refresh_snapshots.start()
+        if not self.notify_deactivated_users.is_running():
+            self.notify_deactivated_users.start()
+        if not self.sweep_authentication_states.is_running():
+            self.sweep_authentication_states.start()
+        print('We have logged in as {0.user}, running shards {1}'.format(self, self.shard_ids or 'all'))
+
+    async def backfill_discord_ids(self):
+        """
+        Stores the discord ids of registrations made before ids were stored, for every user the member caches
+        can find by name. Registrations are looked up by id, so a user who renames themselves stays one registration
+        """
+        registrations = await DbModel.run_async(DbModel.get_registrations_without_discord_id,
+                                                [guild.id for guild in self.guilds])
+        id_updates = []
+        for discord_username, server_id in registrations:
+            guild = self.get_guild(server_id)
+            member = guild.get_member_named(discord_username) if guild is not None else None
+            if member is not None:
+                id_updates.append((discord_username, server_id, member.id))
+
+        await DbModel.run_async(DbModel.update_discord_ids, id_updates)
+        if id_updates:
+            print("Stored the discord ids of {} registrations".format(len(id_updates)))
+
+    # Overridden method
+    # Called by run() before connecting to discord. The web servers start first, so a bot that can't
+    # complete registrations stops right away instead of running without them
+    async def start(self, *args, **kwargs):
+        for attempt in range(1, constant.WEB_SERVER_BIND_ATTEMPTS + 1):
+            try:
+                await self.web_server.start()
+                break
+            except OSError as e:
+                if attempt == constant.WEB_SERVER_BIND_ATTEMPTS:
+                    raise
+                print("Could not start the web server (attempt {}), retrying: {}".format(attempt, e))
+                await asyncio.sleep(constant.WEB_SERVER_BIND_RETRY_DELAY)
+
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            # The bot still works without it, only /metrics is missing
+            print("Could not start the metrics server: {}".format(e))
+
+        await super().start(*args, **kwargs)
+
+    # Overridden method
+    # Called when the bot shuts down
+    async def close(self):
+        self.refresh_snapshots.cancel()
+        self.notify_deactivated_users.cancel()
+        self.sweep_authentication_states.cancel()
+        await self.web_server.stop()
+        await self.metrics_server.stop()
+        await self.authenticator.close_session()
+        await super().close()
+
+    # Precomputes leaderboards in the background so !top doesn't have to wait for wakatime
+    @tasks.loop(seconds=constant.SNAPSHOT_INTERVAL)
+    async def refresh_snapshots(self):
+        # Commands go first, snapshots are only a shortcut for them
+        command_scheduler.priority.set(command_scheduler.BACKGROUND)
+        server_ids = await DbModel.run_async(DbModel.get_servers_with_authenticated_users)
+        # Skip servers the bot isn't in anymore
+        server_ids = [server_id for server_id in server_ids if self.get_guild(server_id) is not None]
+
+        # Stalest servers first, servers without a snapshot before everything else.
+        # Only a few per cycle so the load is spread out over time
+        def snapshot_age(server_id):
+            age = self.authenticator.snapshots.age((server_id, constant.LEADERBOARD_RANGES[0]))
+            return float('inf') if age is None else age
+
+        server_ids.sort(key=snapshot_age, reverse=True)
+
+        for server_id in server_ids[:constant.SNAPSHOT_SERVERS_PER_CYCLE]:
+            try:
+                await data_parser.refresh_server_snapshots(self, server_id)
+            except Exception as e:
+                # Don't let one server stop the loop
+                print("Could not refresh the snapshots of server {}: {}".format(server_id, repr(e)))
 
+    @refresh_snapshots.before_loop
+    async def before_refresh_snapshots(self):
+        await self.wait_until_ready()
 
-# Load secrets file and get token
-load_dotenv('secrets.env')
-API_TOKEN = os.getenv('DISCORD_TOKEN')
+    # Tells users once that their registration was deactivated because wakatime kept refusing their tokens
+    @tasks.loop(seconds=constant.DEACTIVATION_NOTIFY_INTERVAL)
+    async def notify_deactivated_users(self):
+        server_ids = [guild.id for guild in self.guilds]
+        users = await DbModel.run_async(DbModel.get_unnotified_deactivated_users, server_ids)
+
+        for user in users:
+            guild = self.get_guild(user.server_id)
+            if guild is None:
+                continue
+
+            # Claimed before sending, so no other bot process sends it too
+            if not await DbModel.run_async(DbModel.claim_notification, user.discord_username, user.server_id):
+                continue
+
+            try:
+                if user.discord_id is not None:
+                    member = self.get_user(user.discord_id) or await self.fetch_user(user.discord_id)
+                else:
+                    member = guild.get_member_named(user.discord_username)
+                if member is None:
+                    continue
+
+                await member.send("I haven't been able to get your Wakatime stats in **{0}** for a while, it looks "
+                                  "like Wakabot's access to your Wakatime account was revoked. Use `!register` in "
+                                  "**{0}** to show up on its leaderboards again!".format(guild.name))
+            except discord.HTTPException as e:
+                # Users can turn off DMs from server members, they'll notice they're missing from the leaderboard
+                print("Could not notify {} about their deactivated registration: {}".format(user.discord_username, e))
+
+    @notify_deactivated_users.before_loop
+    async def before_notify_deactivated_users(self):
+        await self.wait_until_ready()
+
+    # Deletes registrations that were started with !register but never finished,
+    # and the stored days that are too old for any range made up of days
+    @tasks.loop(seconds=constant.AUTH_STATE_SWEEP_INTERVAL)
+    async def sweep_authentication_states(self):
+        deleted = await DbModel.run_async(DbModel.delete_expired_authentication_states)
+        if deleted:
+            print("Deleted {} expired registrations".format(deleted))
+
+        # SIX_MONTH is answered from stored days too, so that's how far back they're kept, not just the covering ranges
+        oldest = min(start for start, _ in data_parser.range_windows(constant.DAY_RANGES, date.today()).values())
+        deleted = await DbModel.run_async(DbModel.delete_daily_summaries_before, oldest)
+        if deleted:
+            print("Deleted {} daily summaries from before {}".format(deleted, oldest))
 
-DbModel.init_tables()
 
 intents = discord.Intents.default()
 intents.members = True
 
-client = WakaBot()
-client.run(API_TOKEN)
-DbModel.db.close()
\ No newline at end of file
+# The fetch workers import this module too, they must not start another bot
+if __name__ == '__main__':
+    # Load secrets file and get token
+    load_dotenv('secrets.env')
+    API_TOKEN = os.getenv('DISCORD_TOKEN')
+
+    DbModel.migrate_schema()
+
+    client = WakaBot()
+    client.run(API_TOKEN)
+    DbModel.shutdown()
\ No newline at end of file
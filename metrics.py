@@ -0,0 +1,211 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets, the last bucket catches everything above them
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Counters keyed by (name, labels), where labels is a sorted tuple of (label, value) pairs
+counters = defaultdict(int)
+# Histograms keyed the same way as counters
+histograms = {}
+# Functions that return the current value of a gauge, keyed the same way as counters
+gauges = {}
+
+started_at = time.time()
+
+# DB calls record their metrics from the executor threads
+__lock__ = threading.Lock()
+
+
+class Histogram:
+    """
+    Counts how many observed values fall in each of the BUCKETS
+    """
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimates a quantile the same way Prometheus' histogram_quantile does,
+        by assuming values are spread evenly inside their bucket
+
+        :param q: The quantile, between 0 and 1
+        :return: The estimated value, None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[i - 1] if i else 0.0
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / count
+            seen += count
+
+        return BUCKETS[-1]
+
+
+def inc(name, amount=1, **labels):
+    """
+    Increments a counter
+
+    :param name: The name of the counter, e.g. 'requests_coalesced_total'
+    :param amount: OPTIONAL parameter. How much to increment the counter by
+    :param labels: OPTIONAL parameter. Labels that tell apart counters with the same name
+    :return: Nothing
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with __lock__:
+        counters[key] += amount
+
+
+def get(name, **labels):
+    """
+    Gets the current value of a counter, 0 if it was never incremented
+    """
+    return counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def observe(name, value, **labels):
+    """
+    Records a value, usually a duration in seconds, in a histogram
+
+    :param name: The name of the histogram, e.g. 'command_duration_seconds'
+    :param value: The value to record
+    :param labels: OPTIONAL parameter. Labels that tell apart histograms with the same name
+    :return: Nothing
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with __lock__:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def gauge(name, function, **labels):
+    """
+    Registers a gauge, a value that goes up and down like a queue depth. It's read whenever the metrics are rendered
+
+    :param name: The name of the gauge, e.g. 'job_queue_depth'
+    :param function: Function without arguments that returns the current value
+    :param labels: OPTIONAL parameter. Labels that tell apart gauges with the same name
+    :return: Nothing
+    """
+    with __lock__:
+        gauges[(name, tuple(sorted(labels.items())))] = function
+
+
+@contextmanager
+def span(phase, **labels):
+    """
+    Times the code inside the with block as a phase, e.g. with metrics.span('token_refresh'):
+    Works the same in coroutines, the time spent waiting inside the block counts too
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('phase_duration_seconds', time.perf_counter() - start, phase=phase, **labels)
+
+
+def summarize(name):
+    """
+    Summarizes every histogram with a name
+
+    :param name: The name of the histograms, e.g. 'phase_duration_seconds'
+    :return: A list of (labels as a dictionary, count, sum, p50, p95) tuples, the ones with the largest sum first
+    """
+    with __lock__:
+        result = [(dict(labels), h.count, h.sum, h.quantile(0.5), h.quantile(0.95))
+                  for (histogram_name, labels), h in histograms.items() if histogram_name == name]
+    return sorted(result, key=lambda row: row[2], reverse=True)
+
+
+def counter_values(name):
+    """
+    :return: A list of (labels as a dictionary, value) tuples of every counter with a name
+    """
+    with __lock__:
+        return [(dict(labels), value) for (counter_name, labels), value in counters.items() if counter_name == name]
+
+
+def size_bucket(size):
+    """
+    Turns a guild size into a label. Exact sizes would make a histogram per guild
+    """
+    for bound in (10, 100, 1000, 10000):
+        if size < bound:
+            return '<{}'.format(bound)
+    return '10000+'
+
+
+def __format_labels__(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+
+    escaped = []
+    for label, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(label, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+def render():
+    """
+    Renders every counter and histogram in the Prometheus text format
+
+    :return: The metrics as a string
+    """
+    with __lock__:
+        # Sorted by name only, label values can be of different types
+        counter_items = sorted(counters.items(), key=lambda item: item[0][0])
+        histogram_items = sorted(((key, (list(h.counts), h.sum, h.count)) for key, h in histograms.items()),
+                                 key=lambda item: item[0][0])
+        gauge_items = sorted(gauges.items(), key=lambda item: item[0][0])
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {} counter'.format(name))
+        lines.append('{}{} {}'.format(name, __format_labels__(labels), value))
+
+    for (name, labels), (counts, total, count) in histogram_items:
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {} histogram'.format(name))
+
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += bucket
+            lines.append('{}_bucket{} {}'.format(name, __format_labels__(labels, [('le', bound)]), cumulative))
+        lines.append('{}_sum{} {}'.format(name, __format_labels__(labels), total))
+        lines.append('{}_count{} {}'.format(name, __format_labels__(labels), count))
+
+    for (name, labels), function in gauge_items:
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{}{} {}'.format(name, __format_labels__(labels), function()))
+
+    lines.append('# TYPE process_uptime_seconds gauge')
+    lines.append('process_uptime_seconds {}'.format(time.time() - started_at))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,113 @@
+"""
+Benchmarks the queries the bot runs against a synthetic database, before and after the lookup indexes migration.
+Runs against a throwaway SQLite file so it doesn't need MySQL.
+
+Usage (from the repository root):
+    python scripts/bench_indexes.py [--rows 100000] [--servers 1000] [--queries 200]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+# DbModel picks its backend when it's imported
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = DB_FILE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import DbModel
+from DbModel import WakaData, AuthenticationState, db
+
+# The migration that adds the lookup indexes
+INDEX_MIGRATION = DbModel.MIGRATIONS.index(DbModel.__add_lookup_indexes__) + 1
+
+
+def populate(rows, servers):
+    """
+    Fills the database with rows registrations spread over servers servers.
+    Roughly one in ten registrations never finished, so it has no access token.
+    """
+    registrations = []
+    states = []
+    for i in range(rows):
+        authenticated = random.random() > 0.1
+        registrations.append({'discord_username': 'user{}#{:04d}'.format(i, i % 10000),
+                              'server_id': random.randrange(servers),
+                              'auth_token': 'sec_{:032x}'.format(random.getrandbits(128)) if authenticated else None,
+                              'refresh_token': 'ref_{:032x}'.format(random.getrandbits(128))})
+        states.append({'discord_username': registrations[-1]['discord_username'],
+                       'server_id': registrations[-1]['server_id'],
+                       'state': '{:040x}'.format(random.getrandbits(160))})
+
+    db.connect(reuse_if_open=True)
+    with db.atomic():
+        for start in range(0, rows, 500):
+            WakaData.insert_many(registrations[start:start + 500]).execute()
+            AuthenticationState.insert_many(states[start:start + 500]).execute()
+    db.close()
+
+    return registrations, states
+
+
+def time_query(name, run, arguments):
+    """
+    Runs a query once per argument and returns the average time in milliseconds
+    """
+    db.connect(reuse_if_open=True)
+    start = time.perf_counter()
+    for argument in arguments:
+        run(argument)
+    elapsed = (time.perf_counter() - start) * 1000 / len(arguments)
+    db.close()
+    return name, elapsed
+
+
+def run_queries(registrations, states, servers, queries):
+    sample = random.sample(registrations, queries)
+    server_ids = [random.randrange(servers) for _ in range(queries)]
+    state_sample = random.sample(states, queries)
+
+    return [
+        time_query('wakadata by refresh_token', lambda row: list(
+            WakaData.select().where(WakaData.refresh_token == row['refresh_token'])), sample),
+        time_query('authenticated users of a server', lambda server_id: list(
+            WakaData.select().where((WakaData.server_id == server_id) & (~WakaData.auth_token >> None))), server_ids),
+        time_query('unauthenticated user by name', lambda row: list(
+            WakaData.select().where((WakaData.discord_username == row['discord_username']) &
+                                    (WakaData.auth_token >> None))), sample),
+        time_query('servers with authenticated users', lambda _: list(
+            WakaData.select(WakaData.server_id).where(~WakaData.auth_token >> None).distinct()), server_ids[:5]),
+        time_query('authentication state by state', lambda row: list(
+            AuthenticationState.select().where(AuthenticationState.state == row['state'])), state_sample),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(1)
+    DbModel.migrate_schema(target_version=INDEX_MIGRATION - 1)
+    print("Inserting {} rows...".format(args.rows))
+    registrations, states = populate(args.rows, args.servers)
+
+    before = run_queries(registrations, states, args.servers, args.queries)
+    DbModel.migrate_schema(target_version=INDEX_MIGRATION)
+    after = run_queries(registrations, states, args.servers, args.queries)
+
+    print("\n{:<36} {:>12} {:>12} {:>9}".format('query', 'before (ms)', 'after (ms)', 'speedup'))
+    for (name, old), (_, new) in zip(before, after):
+        print("{:<36} {:>12.3f} {:>12.3f} {:>8.1f}x".format(name, old, new, old / new if new else float('inf')))
+
+    DbModel.shutdown()
+    os.remove(DB_FILE)
+
+
+if __name__ == '__main__':
+    main()
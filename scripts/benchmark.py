@@ -0,0 +1,350 @@
+"""
+Benchmarks the leaderboard against scripts/fake_wakatime.py, so it runs offline and doesn't touch the real API.
+Times Authorizer.async_get_all_wakatime_users_json and data_parser.rank_all_users for guilds of different
+sizes and writes a JSON report with p50/p95/p99 latency, HTTP calls, DB round trips and peak memory.
+
+Every run starts with empty in memory caches. Cold runs also start from freshly registered users
+(expired tokens, no stored daily summaries, no cached responses), warm runs keep what the previous runs
+stored in the database and the response cache.
+
+The production request rate limit would make big guilds take minutes, so it's raised with --rate.
+Pass --rate 0 to benchmark with the production limits.
+
+Usage (from the repository root):
+    python scripts/benchmark.py [--sizes 10,100,1000,5000] [--iterations 3] [--range last_7_days]
+                                [--output benchmark-report.json] [--rate 1000] [--expired 0.1]
+                                [--latency 0.05] [--jitter 0.02] [--error-rate 0] [--rate-limit 0] [--languages 5]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+import aiohttp
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# DbModel and auth read their configuration when they're imported. The fetch workers import this
+# script again, they find the database through the environment they inherited
+if 'BENCHMARK_DB' not in os.environ:
+    os.environ['BENCHMARK_DB'] = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+DB_FILE = os.environ['BENCHMARK_DB']
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = DB_FILE
+os.environ['HTTP_CACHE_DIR'] = os.path.join(os.path.dirname(DB_FILE), 'http-cache')
+
+sys.path.insert(0, os.path.join(SCRIPTS, '..'))
+sys.path.insert(0, SCRIPTS)
+import constant
+import DbModel
+import data_parser
+from auth import Authorizer, RequestScheduler
+from cache import ResponseCache
+from command_scheduler import CommandScheduler
+from fake_wakatime import make_token
+
+
+class Member:
+    def __init__(self, member_id, name):
+        self.id = member_id
+        self.name = name
+        self.display_name = name
+
+
+class Guild:
+    """
+    Just enough of a discord.Guild for rank_all_users
+    """
+    def __init__(self, guild_id, members):
+        self.id = guild_id
+        self.name = 'Guild of {}'.format(len(members))
+        self.__members__ = {member.id: member for member in members}
+        self.__named__ = {member.name: member for member in members}
+
+    def get_member(self, member_id):
+        return self.__members__.get(member_id)
+
+    def get_member_named(self, name):
+        return self.__named__.get(name)
+
+    async def query_members(self, user_ids, limit=5):
+        return [self.__members__[member_id] for member_id in user_ids[:limit] if member_id in self.__members__]
+
+
+class Context:
+    def __init__(self, guild):
+        self.guild = guild
+
+
+class Bot:
+    def __init__(self, authenticator):
+        self.authenticator = authenticator
+        self.jobs = CommandScheduler(constant.HEAVY_JOB_LIMIT, constant.HEAVY_JOB_MAX_WAITING,
+                                     constant.HEAVY_JOB_ESTIMATE, constant.COMMAND_COOLDOWNS)
+
+
+class CountingDatabase:
+    """
+    Counts the queries sent to the database, from every thread
+    """
+    def __init__(self, db):
+        self.count = 0
+        self.__lock__ = threading.Lock()
+        self.__execute_sql__ = db.execute_sql
+        db.execute_sql = self.execute_sql
+
+    def execute_sql(self, *args, **kwargs):
+        with self.__lock__:
+            self.count += 1
+        return self.__execute_sql__(*args, **kwargs)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_wakatime(port, args):
+    command = [sys.executable, os.path.join(SCRIPTS, 'fake_wakatime.py'), '--port', str(port),
+               '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+               '--rate-limit', str(args.rate_limit), '--languages', str(args.languages)]
+    server = subprocess.Popen(command)
+
+    # Wait until it accepts connections
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError('The fake wakatime server did not start')
+
+
+async def http_calls(session, site_url, reset=False):
+    """
+    Gets the requests the fake server answered since the last reset
+    """
+    async with session.get(site_url + '/_stats') as response:
+        calls = Counter()
+        for row in await response.json():
+            calls['{} {}'.format(row['endpoint'], row['status'])] += row['count']
+    if reset:
+        async with session.post(site_url + '/_reset'):
+            pass
+    return calls
+
+
+def register_users(server_id, size, expired):
+    """
+    Replaces the registrations of a guild with size freshly registered users.
+    The first expired fraction of them have tokens that need a refresh before use
+    """
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    rows = []
+    for i in range(size):
+        account = 'acct{}x{}'.format(server_id, i)
+        rows.append({'discord_username': 'user{}#{:04d}'.format(i, i % 10000),
+                     'discord_id': server_id * 100000 + i,
+                     'server_id': server_id,
+                     'auth_token': make_token('sec', account),
+                     'refresh_token': make_token('ref', account),
+                     'expires_at': None if i < size * expired else expires_at})
+
+    db = DbModel.db
+    db.connect(reuse_if_open=True)
+    with db.atomic():
+        DbModel.WakaData.delete().where(DbModel.WakaData.server_id == server_id).execute()
+        DbModel.DailySummary.delete().execute()
+        DbModel.DailyLanguage.delete().execute()
+        for start in range(0, len(rows), 500):
+            DbModel.WakaData.insert_many(rows[start:start + 500]).execute()
+    db.close()
+
+    return Guild(server_id, [Member(row['discord_id'], row['discord_username']) for row in rows])
+
+
+def clear_caches(authenticator):
+    authenticator.leaderboard_cache.invalidate_where(lambda key: True)
+    authenticator.snapshots.discard_where(lambda key: True)
+    authenticator.account_results.invalidate_where(lambda key: True)
+    with DbModel.record_cache_lock:
+        DbModel.record_cache.invalidate_where(lambda key: True)
+
+
+def clear_response_cache(authenticator):
+    if authenticator.response_cache is not None:
+        shutil.rmtree(authenticator.response_cache.directory, ignore_errors=True)
+        authenticator.response_cache = ResponseCache(authenticator.response_cache.directory,
+                                                     authenticator.response_cache.max_bytes)
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+async def run_operation(bot, guild, operation, time_range):
+    """
+    Runs one leaderboard operation and returns how many users couldn't be retrieved
+    """
+    if operation == 'fetch':
+        results = await bot.authenticator.async_get_all_wakatime_users_json(guild.id, time_range)
+        return sum(1 for result in results if result[1].error is not None)
+
+    _, failed, _, _ = await data_parser.rank_all_users(bot, Context(guild), time_range)
+    return len(failed)
+
+
+async def benchmark_cell(bot, counter, session, site_url, size, operation, state, args):
+    """
+    Runs an operation args.iterations times on a guild of size users, plus once more to measure memory
+    """
+    server_id = size
+    guild = register_users(server_id, size, args.expired)
+    clear_response_cache(bot.authenticator)
+    if state == 'warm':
+        # Fill the database the same way the bot would have before
+        clear_caches(bot.authenticator)
+        await run_operation(bot, guild, operation, args.range)
+
+    latencies = []
+    calls = Counter()
+    round_trips = 0
+    failures = 0
+
+    for iteration in range(args.iterations + 1):
+        if state == 'cold':
+            guild = register_users(server_id, size, args.expired)
+            clear_response_cache(bot.authenticator)
+        clear_caches(bot.authenticator)
+        await http_calls(session, site_url, reset=True)
+        queries = counter.count
+
+        # The last run is traced, tracemalloc slows everything down too much to time it
+        traced = iteration == args.iterations
+        if traced:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        failed = await run_operation(bot, guild, operation, args.range)
+        elapsed = time.perf_counter() - start
+
+        if traced:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            continue
+
+        latencies.append(elapsed * 1000)
+        calls += await http_calls(session, site_url)
+        round_trips += counter.count - queries
+        failures += failed
+
+    return {'guild_size': size,
+            'operation': operation,
+            'state': state,
+            'iterations': args.iterations,
+            'latency_ms': {'p50': percentile(latencies, 50),
+                           'p95': percentile(latencies, 95),
+                           'p99': percentile(latencies, 99),
+                           'mean': sum(latencies) / len(latencies),
+                           'max': max(latencies)},
+            'http_calls': sum(calls.values()) / args.iterations,
+            'http_calls_by_endpoint': {key: count / args.iterations for key, count in sorted(calls.items())},
+            'db_round_trips': round_trips / args.iterations,
+            'failed_users': failures / args.iterations,
+            'peak_memory_bytes': peak_memory}
+
+
+async def run(args, site_url):
+    bot = Bot(Authorizer())
+    if args.rate:
+        bot.authenticator.scheduler = RequestScheduler(max_concurrency=constant.HTTP_MAX_CONCURRENCY,
+                                                       max_concurrency_per_host=constant.HTTP_MAX_CONCURRENCY_PER_HOST,
+                                                       rate=args.rate,
+                                                       burst=args.rate,
+                                                       max_retries=constant.HTTP_MAX_RETRIES,
+                                                       backoff_base=constant.HTTP_BACKOFF_BASE,
+                                                       backoff_max=constant.HTTP_BACKOFF_MAX,
+                                                       attempt_timeout=constant.HTTP_REQUEST_TIMEOUT,
+                                                       deadline=constant.HTTP_REQUEST_DEADLINE)
+    counter = CountingDatabase(DbModel.db)
+    await bot.authenticator.open_session()
+
+    results = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            for size, operation, state in itertools.product(args.sizes, ['fetch', 'rank'], ['cold', 'warm']):
+                result = await benchmark_cell(bot, counter, session, site_url, size, operation, state, args)
+                results.append(result)
+                print("{:>6} {:<6} {:<5} p50 {:>9.1f} ms  p95 {:>9.1f} ms  p99 {:>9.1f} ms  {:>7.0f} HTTP  "
+                      "{:>6.0f} DB  {:>7.1f} MiB  {:>5.0f} failed".format(
+                        size, operation, state, result['latency_ms']['p50'], result['latency_ms']['p95'],
+                        result['latency_ms']['p99'], result['http_calls'], result['db_round_trips'],
+                        result['peak_memory_bytes'] / 2 ** 20, result['failed_users']))
+    finally:
+        await bot.authenticator.close_session()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000,5000', help='comma separated guild sizes')
+    parser.add_argument('--iterations', type=int, default=3, help='timed runs per guild size and operation')
+    parser.add_argument('--range', default=constant.WEEK, help='time range of the leaderboard')
+    parser.add_argument('--output', default='benchmark-report.json')
+    parser.add_argument('--rate', type=float, default=1000, help='requests per second, 0 for the production limit')
+    parser.add_argument('--expired', type=float, default=0.1, help='fraction of users whose token needs a refresh')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0)
+    parser.add_argument('--languages', type=int, default=5)
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+
+    port = free_port()
+    site_url = 'http://127.0.0.1:{}'.format(port)
+    os.environ['WAKA_SITE_URL'] = site_url
+    server = start_fake_wakatime(port, args)
+
+    try:
+        DbModel.migrate_schema()
+        results = asyncio.run(run(args, site_url))
+    finally:
+        server.terminate()
+        server.wait()
+        DbModel.shutdown()
+        os.remove(DB_FILE)
+        shutil.rmtree(os.environ['HTTP_CACHE_DIR'], ignore_errors=True)
+
+    report = {'created_at': datetime.utcnow().isoformat() + 'Z',
+              'python': platform.python_version(),
+              'config': {key: value for key, value in vars(args).items() if key != 'output'},
+              'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print("Report written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
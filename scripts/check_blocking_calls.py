@@ -0,0 +1,159 @@
+"""
+Regression check that makes sure no synchronous HTTP call can be made from the bot's coroutines.
+A blocking request inside a command freezes the event loop for every guild until it finishes.
+
+Usage (from the repository root):
+    python scripts/check_blocking_calls.py
+
+Exits with status 1 and prints every offending call if one is found.
+"""
+import ast
+import glob
+import os
+import sys
+
+# Modules that only do blocking HTTP
+BLOCKING_MODULES = {'requests', 'urllib', 'urllib3', 'http'}
+
+# rauth methods that do a blocking request under the hood
+BLOCKING_METHODS = {'get_raw_access_token', 'get_access_token', 'get_auth_session', 'get_session'}
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def __call_name__(call):
+    """
+    Gets the dotted name of a call, e.g. 'requests.get' or 'self.service.get_raw_access_token'
+    """
+    parts = []
+    node = call.func
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+
+def __is_blocking__(name):
+    parts = name.split('.')
+    return parts[0] in BLOCKING_MODULES or parts[-1] in BLOCKING_METHODS
+
+
+def __bot_modules__():
+    """
+    :return: The file names of every module of the bot, all of them can end up running on the event loop
+    """
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(ROOT, '*.py')))
+
+
+def __index_functions__(tree):
+    """
+    Finds every function and method of a module
+
+    :return: A dictionary of name -> list of function nodes. Methods of different classes can share a name
+    """
+    functions = {}
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions.setdefault(node.name, []).append(node)
+    return functions
+
+
+def __imports__(tree, modules):
+    """
+    Finds what the names a module imports from other bot modules refer to
+
+    :return: A tuple of a dictionary of alias -> imported bot module, and a dictionary of
+             alias -> (bot module, function name)
+    """
+    module_aliases = {}
+    function_aliases = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name in modules:
+                    module_aliases[alias.asname or alias.name] = alias.name
+        elif isinstance(node, ast.ImportFrom) and node.module in modules:
+            for alias in node.names:
+                function_aliases[alias.asname or alias.name] = (node.module, alias.name)
+    return module_aliases, function_aliases
+
+
+def __find_blocking_calls__(trees):
+    """
+    Finds blocking HTTP calls that can be reached from a coroutine.
+    Synchronous functions of the bot modules are followed, since a coroutine calling a blocking
+    helper blocks just the same. Calls are resolved per module: plain and self. calls go to the module
+    itself, calls through an imported bot module go to that module, and calls on any other object go
+    to every function of that name, since its type isn't known.
+
+    :param trees: Dictionary of module name (without .py) -> parsed module
+    :return: A list of (module, coroutine name, line number, call name) tuples
+    """
+    functions = {module: __index_functions__(tree) for module, tree in trees.items()}
+    imports = {module: __imports__(tree, trees) for module, tree in trees.items()}
+
+    def resolve(module, name):
+        parts = name.split('.')
+        module_aliases, function_aliases = imports[module]
+        if len(parts) == 1:
+            if parts[0] in function_aliases:
+                target, function = function_aliases[parts[0]]
+                return [(target, node) for node in functions[target].get(function, [])]
+            return [(module, node) for node in functions[module].get(parts[0], [])]
+        if len(parts) == 2 and parts[0] in module_aliases:
+            target = module_aliases[parts[0]]
+            return [(target, node) for node in functions[target].get(parts[1], [])]
+        if len(parts) == 2 and parts[0] in ('self', 'cls'):
+            return [(module, node) for node in functions[module].get(parts[1], [])]
+        return [(other, node) for other in functions for node in functions[other].get(parts[-1], [])]
+
+    findings = []
+    for module in sorted(functions):
+        coroutines = [node for nodes in functions[module].values() for node in nodes
+                      if isinstance(node, ast.AsyncFunctionDef)]
+        for coroutine in coroutines:
+            to_visit = [(module, coroutine)]
+            visited = set()
+            while to_visit:
+                function_module, function = to_visit.pop()
+                if id(function) in visited:
+                    continue
+                visited.add(id(function))
+
+                for node in ast.walk(function):
+                    if not isinstance(node, ast.Call):
+                        continue
+                    name = __call_name__(node)
+                    if __is_blocking__(name):
+                        findings.append((function_module + '.py', coroutine.name, node.lineno, name))
+
+                    # Follow synchronous helpers defined in the bot modules
+                    for helper in resolve(function_module, name):
+                        if isinstance(helper[1], ast.FunctionDef):
+                            to_visit.append(helper)
+
+    return findings
+
+
+def main():
+    trees = {}
+    for module in __bot_modules__():
+        with open(os.path.join(ROOT, module)) as f:
+            trees[module[:-len('.py')]] = ast.parse(f.read(), filename=module)
+
+    failed = False
+    for module, coroutine, line, name in __find_blocking_calls__(trees):
+        print("{}:{}: {}() is reachable from coroutine {}()".format(module, line, name, coroutine))
+        failed = True
+
+    if failed:
+        print("Blocking HTTP calls found on the event loop")
+        sys.exit(1)
+
+    print("No blocking HTTP calls reachable from coroutines")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+A stand-in for the parts of the wakatime API the bot uses, so the bot can be run and benchmarked offline.
+Point the bot at it with WAKA_SITE_URL=http://127.0.0.1:8181
+
+Every user gets made up but stable data, worked out from the account id inside their tokens.
+GET /_stats returns how many requests each endpoint answered with each status, POST /_reset clears the counts.
+POST /_revoke?account=<id> makes the tokens of an account stop working, like a user revoking the bot's access.
+API responses carry an ETag, requests whose If-None-Match matches it get a 304 (turn off with --no-etags).
+GET /oauth/authorize allows access right away and redirects back with a code, for a made up account
+(or ?account=<id>), so registrations can be run end to end.
+
+Usage (from the repository root):
+    python scripts/fake_wakatime.py [--port 8181] [--latency 0.05] [--jitter 0.02] [--error-rate 0]
+                                    [--rate-limit 0] [--retry-after 1] [--languages 5] [--no-etags]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from collections import Counter
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+# Days covered by the named ranges of the summaries endpoint
+RANGE_DAYS = {'today': 1, 'last_7_days': 7, 'last_30_days': 30, 'last_6_months': 183, 'last_year': 365}
+
+LANGUAGES = ['Python', 'JavaScript', 'TypeScript', 'Go', 'Rust', 'Java', 'C', 'C++', 'C#', 'Ruby',
+             'PHP', 'Kotlin', 'Swift', 'Haskell', 'Lua', 'Bash', 'SQL', 'HTML', 'CSS', 'Markdown']
+
+
+def make_token(prefix, account):
+    """
+    Makes a token that belongs to an account. The fake server finds the account again from the token,
+    so tokens seeded into the database have to look like this too
+    """
+    return '{}_{}_{}'.format(prefix, account, os.urandom(8).hex())
+
+
+def account_of(token):
+    parts = token.split('_')
+    return parts[1] if len(parts) >= 3 else hashlib.sha1(token.encode()).hexdigest()[:12]
+
+
+def duration_text(seconds):
+    hours, minutes = divmod(int(seconds) // 60, 60)
+    return '{} hrs {} mins'.format(hours, minutes)
+
+
+def day_json(account, day, language_count):
+    """
+    The summary of a single day, the same every time it's asked for
+    """
+    rng = random.Random('{}{}'.format(account, day.isoformat()))
+    total = rng.randint(0, 8 * 3600)
+
+    languages = []
+    left = total
+    for name in rng.sample(LANGUAGES, min(language_count, len(LANGUAGES))):
+        seconds = rng.randint(0, left)
+        left -= seconds
+        languages.append({'name': name, 'total_seconds': seconds, 'text': duration_text(seconds),
+                          'percent': round(100 * seconds / total, 2) if total else 0})
+    languages.sort(key=lambda language: language['total_seconds'], reverse=True)
+
+    return {'grand_total': {'total_seconds': total, 'text': duration_text(total)},
+            'languages': languages,
+            'range': {'date': day.isoformat(), 'text': day.strftime('%a %b %d')}}
+
+
+class FakeWakatime:
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, rate_limit=0, retry_after=1, languages=5,
+                 etags=True):
+        self.latency = latency  # Average seconds before answering
+        self.jitter = jitter  # Answers take latency +/- jitter seconds
+        self.error_rate = error_rate  # Fraction of requests answered with a 500
+        self.rate_limit = rate_limit  # Requests per second answered before sending 429s, 0 for no limit
+        self.retry_after = retry_after  # Retry-After header of the 429s
+        self.languages = languages  # Languages per day, decides how big summaries are
+        self.etags = etags  # If API responses get an ETag and conditional requests get 304s
+
+        self.calls = Counter()  # (endpoint, status) -> count
+        self.revoked = set()  # Accounts whose tokens are refused
+        self.__window__ = (0, 0)  # (second, requests answered in it)
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.__middleware__])
+        app.router.add_get('/oauth/authorize', self.authorize)
+        app.router.add_post('/oauth/token', self.token)
+        app.router.add_get('/api/v1/users/current', self.current_user)
+        app.router.add_get('/api/v1/users/current/summaries', self.summaries)
+        app.router.add_get('/api/v1/users/current/all_time_since_today', self.all_time)
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_reset', self.reset)
+        app.router.add_post('/_revoke', self.revoke)
+        return app
+
+    def __rate_limited__(self):
+        if not self.rate_limit:
+            return False
+
+        second = int(time.monotonic())
+        window, count = self.__window__
+        if window != second:
+            window, count = second, 0
+        self.__window__ = (window, count + 1)
+        return count >= self.rate_limit
+
+    @web.middleware
+    async def __middleware__(self, request, handler):
+        if request.path.startswith('/_'):
+            return await handler(request)
+
+        endpoint = request.path
+        if self.__rate_limited__():
+            response = web.json_response({'error': 'Rate limited'}, status=429,
+                                         headers={'Retry-After': str(self.retry_after)})
+        else:
+            await asyncio.sleep(max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+            if random.random() < self.error_rate:
+                response = web.json_response({'error': 'Internal server error'}, status=500)
+            else:
+                try:
+                    response = await handler(request)
+                except web.HTTPException as e:
+                    response = e
+
+                if self.etags and request.method == 'GET' and response.status == 200:
+                    response = self.__conditional__(request, response)
+
+        self.calls[(endpoint, response.status)] += 1
+        return response
+
+    def __conditional__(self, request, response):
+        etag = '"{}"'.format(hashlib.sha1(response.body).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+
+        response.headers['ETag'] = etag
+        return response
+
+    def __account__(self, request):
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer ') or account_of(header[len('Bearer '):]) in self.revoked:
+            raise web.HTTPUnauthorized(text=json.dumps({'error': 'Unauthorized'}), content_type='application/json')
+        return account_of(header[len('Bearer '):])
+
+    async def authorize(self, request):
+        try:
+            redirect_uri = request.query['redirect_uri']
+            state = request.query['state']
+        except KeyError:
+            return web.json_response({'error': 'invalid_request'}, status=400)
+
+        account = request.query.get('account') or os.urandom(6).hex()
+        raise web.HTTPFound('{}?{}'.format(redirect_uri, urlencode({'code': make_token('code', account),
+                                                                    'state': state})))
+
+    async def token(self, request):
+        form = await request.post()
+        if form.get('grant_type') == 'refresh_token' and form.get('refresh_token'):
+            account = account_of(form['refresh_token'])
+        elif form.get('grant_type') == 'authorization_code' and form.get('code'):
+            account = account_of(form['code'])
+        else:
+            return web.json_response({'error': 'invalid_grant'}, status=400)
+
+        if account in self.revoked:
+            return web.json_response({'error': 'invalid_grant'}, status=400)
+
+        # Wakatime answers token requests form encoded
+        body = urlencode({'access_token': make_token('sec', account),
+                          'refresh_token': make_token('ref', account),
+                          'expires_in': 3600,
+                          'uid': account,
+                          'token_type': 'bearer'})
+        return web.Response(text=body, content_type='application/x-www-form-urlencoded')
+
+    async def current_user(self, request):
+        account = self.__account__(request)
+        return web.json_response({'data': {'id': account, 'username': account}})
+
+    async def summaries(self, request):
+        account = self.__account__(request)
+        today = date.today()
+
+        try:
+            if 'range' in request.query:
+                start = today - timedelta(days=RANGE_DAYS[request.query['range']] - 1)
+                end = today
+            else:
+                start = date.fromisoformat(request.query['start'])
+                end = date.fromisoformat(request.query['end'])
+        except (KeyError, ValueError):
+            return web.json_response({'error': 'Invalid range'}, status=400)
+
+        days = []
+        day = start
+        while day <= end:
+            days.append(day_json(account, day, self.languages))
+            day += timedelta(days=1)
+
+        total = sum(day['grand_total']['total_seconds'] for day in days)
+        return web.json_response({'data': days,
+                                  'cummulative_total': {'seconds': total, 'text': duration_text(total)},
+                                  'start': start.isoformat(), 'end': end.isoformat()})
+
+    async def all_time(self, request):
+        account = self.__account__(request)
+        rng = random.Random(account)
+        total = rng.randint(0, 5000 * 3600)
+        started = date.today() - timedelta(days=rng.randint(30, 3000))
+        return web.json_response({'data': {'total_seconds': total,
+                                           'text': duration_text(total),
+                                           'is_up_to_date': True,
+                                           'range': {'start_date': started.isoformat(),
+                                                     'start_text': started.strftime('%a %b %d %Y')}}})
+
+    async def stats(self, request):
+        return web.json_response([{'endpoint': endpoint, 'status': status, 'count': count}
+                                  for (endpoint, status), count in self.calls.items()])
+
+    async def reset(self, request):
+        self.calls.clear()
+        return web.json_response({})
+
+    async def revoke(self, request):
+        self.revoked.add(request.query['account'])
+        return web.json_response({})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8181,
+                        help="the bot's own web server listens on 8080 by default")
+    parser.add_argument('--latency', type=float, default=0.05, help='average seconds before answering')
+    parser.add_argument('--jitter', type=float, default=0.02, help='answers take latency +/- jitter seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 500')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second before sending 429s')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the 429s in seconds')
+    parser.add_argument('--languages', type=int, default=5, help='languages per day in summaries')
+    parser.add_argument('--no-etags', dest='etags', action='store_false', help='never answer with a 304')
+    args = parser.parse_args()
+
+    fake = FakeWakatime(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        rate_limit=args.rate_limit, retry_after=args.retry_after, languages=args.languages,
+                        etags=args.etags)
+    web.run_app(fake.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,187 @@
+"""
+Copies the registration tables between SQLite and MySQL, in either direction.
+Rows are streamed from the source in primary key order, a chunk at a time, and every chunk is written
+to the target with multi-row inserts in its own transaction. After every chunk the last copied key is
+saved to a checkpoint file, so a copy that died halfway picks up where it stopped when run again.
+Rows that already exist in the target are replaced, so copying a chunk twice is harmless.
+
+The target schema is brought up to date with the bot's migrations first. Stop the bot while copying.
+MySQL is configured through secrets.env, the same as for the bot.
+
+Usage (from the repository root):
+    python scripts/sqlite2mysql.py [--from sqlite] [--to mysql] [--sqlite users.db]
+                                   [--tables wakadata,authenticationstate] [--chunk-size 1000]
+                                   [--checkpoint migration-checkpoint.json] [--restart]
+"""
+import argparse
+import json
 import os
-import sqlite3
+import sys
+import time
 
 from dotenv import load_dotenv
-from peewee import *
-from playhouse.mysql_ext import MySQLDatabase
+from peewee import MySQLDatabase, SqliteDatabase, Tuple, fn
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import constant
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='source', choices=['sqlite', 'mysql'], default='sqlite')
+    parser.add_argument('--to', dest='target', choices=['sqlite', 'mysql'], default='mysql')
+    parser.add_argument('--sqlite', default='users.db', help='path of the SQLite database')
+    parser.add_argument('--tables', default='wakadata,authenticationstate',
+                        help='comma separated tables to copy, dailysummary and dailylanguage can be copied too')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='rows read and committed at a time')
+    parser.add_argument('--checkpoint', default='migration-checkpoint.json')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and copy everything again')
+    args = parser.parse_args()
+
+    if args.source == args.target:
+        parser.error('--from and --to must be different databases')
+    args.tables = [table.strip() for table in args.tables.split(',') if table.strip()]
+    return args
+
+
+def open_source(backend, sqlite_path):
+    if backend == 'sqlite':
+        if not os.path.exists(sqlite_path):
+            raise SystemExit('{} does not exist'.format(sqlite_path))
+        return SqliteDatabase(sqlite_path)
+
+    return MySQLDatabase(os.getenv('MYSQL_DATABASE_NAME'),
+                         host=os.getenv('MYSQL_HOST'),
+                         user=os.getenv('MYSQL_USER'),
+                         password=os.getenv('MYSQL_PASSWORD'))
+
+
+def load_checkpoint(args):
+    """
+    :return: The saved progress of every table, empty if there is none or it belongs to another copy
+    """
+    if args.restart or not os.path.exists(args.checkpoint):
+        return {}
+
+    with open(args.checkpoint) as file:
+        checkpoint = json.load(file)
+
+    if (checkpoint.get('from'), checkpoint.get('to'), checkpoint.get('sqlite')) != (args.source, args.target,
+                                                                                    os.path.abspath(args.sqlite)):
+        print("{} belongs to another copy, starting over".format(args.checkpoint))
+        return {}
+
+    return checkpoint['tables']
+
+
+def save_checkpoint(args, tables):
+    checkpoint = {'from': args.source, 'to': args.target, 'sqlite': os.path.abspath(args.sqlite), 'tables': tables}
+
+    # Written to a temporary file first so a crash can't leave half a checkpoint behind
+    temporary = args.checkpoint + '.tmp'
+    with open(temporary, 'w') as file:
+        # Keys of daily summaries hold dates, they compare the same as their ISO strings
+        json.dump(checkpoint, file, indent=2, default=str)
+    os.replace(temporary, args.checkpoint)
+
+
+def copy_table(model, source, target, args, progress, tables):
+    """
+    Copies every row of a table that comes after the checkpoint, a chunk at a time
+
+    :param model: The DbModel model of the table
+    :param source: The database to read from
+    :param target: The database to write to
+    :param progress: The checkpoint of the table, updated as chunks get committed
+    :param tables: The checkpoint of every table, saved after every chunk
+    :return: Nothing
+    """
+    table = model._meta.table_name
+    key_fields = [model._meta.fields[name] for name in model._meta.primary_key.field_names]
+
+    # Older databases may not have every column yet, those are left to their defaults
+    source_columns = set(column.name for column in source.get_columns(table))
+    fields = [field for field in model._meta.sorted_fields if field.column_name in source_columns]
+
+    with source.bind_ctx([model]):
+        total = model.select(fn.COUNT(1)).scalar()
+
+    copied_before = progress['rows']
+    started = time.perf_counter()
+
+    while True:
+        # Keyset pagination, every chunk starts after the last key of the previous one.
+        # Unlike OFFSET it doesn't get slower the further in the table it gets
+        with source.bind_ctx([model]):
+            query = model.select(*fields).order_by(*key_fields).limit(args.chunk_size)
+            if progress['last_key'] is not None:
+                query = query.where(Tuple(*key_fields) > Tuple(*progress['last_key']))
+            rows = list(query.dicts())
+
+        if not rows:
+            break
+
+        with target.atomic():
+            for start in range(0, len(rows), constant.DB_BATCH_SIZE):
+                model.insert_many(rows[start:start + constant.DB_BATCH_SIZE]).on_conflict_replace().execute()
+
+        progress['last_key'] = [rows[-1][field.name] for field in key_fields]
+        progress['rows'] += len(rows)
+        save_checkpoint(args, tables)
 
-load_dotenv('../secrets.env')
-HOST = os.getenv('MYSQL_HOST')
-MYSQL_USERNAME = os.getenv('MYSQL_USER')
-MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD')
-DB_NAME = os.getenv('MYSQL_DATABASE_NAME')
+        elapsed = time.perf_counter() - started
+        copied = progress['rows'] - copied_before
+        print("{}: {}/{} rows, {:.0f} rows/s".format(table, progress['rows'], total, copied / elapsed if elapsed else 0))
 
-mysql_db = MySQLDatabase(
-    host=HOST,
-    user=MYSQL_USERNAME,
-    password=MYSQL_PASSWORD,
-    database=DB_NAME
-)
+        if len(rows) < args.chunk_size:
+            break
 
+    progress['done'] = True
+    save_checkpoint(args, tables)
 
-class BaseModel(Model):
-    """A base model that will use our Sqlite database."""
+    elapsed = time.perf_counter() - started
+    copied = progress['rows'] - copied_before
+    print("{}: done, copied {} rows in {:.1f}s ({:.0f} rows/s)".format(table, copied, elapsed,
+                                                                         copied / elapsed if elapsed else 0))
 
-    class Meta:
-        database = mysql_db
-        primary_key = CompositeKey('discord_username', 'server_id')
 
+def main():
+    args = parse_args()
+    load_dotenv(os.path.join(ROOT, 'secrets.env'))
 
-class WakaData(BaseModel):
-    discord_username = CharField(null=False, max_length=40)
-    wakatime_username = CharField(null=True, max_length=40)
-    auth_token = CharField(null=True, max_length=100)
-    refresh_token = CharField(null=True, max_length=100)
-    server_id = BigIntegerField(null=False)
+    # DbModel connects to the target, so the target gets the bot's migrations and the copy goes through its pool
+    os.environ['DB_BACKEND'] = args.target
+    os.environ['SQLITE_PATH'] = args.sqlite
+    import DbModel
 
+    models = {model._meta.table_name: model for model in [DbModel.WakaData, DbModel.AuthenticationState,
+                                                          DbModel.DailySummary, DbModel.DailyLanguage]}
+    unknown = [table for table in args.tables if table not in models]
+    if unknown:
+        raise SystemExit('Unknown tables: {}'.format(', '.join(unknown)))
 
-mysql_db.connect()
+    tables = load_checkpoint(args)
+    source = open_source(args.source, args.sqlite)
+    target = DbModel.db
 
-conn = sqlite3.connect('../users.db')
-c = conn.cursor()
+    DbModel.migrate_schema()
+    source.connect()
+    target.connect(reuse_if_open=True)
+    try:
+        for table in args.tables:
+            progress = tables.setdefault(table, {'last_key': None, 'rows': 0, 'done': False})
+            if progress['done']:
+                print("{}: already copied, skipping".format(table))
+                continue
+            copy_table(models[table], source, target, args, progress, tables)
+    finally:
+        source.close()
+        target.close()
+        DbModel.shutdown()
 
-c.execute("SELECT * FROM wakadata")
-data = c.fetchall()
+    print("Copy finished. Run with --restart to copy everything again")
 
-for row in data:
-    WakaData.create(discord_username=row[0],
-                    wakatime_username=row[1],
-                    auth_token=row[2],
-                    refresh_token=row[3],
-                    server_id=row[4])
 
-mysql_db.close()
-conn.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
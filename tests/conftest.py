@@ -0,0 +1,47 @@
+"""
+DbModel, auth and friends read their configuration when they're imported, so every test runs against
+a SQLite file in a temporary directory instead of the MySQL database in secrets.env.
+"""
+import os
+import sys
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp()
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = os.path.join(TEST_DIR, 'test.db')
+os.environ['HTTP_CACHE_DIR'] = os.path.join(TEST_DIR, 'http-cache')
+os.environ['FETCH_WORKERS'] = '0'
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pytest
+
+import DbModel
+
+
+def drop_all_tables():
+    DbModel.db.connect(reuse_if_open=True)
+    try:
+        for table in DbModel.db.get_tables():
+            DbModel.db.execute_sql('DROP TABLE "{}"'.format(table))
+    finally:
+        DbModel.db.close()
+    DbModel.record_cache.invalidate_where(lambda key: True)
+
+
+@pytest.fixture
+def empty_database():
+    """
+    A database without any tables, not even the schema version
+    """
+    drop_all_tables()
+    yield DbModel.db
+    drop_all_tables()
+
+
+@pytest.fixture
+def database(empty_database):
+    """
+    A database with the latest schema and no rows
+    """
+    DbModel.migrate_schema()
+    return empty_database
@@ -0,0 +1,157 @@
+import asyncio
+import os
+
+import pytest
+
+import cache
+from cache import ResponseCache, SingleFlight, TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_ttl_cache_entries_expire(clock):
+    entries = TTLCache(10, default_ttl=60)
+    entries.set('default', 1)
+    entries.set('short', 2, ttl=5)
+    entries.set('never', 3, ttl=0)
+
+    assert entries.get('short') == 2
+    assert entries.get('never') is None
+
+    clock.now += 5
+    assert entries.get('short') is None
+    assert entries.get('default') == 1
+
+    clock.now += 55
+    assert entries.get('default') is None
+    assert len(entries) == 0
+
+
+def test_ttl_cache_evicts_the_least_recently_used_entry(clock):
+    entries = TTLCache(2, default_ttl=60)
+    entries.set('a', 1)
+    entries.set('b', 2)
+    entries.get('a')
+    entries.set('c', 3)
+
+    assert entries.get('b') is None
+    assert entries.get('a') == 1
+    assert entries.get('c') == 3
+
+
+def test_ttl_cache_invalidation(clock):
+    entries = TTLCache(10, default_ttl=60)
+    for i in range(4):
+        entries.set(('server', i), i)
+
+    entries.invalidate(('server', 0))
+    entries.invalidate_where(lambda key: key[1] == 1)
+    entries.invalidate_values_where(lambda value: value == 2)
+
+    assert [entries.get(('server', i)) for i in range(4)] == [None, None, None, 3]
+
+
+def test_single_flight_runs_once_for_concurrent_callers():
+    async def scenario():
+        flights = SingleFlight('test')
+        calls = []
+        release = asyncio.Event()
+
+        async def compute(value):
+            calls.append(value)
+            await release.wait()
+            return value * 2
+
+        first = asyncio.ensure_future(flights.run('key', compute, 1))
+        second = asyncio.ensure_future(flights.run('key', compute, 2))
+        await asyncio.sleep(0)
+        assert flights.running('key')
+
+        release.set()
+        assert await asyncio.gather(first, second) == [2, 2]
+        assert calls == [1]
+        assert not flights.running('key')
+
+        # Once it's done the next caller runs it again
+        assert await flights.run('key', compute, 3) == 6
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_keeps_running_when_a_caller_gives_up():
+    async def scenario():
+        flights = SingleFlight('test')
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return 'done'
+
+        leaving = asyncio.ensure_future(flights.run('key', compute))
+        staying = asyncio.ensure_future(flights.run('key', compute))
+        await asyncio.sleep(0)
+
+        leaving.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await staying == 'done'
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_passes_failures_on_to_every_caller():
+    async def scenario():
+        flights = SingleFlight('test')
+
+        async def compute():
+            await asyncio.sleep(0)
+            raise ValueError('broken')
+
+        results = await asyncio.gather(flights.run('key', compute), flights.run('key', compute),
+                                       return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert not flights.running('key')
+
+    asyncio.run(scenario())
+
+
+def test_response_cache_round_trip(tmp_path):
+    async def scenario():
+        responses = ResponseCache(str(tmp_path), max_bytes=10 ** 6)
+        assert await responses.get(('account', 'url')) is None
+
+        await responses.put(('account', 'url'), '"etag"', 'Mon, 01 Jan 2024 00:00:00 GMT', '{"data": []}')
+        stored = await responses.get(('account', 'url'))
+        assert stored == cache.CachedResponse('"etag"', 'Mon, 01 Jan 2024 00:00:00 GMT', '{"data": []}')
+
+        # Another process, or the bot after a restart, finds it too
+        assert ResponseCache(str(tmp_path), max_bytes=10 ** 6).load(('account', 'url')) == stored
+
+    asyncio.run(scenario())
+
+
+def test_response_cache_evicts_the_least_recently_used_responses(tmp_path):
+    responses = ResponseCache(str(tmp_path), max_bytes=2500)
+    body = os.urandom(1000).hex()  # Compresses to about half, so every file is a little over 1000 bytes
+    responses.store('a', None, None, body)
+    responses.store('b', None, None, body)
+    responses.load('a')
+    responses.store('c', None, None, body)
+
+    assert responses.load('b') is None
+    assert responses.load('a').body == body
+    assert responses.load('c').body == body
+    assert len(os.listdir(str(tmp_path))) == 2
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from command_scheduler import BACKGROUND, HEAVY, INTERACTIVE, Busy, CommandScheduler, PriorityLimiter, SharedPriority
+
+
+async def settle():
+    # Lets every task that can run get as far as it can
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def take(limiter, level, name, order):
+    await limiter.acquire(level)
+    order.append(name)
+
+
+def test_limiter_lets_tasks_in_up_to_its_limit():
+    async def scenario():
+        limiter = PriorityLimiter(2)
+        order = []
+        tasks = [asyncio.ensure_future(take(limiter, INTERACTIVE, i, order)) for i in range(3)]
+        await settle()
+        assert order == [0, 1]
+        assert limiter.waiting() == 1
+
+        limiter.release()
+        await settle()
+        assert order == [0, 1, 2]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_limiter_hands_over_to_the_most_urgent_waiter_first():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(INTERACTIVE)
+        order = []
+        tasks = [asyncio.ensure_future(take(limiter, level, name, order))
+                 for level, name in [(BACKGROUND, 'background'), (HEAVY, 'heavy 1'), (INTERACTIVE, 'interactive'),
+                                     (HEAVY, 'heavy 2')]]
+        await settle()
+        assert limiter.waiting(HEAVY) == 2
+
+        for _ in tasks:
+            limiter.release()
+            await settle()
+
+        # Same priority goes in the order of arrival
+        assert order == ['interactive', 'heavy 1', 'heavy 2', 'background']
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_limiter_skips_cancelled_waiters():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(INTERACTIVE)
+        order = []
+        cancelled = asyncio.ensure_future(take(limiter, INTERACTIVE, 'cancelled', order))
+        waiting = asyncio.ensure_future(take(limiter, HEAVY, 'waiting', order))
+        await settle()
+
+        cancelled.cancel()
+        await settle()
+        limiter.release()
+        await settle()
+
+        assert order == ['waiting']
+        assert limiter.waiting() == 0
+        await waiting
+
+    asyncio.run(scenario())
+
+
+def test_shared_priority_moves_waiters_up_when_a_more_urgent_task_joins():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        await limiter.acquire(INTERACTIVE)
+        order = []
+        shared = SharedPriority(BACKGROUND)
+        refresh = asyncio.ensure_future(take(limiter, shared, 'refresh', order))
+        heavy = asyncio.ensure_future(take(limiter, HEAVY, 'heavy', order))
+        await settle()
+        assert limiter.waiting(BACKGROUND) == 1
+
+        shared.join(INTERACTIVE)
+        # Joining with a less urgent priority doesn't change anything
+        shared.join(HEAVY)
+        assert shared.level == INTERACTIVE
+        assert limiter.waiting(INTERACTIVE) == 1
+
+        limiter.release()
+        await settle()
+        limiter.release()
+        await settle()
+
+        assert order == ['refresh', 'heavy']
+        # Only the queues it's waiting in right now get moved
+        assert shared.__waiting__ == []
+        await asyncio.gather(refresh, heavy)
+
+    asyncio.run(scenario())
+
+
+def test_heavy_jobs_are_turned_away_when_too_many_are_waiting():
+    async def scenario():
+        jobs = CommandScheduler(heavy_limit=1, max_waiting=1, job_estimate=10, cooldowns={})
+        release = asyncio.Event()
+
+        async def job():
+            async with jobs.heavy_job('leaderboard'):
+                await release.wait()
+
+        running = asyncio.ensure_future(job())
+        waiting = asyncio.ensure_future(job())
+        await settle()
+
+        with pytest.raises(Busy) as busy:
+            async with jobs.heavy_job('leaderboard'):
+                pass
+        assert busy.value.retry_after >= 10
+
+        release.set()
+        await asyncio.gather(running, waiting)
+
+    asyncio.run(scenario())
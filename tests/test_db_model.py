@@ -0,0 +1,102 @@
+from datetime import date, datetime, timedelta
+
+import DbModel
+from DbModel import WakaData
+
+
+def register(discord_username, refresh_token, server_id=1):
+    WakaData.create(discord_username=discord_username, server_id=server_id, auth_token='access-' + refresh_token,
+                    refresh_token=refresh_token, wakatime_username=discord_username)
+
+
+def schema_versions():
+    return [row.version for row in DbModel.SchemaVersion.select().order_by(DbModel.SchemaVersion.version)]
+
+
+def test_migrations_apply_in_order_and_only_once(empty_database):
+    assert DbModel.migrate_schema(target_version=4) == 4
+    assert schema_versions() == [1, 2, 3, 4]
+
+    assert DbModel.migrate_schema() == len(DbModel.MIGRATIONS)
+    assert schema_versions() == list(range(1, len(DbModel.MIGRATIONS) + 1))
+
+    assert DbModel.migrate_schema() == len(DbModel.MIGRATIONS)
+    assert schema_versions() == list(range(1, len(DbModel.MIGRATIONS) + 1))
+
+
+def test_migrations_bring_the_tables_in_line_with_the_models(empty_database):
+    DbModel.migrate_schema()
+    for model in [WakaData, DbModel.AuthenticationState, DbModel.DailySummary, DbModel.DailyLanguage]:
+        columns = set(column.name for column in empty_database.get_columns(model._meta.table_name))
+        assert columns == set(field.column_name for field in model._meta.sorted_fields)
+
+
+def test_languages_stored_on_daily_summaries_move_to_their_own_table(empty_database):
+    # Databases migrated before languages got their own table kept them in a JSON column
+    version = DbModel.MIGRATIONS.index(DbModel.__create_daily_languages__)
+    DbModel.migrate_schema(target_version=version)
+    empty_database.execute_sql('ALTER TABLE dailysummary ADD COLUMN languages TEXT')
+    empty_database.execute_sql('INSERT INTO dailysummary (account, day, total_seconds, languages) '
+                               'VALUES (?, ?, ?, ?)', ('account', '2024-01-01', 60, '{"Python": 40, "Go": 20}'))
+
+    DbModel.migrate_schema()
+
+    assert 'languages' not in [column.name for column in empty_database.get_columns('dailysummary')]
+    assert DbModel.get_daily_summaries('account', date(2024, 1, 1), date(2024, 1, 1)) == \
+        [{'day': date(2024, 1, 1), 'total_seconds': 60, 'languages': {'Python': 40, 'Go': 20}}]
+
+
+def test_token_updates_are_a_compare_and_swap(database):
+    register('alice', 'old-a')
+    register('bob', 'old-b')
+    expires_at = datetime(2030, 1, 1)
+
+    # Cached before the refresh, the cache mustn't keep handing out the old tokens
+    assert DbModel.get_discord_user_data('alice', 1).refresh_token == 'old-a'
+
+    # Another bot process already refreshed bob
+    WakaData.update(refresh_token='other-b').where(WakaData.refresh_token == 'old-b').execute()
+
+    written = DbModel.update_tokens_bulk([('old-a', 'new-a', 'access-new-a', expires_at),
+                                          ('old-b', 'new-b', 'access-new-b', expires_at)])
+
+    assert written == {'new-a'}
+    alice = DbModel.get_discord_user_data('alice', 1)
+    assert (alice.refresh_token, alice.auth_token, alice.expires_at) == ('new-a', 'access-new-a', expires_at)
+    bob = WakaData.get(WakaData.discord_username == 'bob')
+    assert (bob.refresh_token, bob.auth_token) == ('other-b', 'access-old-b')
+
+
+def test_token_updates_in_many_batches(database):
+    count = DbModel.constant.DB_BATCH_SIZE * 2 + 1
+    for i in range(count):
+        register('user{}'.format(i), 'old{}'.format(i))
+
+    written = DbModel.update_tokens_bulk([('old{}'.format(i), 'new{}'.format(i), 'access', None)
+                                          for i in range(count)])
+
+    assert written == set('new{}'.format(i) for i in range(count))
+    assert WakaData.select().where(WakaData.refresh_token.startswith('old')).count() == 0
+
+
+def test_cached_records_are_copies(database):
+    register('alice', 'old-a')
+    record = DbModel.get_discord_user_data('alice', 1)
+    # Like a token refresh whose save never happened
+    record.auth_token = 'unsaved'
+
+    assert DbModel.get_discord_user_data('alice', 1).auth_token == 'access-old-a'
+
+
+def test_old_daily_summaries_are_deleted(database):
+    first = date(2024, 1, 1)
+    for account in ['a', 'b']:
+        DbModel.save_daily_summaries(account, [{'day': first + timedelta(days=i), 'total_seconds': 60,
+                                                'languages': {'Python': 60}} for i in range(4)])
+
+    assert DbModel.delete_daily_summaries_before(first + timedelta(days=2)) == 4
+
+    for account in ['a', 'b']:
+        days = DbModel.get_daily_summaries(account, first, first + timedelta(days=3))
+        assert [day['day'] for day in days] == [first + timedelta(days=2), first + timedelta(days=3)]
+    assert DbModel.DailyLanguage.select().where(DbModel.DailyLanguage.day < first + timedelta(days=2)).count() == 0
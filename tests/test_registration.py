@@ -0,0 +1,121 @@
+"""
+Registers a user, refreshes their tokens and has them revoked against scripts/fake_wakatime.py,
+the same way the bot talks to wakatime
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import constant
+import DbModel
+from auth import Authorizer
+from DbModel import WakaData
+from fake_wakatime import FakeWakatime, account_of
+
+SERVER_ID = 1
+DISCORD_ID = 10
+
+
+def stored_user():
+    return WakaData.get((WakaData.discord_id == DISCORD_ID) & (WakaData.server_id == SERVER_ID))
+
+
+def expire_tokens():
+    # Also forget everything that was fetched, so the next fetch has to refresh first
+    WakaData.update(expires_at=datetime.utcnow() - timedelta(minutes=1)).execute()
+    DbModel.record_cache.invalidate_where(lambda key: True)
+
+
+async def fetch_week(authenticator):
+    authenticator.account_results.invalidate_where(lambda key: True)
+    return await authenticator.async_get_wakatime_user_json('alice', SERVER_ID, constant.WEEK, DISCORD_ID)
+
+
+def test_register_refresh_and_revoke(database, monkeypatch, tmp_path):
+    async def scenario():
+        fake = FakeWakatime(latency=0, jitter=0)
+        runner = web.AppRunner(fake.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        site_url = 'http://127.0.0.1:{}'.format(site._server.sockets[0].getsockname()[1])
+
+        monkeypatch.setenv('WAKA_SITE_URL', site_url)
+        monkeypatch.setenv('HTTP_CACHE_DIR', str(tmp_path))
+        authenticator = Authorizer()
+        await authenticator.open_session()
+        try:
+            async with aiohttp.ClientSession() as browser:
+                await registration(authenticator, browser)
+                account = stored_user().wakatime_username
+                await refresh(authenticator, fake)
+                await revocation(authenticator, browser, site_url, account)
+        finally:
+            await authenticator.close_session()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+async def registration(authenticator, browser):
+    # !register hands out the authorization URL, the user allows access and wakatime sends them back with a code
+    url = await authenticator.get_user_authorization_url('alice', SERVER_ID, DISCORD_ID)
+    async with browser.get(url, allow_redirects=False) as response:
+        assert response.status == 302
+        callback = parse_qs(urlsplit(response.headers['Location']).query)
+    state = parse_qs(urlsplit(url).query)['state'][0]
+    assert callback['state'] == [state]
+
+    user = await authenticator.complete_registration(state, callback['code'][0])
+    assert user.discord_username == 'alice'
+
+    stored = stored_user()
+    account = account_of(callback['code'][0])
+    assert stored.wakatime_username == account
+    assert account_of(stored.auth_token) == account and account_of(stored.refresh_token) == account
+    assert not authenticator.token_needs_refresh(stored.expires_at)
+    # The callback can't complete the same registration twice
+    assert await authenticator.complete_registration(state, callback['code'][0]) is None
+
+    summary = await fetch_week(authenticator)
+    assert summary.error is None
+
+
+async def refresh(authenticator, fake):
+    old = stored_user()
+    expire_tokens()
+
+    summary = await fetch_week(authenticator)
+
+    assert summary.error is None
+    assert fake.calls[('/oauth/token', 200)] == 2  # The registration and the refresh
+    stored = stored_user()
+    assert stored.refresh_token != old.refresh_token and stored.auth_token != old.auth_token
+    assert not authenticator.token_needs_refresh(stored.expires_at)
+
+
+async def revocation(authenticator, browser, site_url, account):
+    async with browser.post(site_url + '/_revoke', params={'account': account}) as response:
+        assert response.status == 200
+    old = stored_user()
+    expire_tokens()
+    authenticator.leaderboard_cache.set((SERVER_ID, constant.WEEK), ([], [], 0))
+
+    summary = await fetch_week(authenticator)
+
+    assert summary.error == 'The refresh token was refused'
+    stored = stored_user()
+    assert stored.refresh_token == old.refresh_token
+    assert stored.failure_count == 1 and stored.next_attempt_at is not None
+    # The user's old data doesn't hold anymore
+    assert authenticator.leaderboard_cache.get((SERVER_ID, constant.WEEK)) is None
+
+    # Until the backoff is over the registration isn't even tried
+    summary = await fetch_week(authenticator)
+    assert summary.skipped
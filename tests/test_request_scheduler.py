@@ -0,0 +1,118 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from auth import RequestFailed, RequestScheduler
+
+
+def make_scheduler(**overrides):
+    settings = dict(max_concurrency=10, max_concurrency_per_host=10, rate=1000, burst=1000, max_retries=3,
+                    backoff_base=0.01, backoff_max=0.05, attempt_timeout=5, deadline=10)
+    settings.update(overrides)
+    return RequestScheduler(**settings)
+
+
+async def serve(responses):
+    """
+    Starts a server that answers every request to /test with the next (status, headers) of responses
+
+    :return: The URL of /test, the list of the times requests arrived, and the runner to clean up
+    """
+    arrivals = []
+
+    async def handler(request):
+        arrivals.append(time.monotonic())
+        status, headers = responses[min(len(arrivals), len(responses)) - 1]
+        return web.Response(status=status, text='attempt {}'.format(len(arrivals)), headers=headers)
+
+    app = web.Application()
+    app.router.add_route('*', '/test', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return 'http://127.0.0.1:{}/test'.format(port), arrivals, runner
+
+
+def request(scheduler, responses, method='GET', idempotent=True):
+    """
+    Sends a request through the scheduler to a server answering with responses
+
+    :return: What the scheduler returned or raised, and the times requests arrived
+    """
+    async def scenario():
+        url, arrivals, runner = await serve(responses)
+        try:
+            async with aiohttp.ClientSession() as session:
+                try:
+                    status, text, _ = await scheduler.request(session, method, url, idempotent=idempotent)
+                    return (status, text), arrivals
+                except RequestFailed as e:
+                    return e, arrivals
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(scenario())
+
+
+def test_retries_until_the_request_goes_through():
+    result, arrivals = request(make_scheduler(), [(503, {}), (502, {}), (200, {})])
+    assert result == (200, 'attempt 3')
+    assert len(arrivals) == 3
+
+
+def test_gives_up_after_the_last_retry():
+    result, arrivals = request(make_scheduler(max_retries=2), [(503, {})])
+    assert isinstance(result, RequestFailed)
+    assert 'HTTP 503' in str(result)
+    assert len(arrivals) == 3
+
+
+def test_client_errors_are_not_retried():
+    result, arrivals = request(make_scheduler(), [(404, {}), (200, {})])
+    assert result == (404, 'attempt 1')
+    assert len(arrivals) == 1
+
+
+def test_only_unprocessed_requests_are_retried_when_they_are_not_idempotent():
+    result, arrivals = request(make_scheduler(), [(500, {}), (200, {})], method='POST', idempotent=False)
+    assert result == (500, 'attempt 1')
+
+    result, arrivals = request(make_scheduler(), [(429, {}), (200, {})], method='POST', idempotent=False)
+    assert result == (200, 'attempt 2')
+
+
+def test_waits_as_long_as_retry_after_says():
+    # The backoff alone would wait for at most 0.05 seconds
+    result, arrivals = request(make_scheduler(), [(429, {'Retry-After': '0.3'}), (200, {})])
+    assert result == (200, 'attempt 2')
+    assert arrivals[1] - arrivals[0] >= 0.29
+
+
+def test_retry_after_counts_against_the_deadline():
+    started = time.monotonic()
+    result, arrivals = request(make_scheduler(deadline=1), [(503, {'Retry-After': '30'})])
+    assert isinstance(result, RequestFailed)
+    assert len(arrivals) == 1
+    assert time.monotonic() - started < 5
+
+
+def test_retry_after_can_be_a_date():
+    scheduler = make_scheduler()
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 <= scheduler.__backoff__(0, format_datetime(retry_at, usegmt=True)) <= 30
+    # Dates in the past and values that make no sense fall back to the backoff
+    assert scheduler.__backoff__(0, format_datetime(retry_at - timedelta(hours=1), usegmt=True)) == 0
+    assert 0 <= scheduler.__backoff__(0, 'soon') <= scheduler.backoff_base
+
+
+@pytest.mark.parametrize('attempt', [0, 1, 5, 20])
+def test_backoff_stays_below_its_cap(attempt):
+    scheduler = make_scheduler(backoff_base=0.5, backoff_max=10)
+    assert 0 <= scheduler.__backoff__(attempt) <= min(10, 0.5 * 2 ** attempt)